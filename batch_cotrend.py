@@ -0,0 +1,359 @@
+"""
+Cotrend several sectors/cameras/chips on one machine
+
+Replaces submitting wrapper.sh once per CCD. Each CCD is a job made
+of the config, prepare, cbvs, cotrend and store stages, run in order.
+The stages of different jobs are scheduled together on this machine,
+keeping within a total core and memory budget. The I/O bound stages
+(config, prepare, store) run alongside the compute bound stages
+(cbvs, cotrend) of other CCDs. Each stage is booked the most cores
+any of its pools uses, e.g. prepare reads with job_cores workers and
+cotrend writes back with write_pool_size. A per-job status and timing
+table is kept up to date in batch_status.json
+"""
+import os
+import sys
+import json
+import time
+import subprocess
+import argparse as ap
+from itertools import product
+from datetime import datetime, timezone
+
+# pylint: disable=invalid-name
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# stage name -> is it compute bound? in the order they run
+STAGES = [('config', False),
+          ('prepare', False),
+          ('cbvs', True),
+          ('cotrend', True),
+          ('store', False)]
+
+# rough peak memory of each stage for one CCD, in GB
+DEFAULT_STAGE_MEMORY = {'config': 0.5,
+                        'prepare': 4,
+                        'cbvs': 8,
+                        'cotrend': 16,
+                        'store': 0.5}
+
+def arg_parse():
+    """
+    Parse the command line arguments
+    """
+    p = ap.ArgumentParser(description='Cotrend several CCDs with a local scheduler')
+    p.add_argument('--sectors',
+                   help='TESS sector IDs (e.g. S05 S06)',
+                   nargs='+',
+                   required=True)
+    p.add_argument('--cameras',
+                   help='camera IDs',
+                   nargs='+',
+                   choices=["1", "2", "3", "4"],
+                   default=["1", "2", "3", "4"])
+    p.add_argument('--chips',
+                   help='chip IDs',
+                   nargs='+',
+                   choices=["1", "2", "3", "4"],
+                   default=["1", "2", "3", "4"])
+    p.add_argument('--cbv_mode',
+                   help='CBV fitting mode, MAP | LS',
+                   choices=['MAP', 'LS'],
+                   default='LS')
+    p.add_argument('--total_cores',
+                   help='cores available to all the jobs',
+                   type=int,
+                   default=os.cpu_count())
+    p.add_argument('--total_memory',
+                   help='memory available to all the jobs, in GB',
+                   type=float,
+                   default=64)
+    p.add_argument('--job_cores',
+                   help='cores given to the pools of each CCD (the cotrendy pool_size and ingest_pool_size)',
+                   type=int,
+                   default=8)
+    p.add_argument('--write_pool_size',
+                   help='workers writing the cotrended light curves back in the cotrend stage',
+                   type=int,
+                   default=8)
+    p.add_argument('--robust_pool_size',
+                   help='processes for the batched robust fits in the cbvs and cotrend stages',
+                   type=int,
+                   default=1)
+    p.add_argument('--max_io_stages',
+                   help='most I/O bound stages running at once',
+                   type=int,
+                   default=2)
+    p.add_argument('--stage_memory',
+                   help='peak memory of a stage in GB, e.g. cotrend=24',
+                   nargs='+',
+                   default=[])
+    p.add_argument('--output_mode',
+                   help='tic or ccd, passed on to store_output.py',
+                   choices=['tic', 'ccd'],
+                   default='tic')
+    p.add_argument('--work_dir',
+                   help='scratch directory, each CCD gets its own TMPDIR in here',
+                   default=os.getenv('TMPDIR', '.'))
+    return p.parse_args()
+
+class Stage():
+    """
+    One stage of one CCD job
+    """
+    def __init__(self, job, name, compute, cores, memory):
+        """
+        Initialise the class
+
+        Parameters
+        ----------
+        job : str
+            Job name, e.g. S05_1-1
+        name : str
+            Stage name, see STAGES
+        compute : boolean
+            Is the stage compute bound?
+        cores : int
+            Cores the stage needs
+        memory : float
+            Peak memory of the stage, in GB
+        """
+        self.job = job
+        self.name = name
+        self.compute = compute
+        self.cores = cores
+        self.memory = memory
+        self.state = 'pending'
+        self.start = None
+        self.end = None
+        self.returncode = None
+        self.process = None
+        self.log = None
+
+    @property
+    def wall_time(self):
+        """
+        Wall time of the stage so far, in seconds
+        """
+        if self.start is None:
+            return None
+        return (self.end or time.time()) - self.start
+
+    def status(self):
+        """
+        Row of the status table for this stage
+        """
+        def iso(t):
+            return datetime.fromtimestamp(t, timezone.utc).isoformat() if t else None
+        return {'job': self.job,
+                'stage': self.name,
+                'state': self.state,
+                'cores': self.cores,
+                'memory_gb': self.memory,
+                'start': iso(self.start),
+                'end': iso(self.end),
+                'wall_time': self.wall_time,
+                'returncode': self.returncode}
+
+def job_tmpdir(work_dir, sector, camera, chip):
+    """
+    Scratch directory for one CCD, used as its TMPDIR
+    """
+    return os.path.join(os.path.abspath(work_dir), f"{sector}_{camera}-{chip}")
+
+def stage_cores(name, job_cores, write_pool_size, robust_pool_size):
+    """
+    Cores booked for one stage, the largest pool it runs. The pools
+    within a stage run one after another, so they are not added up
+    """
+    pools = {'config': [1],
+             'prepare': [job_cores],
+             'cbvs': [job_cores, robust_pool_size],
+             'cotrend': [job_cores, robust_pool_size, write_pool_size],
+             'store': [1]}
+    return max(pools[name])
+
+def stage_command(name, sector, camera, chip, tmpdir, job_cores, cbv_mode, output_mode,
+                  write_pool_size, robust_pool_size):
+    """
+    Command line to run one stage for one CCD
+    """
+    config = os.path.join(tmpdir, f"config_{sector}_{camera}-{chip}.toml")
+    scripts = {'config': ['write_cotrendy_config_file.py', sector, camera, chip,
+                          str(job_cores), cbv_mode,
+                          '--write_pool_size', str(write_pool_size),
+                          '--robust_pool_size', str(robust_pool_size)],
+               'prepare': ['prepare_tess_lcs_for_cotrendy.py', config],
+               'cbvs': ['cotrend_tess_lcs.py', config, '--cbvs_only'],
+               'cotrend': ['cotrend_tess_lcs.py', config],
+               'store': ['store_output.py', sector, camera, chip,
+                         '--output_mode', output_mode]}
+    script, *script_args = scripts[name]
+    return [sys.executable, os.path.join(SCRIPT_DIR, script)] + script_args
+
+def stage_memory(overrides):
+    """
+    Peak memory of each stage, the defaults with
+    any name=GB overrides from the command line
+    """
+    memory = dict(DEFAULT_STAGE_MEMORY)
+    for override in overrides:
+        name, value = override.split('=')
+        if name not in memory:
+            raise ValueError(f"Unknown stage {name}, expected one of {list(memory)}")
+        memory[name] = float(value)
+    return memory
+
+def write_status(jobs, status_file):
+    """
+    Atomically write the status table of every stage
+    """
+    rows = [stage.status() for stages in jobs.values() for stage in stages]
+    tmp_file = f"{status_file}.tmp"
+    with open(tmp_file, 'w') as sf:
+        json.dump(rows, sf, indent=2)
+    os.replace(tmp_file, status_file)
+
+def print_status(jobs):
+    """
+    Print the status and timing table
+    """
+    print(f"{'job':<12} " + " ".join(f"{name:>16}" for name, _ in STAGES))
+    for job, stages in jobs.items():
+        cells = []
+        for stage in stages:
+            wall = f" {stage.wall_time:.0f}s" if stage.wall_time is not None else ""
+            cells.append(f"{stage.state + wall:>16}")
+        print(f"{job:<12} " + " ".join(cells))
+
+def run_batch(jobs, commands, total_cores, total_memory, max_io_stages,
+              status_file, log_dir, poll=2.):
+    """
+    Run every job's stages in order, starting any stage whose job
+    is ready once there are enough free cores and memory for it.
+    Budgets under 1 are rejected up front, and a RuntimeError is
+    raised if any stage could never be started
+
+    Parameters
+    ----------
+    jobs : dict
+        Job name -> list of its Stages, in order
+    commands : dict
+        (job name, stage name) -> (command line, environment)
+    total_cores : int
+        Cores available to all the stages
+    total_memory : float
+        Memory available to all the stages, in GB
+    max_io_stages : int
+        Most I/O bound stages running at once
+    status_file : str
+        Path of the JSON status table
+    log_dir : str
+        Directory for the output of each stage
+    poll : float
+        Seconds between checks on the running stages
+
+    Returns
+    -------
+    n_failed : int
+        Number of jobs that failed
+    """
+    for name, budget in (('total_cores', total_cores), ('total_memory', total_memory),
+                         ('max_io_stages', max_io_stages)):
+        if budget < 1:
+            raise ValueError(f"{name} is {budget}, it must be at least 1")
+    os.makedirs(log_dir, exist_ok=True)
+    for stages in jobs.values():
+        for stage in stages:
+            if stage.cores > total_cores or stage.memory > total_memory:
+                raise ValueError(f"{stage.job} {stage.name} needs {stage.cores} cores and "
+                                 f"{stage.memory} GB, more than the whole budget")
+    running = []
+
+    while True:
+        # reap any finished stages, a failure skips the rest of its job
+        changed = False
+        for stage in list(running):
+            returncode = stage.process.poll()
+            if returncode is None:
+                continue
+            stage.end = time.time()
+            stage.returncode = returncode
+            stage.state = 'done' if returncode == 0 else 'failed'
+            stage.log.close()
+            running.remove(stage)
+            changed = True
+            if returncode != 0:
+                for later in jobs[stage.job]:
+                    if later.state == 'pending':
+                        later.state = 'skipped'
+
+        # the next stage of each job, compute bound stages first so
+        # the cores stay busy while the I/O bound ones fill the gaps
+        ready = [next(s for s in stages if s.state != 'done')
+                 for stages in jobs.values()
+                 if any(s.state != 'done' for s in stages)]
+        ready = [s for s in ready if s.state == 'pending']
+        ready.sort(key=lambda s: not s.compute)
+
+        for stage in ready:
+            cores_used = sum(s.cores for s in running)
+            memory_used = sum(s.memory for s in running)
+            io_running = sum(not s.compute for s in running)
+            if cores_used + stage.cores > total_cores:
+                continue
+            if memory_used + stage.memory > total_memory:
+                continue
+            if not stage.compute and io_running >= max_io_stages:
+                continue
+            command, env = commands[(stage.job, stage.name)]
+            stage.log = open(os.path.join(log_dir, f"{stage.job}_{stage.name}.log"), 'w')
+            stage.process = subprocess.Popen(command, env=env, stdout=stage.log,
+                                             stderr=subprocess.STDOUT)
+            stage.start = time.time()
+            stage.state = 'running'
+            running.append(stage)
+            changed = True
+
+        if changed:
+            write_status(jobs, status_file)
+            print_status(jobs)
+        if not running:
+            break
+        time.sleep(poll)
+
+    write_status(jobs, status_file)
+    pending = [f"{s.job} {s.name}" for stages in jobs.values() for s in stages
+               if s.state == 'pending']
+    if pending:
+        raise RuntimeError(f"{len(pending)} stages could never be started within the "
+                           f"budget: {', '.join(pending)}")
+    return sum(any(s.state == 'failed' for s in stages) for stages in jobs.values())
+
+if __name__ == "__main__":
+    args = arg_parse()
+    memory = stage_memory(args.stage_memory)
+
+    jobs, commands = {}, {}
+    for sector, camera, chip in product(args.sectors, args.cameras, args.chips):
+        job = f"{sector}_{camera}-{chip}"
+        tmpdir = job_tmpdir(args.work_dir, sector, camera, chip)
+        os.makedirs(tmpdir, exist_ok=True)
+        env = dict(os.environ, TMPDIR=tmpdir)
+        jobs[job] = []
+        for name, compute in STAGES:
+            cores = stage_cores(name, args.job_cores, args.write_pool_size,
+                                args.robust_pool_size)
+            jobs[job].append(Stage(job, name, compute, cores, memory[name]))
+            commands[(job, name)] = (stage_command(name, sector, camera, chip, tmpdir,
+                                                   args.job_cores, args.cbv_mode,
+                                                   args.output_mode, args.write_pool_size,
+                                                   args.robust_pool_size), env)
+
+    status_file = os.path.join(os.path.abspath(args.work_dir), 'batch_status.json')
+    log_dir = os.path.join(os.path.abspath(args.work_dir), 'logs')
+    n_failed = run_batch(jobs, commands, args.total_cores, args.total_memory,
+                         args.max_io_stages, status_file, log_dir)
+    print(f"Finished {len(jobs)} jobs, {n_failed} failed. Status in {status_file}")
+    sys.exit(1 if n_failed else 0)
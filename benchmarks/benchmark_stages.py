@@ -0,0 +1,508 @@
+"""
+Time and memory profile each stage of the cotrending
+
+Run on a data set from make_synthetic_data.py (or any real CCD) to
+measure the stages of the pipeline one after the other. Each stage
+runs in its own process so its peak RSS is its own, read from the
+rusage of that process and any workers it waited on.
+
+When cotrendy can be imported the real pipeline is timed: prepare,
+the cbvs and cotrend stages of cotrend_tess_lcs.cotrend_aperture, as
+batch_cotrend.py runs them, the write back and the diagnostics plots.
+Each run starts from scratch, with its own checkpoints and CBV product
+in SCRATCH_DIR and no CBV cache or MAP journal. The time of each step
+inside cotrend_aperture, e.g. the robust fits or the MAP fits, is
+taken from its instrumentation and saved with the stage.
+
+Otherwise, or with --stand_ins, the cotrend stages are replaced by
+kernels calling the engines in this repo on the arrays in the light
+curve store, with the options taken from the config: CBV extraction,
+robust fits, LS and MAP cotrending. Where the pipeline would run
+cotrendy instead, e.g. svd_mode = "cotrendy" or the default robust
+and MAP engines, the stage is a stand-in and is labelled as one in
+the output and the results. The normalised variability is always a
+stand-in for cotrendy's
+
+The results are saved as JSON, and can be saved as a baseline and
+compared against on later runs, flagging any stage that got slower
+or bigger than the tolerance allows
+"""
+import os
+import sys
+import copy
+import json
+import shutil
+import time
+import platform
+import subprocess
+import argparse as ap
+from datetime import datetime, timezone
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(SCRIPT_DIR)
+sys.path.insert(0, REPO_DIR)
+
+# pylint: disable=invalid-name
+# pylint: disable=wrong-import-position
+from astropy.io import fits
+import cotrendy.utils as cuts
+from lc_store import (LightcurveStore, store_dirname, config_apertures, config_precision,
+                      aperture_config)
+from fitting import robust_fit_coeffs_batched, cotrend_ls_stream
+from cbv_svd import truncated_svd, select_cbvs
+from map_fit import cotrend_map_kde, scaled_coordinates, DEFAULT_DIM_WEIGHTS
+from tess_io import write_back
+from checkpoint import CheckpointStore, checkpoint_dirname
+from instrumentation import Instrumentation
+
+# the stages of the real pipeline, in the order they run
+PIPELINE_STAGES = ['prepare', 'cbvs', 'cotrend', 'write_back', 'diagnostics']
+
+# the stages with the kernel stand-ins, in the order they run. Later
+# stages use the outputs of earlier ones, kept in the store and SCRATCH_DIR
+KERNEL_STAGES = ['prepare', 'cbvs', 'robust_fits', 'ls', 'map', 'write_back', 'diagnostics']
+
+STAGES = list(dict.fromkeys(PIPELINE_STAGES + KERNEL_STAGES))
+
+# intermediate arrays passed between the kernel stages
+SCRATCH_DIR = "benchmark_scratch"
+
+def arg_parse():
+    """
+    Parse the command line arguments
+    """
+    p = ap.ArgumentParser(description='Benchmark the cotrending stages')
+    p.add_argument('config',
+                   help='path to config file')
+    p.add_argument('--stages',
+                   help='stages to run, in order, defaults to all of them',
+                   nargs='+',
+                   choices=STAGES)
+    p.add_argument('--stand_ins',
+                   help='time the kernel stand-ins even if cotrendy can be imported',
+                   action='store_true')
+    p.add_argument('--aperture',
+                   help='aperture to benchmark, defaults to the first in the config')
+    p.add_argument('--results',
+                   help='JSON file for the results, defaults to benchmark_results.json in the root')
+    p.add_argument('--baseline',
+                   help='JSON results of an earlier run to compare against')
+    p.add_argument('--save_baseline',
+                   help='also save the results to this file as a new baseline')
+    p.add_argument('--tolerance',
+                   help='fractional increase in wall time or peak RSS flagged as a regression',
+                   type=float,
+                   default=0.2)
+    p.add_argument('--run_stage',
+                   help=ap.SUPPRESS,
+                   choices=STAGES)
+    p.add_argument('--timing_file',
+                   help=ap.SUPPRESS)
+    p.add_argument('--pipeline',
+                   help=ap.SUPPRESS,
+                   action='store_true')
+    return p.parse_args()
+
+def normalise(flux):
+    """
+    Normalised fluxes, (flux - median) / median
+    """
+    flux = np.asarray(flux, dtype=np.float64)
+    med = np.median(flux, axis=1)[:, None]
+    return (flux - med) / med
+
+def normalised_variability(norm_flux):
+    """
+    Stand-in for cotrendy's normalised variability, the scatter of
+    each star relative to the median scatter of all of them
+    """
+    scatter = np.std(norm_flux, axis=1)
+    return scatter / np.median(scatter)
+
+def stage_cbvs(config, store, aperture):
+    """
+    Extract the CBVs from the quieter CBV stars
+    """
+    cotrend = config['cotrend']
+    flux = normalise(store.rows(f"flux_{aperture}", store['objects_mask']))
+    flux = flux[normalised_variability(flux) < cotrend['normalised_variability_limit']]
+    svd_mode = cotrend.get('svd_mode', "cotrendy")
+    _, _, VT = truncated_svd(flux, cotrend['max_n_cbvs'],
+                             mode="exact" if svd_mode == "cotrendy" else svd_mode,
+                             oversample=cotrend.get('svd_oversample', 10),
+                             power_iters=cotrend.get('svd_power_iters', 2))
+    selected, _, _ = select_cbvs(VT, cotrend['max_n_cbvs'], cotrend['cbv_snr_limit'])
+    vect_store = np.array([selected[cbv_id] for cbv_id in sorted(selected)])
+    np.save(os.path.join(SCRATCH_DIR, 'vect_store.npy'), vect_store)
+    return {'n_cbv_stars': len(flux), 'n_cbvs': len(vect_store)}
+
+def stage_robust_fits(config, store, aperture):
+    """
+    Robust fit coefficients of every star, for the MAP priors
+    """
+    vect_store = np.load(os.path.join(SCRATCH_DIR, 'vect_store.npy'))
+    norm_flux = normalise(store[f"flux_{aperture}"])
+    fit_coeffs = robust_fit_coeffs_batched(norm_flux, vect_store,
+                                           block_rows=config['cotrend'].get('robust_block_rows', 256),
+                                           pool_size=config['cotrend'].get('robust_pool_size', 1))
+    np.save(os.path.join(SCRATCH_DIR, 'fit_coeffs.npy'), fit_coeffs)
+    np.save(os.path.join(SCRATCH_DIR, 'variability.npy'), normalised_variability(norm_flux))
+    return {'n_stars': len(norm_flux)}
+
+def stage_ls(config, store, aperture):
+    """
+    LS cotrend every star, streaming the outputs into the store for the write back
+    """
+    vect_store = np.load(os.path.join(SCRATCH_DIR, 'vect_store.npy'))
+    flux = store[f"flux_{aperture}"]
+    cor = store.add_array(f"cor_{aperture}", flux.shape, dtype=config_precision(config))
+    cbv = store.add_array(f"cbv_{aperture}", flux.shape, dtype=config_precision(config))
+    cotrend_ls_stream(flux, vect_store, cor, cbv,
+                      chunk_rows=config['cotrend'].get('stream_chunk_rows', 2048))
+    store.flush()
+    return {'n_stars': len(flux)}
+
+def stage_map(config, store, aperture):
+    """
+    MAP cotrend every star with the kde engine
+    """
+    vect_store = np.load(os.path.join(SCRATCH_DIR, 'vect_store.npy'))
+    fit_coeffs = np.load(os.path.join(SCRATCH_DIR, 'fit_coeffs.npy'))
+    variability = np.load(os.path.join(SCRATCH_DIR, 'variability.npy'))
+    coords = scaled_coordinates(store.catalog_column('ra'), store.catalog_column('dec'),
+                                store.catalog_column('mag'),
+                                config['catalog'].get('dim_weights', DEFAULT_DIM_WEIGHTS))
+    cotrend = config['cotrend']
+    cotrend_map_kde(normalise(store[f"flux_{aperture}"]), vect_store, fit_coeffs,
+                    variability, coords, cotrend['prior_normalised_variability_limit'],
+                    n_neighbours=cotrend.get('prior_n_neighbours', 40),
+                    radius=cotrend.get('prior_radius'),
+                    n_theta=cotrend.get('map_n_theta', 500),
+                    theta_mode=cotrend.get('map_theta_mode', "fixed"),
+                    pool_size=cotrend.get('pool_size', 1),
+                    chunk_stars=cotrend.get('map_chunk_stars', 64),
+                    precision=config_precision(config))
+    return {'n_stars': len(fit_coeffs), 'map_theta_mode': cotrend.get('map_theta_mode', "fixed")}
+
+def stage_write_back(config, store, aperture):
+    """
+    Write the LS outputs back to the TIC files
+    """
+    with fits.open(config['data']['cadence_mask_file']) as mf:
+        mask = mf[1].data['MASK']
+    failures = write_back(store.directory, mask, [aperture],
+                          pool_size=config['data'].get('write_pool_size', 1))
+    return {'n_files': len(store['tic_ids']), 'n_failed': len(failures)}
+
+def import_pipeline():
+    """
+    Import cotrend_tess_lcs, which needs cotrendy
+
+    Returns
+    -------
+    module : module
+        cotrend_tess_lcs, None if it cannot be imported
+    reason : str
+        Why it could not be imported, None if it could
+    """
+    try:
+        import cotrend_tess_lcs # pylint: disable=import-outside-toplevel
+    except ImportError as e:
+        return None, str(e)
+    return cotrend_tess_lcs, None
+
+def pipeline_config(config, aperture):
+    """
+    Copy of the config for one aperture with the checkpoints, CBV
+    product and pickle in SCRATCH_DIR, and the CBV cache and MAP
+    journal turned off, so the real outputs are left alone and
+    nothing is reused from an earlier run
+    """
+    config = copy.deepcopy(config)
+    config['data'].update(checkpoint_dir=os.path.join(SCRATCH_DIR, 'checkpoints'),
+                          cbv_file=os.path.join(SCRATCH_DIR, 'cbvs.pkl'),
+                          cbv_product_file=os.path.join(SCRATCH_DIR, 'cbvs.fits'),
+                          cbv_cache=False)
+    config['data'].pop('map_journal_dir', None)
+    return aperture_config(config, aperture)
+
+def substage_times(profiler):
+    """
+    Wall time of each stage cotrend_aperture recorded, by name
+    """
+    return {stage['name'].split('/', 1)[-1]: stage['wall_time'] for stage in profiler.stages}
+
+def stage_pipeline_cbvs(config, store, aperture):
+    """
+    Extract the CBVs with cotrend_aperture, as cotrend_tess_lcs.py --cbvs_only
+    """
+    cotrend_tess_lcs, _ = import_pipeline()
+    config = pipeline_config(config, aperture)
+    shutil.rmtree(checkpoint_dirname(config), ignore_errors=True)
+    profiler = Instrumentation('benchmark_cbvs')
+    cotrend_tess_lcs.cotrend_aperture(config, store, aperture, cbvs_only=True,
+                                      profiler=profiler)
+    return {'substages': substage_times(profiler)}
+
+def stage_pipeline_cotrend(config, store, aperture):
+    """
+    Cotrend every star with cotrend_aperture, as cotrend_tess_lcs.py,
+    reusing only the CBVs of the cbvs stage
+    """
+    cotrend_tess_lcs, _ = import_pipeline()
+    config = pipeline_config(config, aperture)
+    checkpoints = CheckpointStore(checkpoint_dirname(config), cotrend_tess_lcs.STAGES,
+                                  inputs_key=store.inputs_key())
+    checkpoints.invalidate('variability')
+    profiler = Instrumentation('benchmark_cotrend')
+    cotrend_tess_lcs.cotrend_aperture(config, store, aperture, profiler=profiler)
+    return {'substages': substage_times(profiler),
+            'cbv_mode': config['cotrend']['cbv_mode']}
+
+def stage_engine(stage, config, pipeline=False):
+    """
+    What a stage runs, and whether that is a stand-in for the
+    cotrendy call the pipeline would make with this config. With
+    pipeline set the cbvs stage is the real one
+
+    Returns
+    -------
+    engine : str
+        Description of what the stage runs
+    stand_in : boolean
+        Does the pipeline run something else here?
+    """
+    cotrend = config['cotrend']
+    if stage == 'cotrend':
+        return "cotrend_tess_lcs.cotrend_aperture", False
+    if stage == 'cbvs' and pipeline:
+        return "cotrend_tess_lcs.cotrend_aperture, cbvs_only", False
+    if stage == 'cbvs':
+        svd_mode = cotrend.get('svd_mode', "cotrendy")
+        if svd_mode == "cotrendy":
+            return ("truncated_svd exact, stand-in variability cut, "
+                    "in place of cotrendy's calculate_cbvs", True)
+        return f"truncated_svd {svd_mode}, stand-in variability cut", True
+    if stage == 'robust_fits':
+        if cotrend.get('robust_engine', "cotrendy") == "batched":
+            return "robust_fit_coeffs_batched, without the check against cotrendy", False
+        return ("robust_fit_coeffs_batched, in place of cotrendy's "
+                "calculate_robust_fit_coeffs_sequen", True)
+    if stage == 'ls':
+        if cotrend.get('streaming', False):
+            return "cotrend_ls_stream", False
+        if cotrend.get('ls_engine', "batched") == "batched":
+            return ("cotrend_ls_stream, in place of cotrend_data_ls_batched "
+                    "and its check against cotrendy", True)
+        return "cotrend_ls_stream, in place of cotrendy's cotrend_data_ls", True
+    if stage == 'map':
+        if cotrend.get('map_engine', "cotrendy") == "kde":
+            return "cotrend_map_kde, stand-in variability", True
+        return ("cotrend_map_kde, stand-in variability, in place of "
+                "cotrendy's cotrend_data_map_mp", True)
+    if stage == 'write_back':
+        return "write_back", False
+    return "script", False
+
+KERNELS = {'cbvs': stage_cbvs,
+           'robust_fits': stage_robust_fits,
+           'ls': stage_ls,
+           'map': stage_map,
+           'write_back': stage_write_back}
+
+PIPELINE_KERNELS = {'cbvs': stage_pipeline_cbvs,
+                    'cotrend': stage_pipeline_cotrend,
+                    'write_back': stage_write_back}
+
+def run_kernel(config_file, stage, aperture, timing_file, pipeline=False):
+    """
+    Run one kernel stage in this process, saving its own wall and
+    CPU time to timing_file. With pipeline set the real cbvs and
+    cotrend stages are run instead of the stand-ins
+    """
+    config = cuts.load_config(config_file)
+    os.chdir(config['global']['root'])
+    os.makedirs(SCRATCH_DIR, exist_ok=True)
+    store = LightcurveStore(store_dirname(config), mode='r+')
+    aperture = aperture or config_apertures(config)[0]
+
+    wall0, cpu0 = time.perf_counter(), time.process_time()
+    info = (PIPELINE_KERNELS if pipeline else KERNELS)[stage](config, store, aperture)
+    engine, stand_in = stage_engine(stage, config, pipeline=pipeline)
+    timing = {'kernel_wall_time': time.perf_counter() - wall0,
+              'kernel_cpu_time': time.process_time() - cpu0,
+              'info': dict(info, engine=engine, stand_in=stand_in)}
+    with open(timing_file, 'w') as tf:
+        json.dump(timing, tf)
+
+def stage_command(stage, config_file, aperture, timing_file, pipeline=False):
+    """
+    Command line and working directory to run one stage in its own process
+    """
+    config = cuts.load_config(config_file)
+    root = config['global']['root']
+    aperture = aperture or config_apertures(config)[0]
+    if stage == 'prepare':
+        return [sys.executable, os.path.join(REPO_DIR, 'prepare_tess_lcs_for_cotrendy.py'),
+                os.path.abspath(config_file), '--full'], root
+    if stage == 'diagnostics':
+        return [sys.executable, os.path.join(REPO_DIR, 'diagnostics',
+                                             'plot_random_cotrended_sample_from_dir.py'),
+                '--aperture', aperture], root
+    return [sys.executable, os.path.abspath(__file__), os.path.abspath(config_file),
+            '--run_stage', stage, '--aperture', aperture, '--timing_file', timing_file] + \
+        (['--pipeline'] if pipeline else []), root
+
+def profile_stage(stage, config_file, aperture, log_file, pipeline=False):
+    """
+    Run one stage in a child process and measure it
+
+    Returns
+    -------
+    result : dict
+        Wall and CPU time in seconds, peak RSS in MB and the exit code.
+        The CPU time and peak RSS include any workers of the stage
+    """
+    timing_file = f"{log_file}.timing.json"
+    command, cwd = stage_command(stage, config_file, aperture, timing_file, pipeline=pipeline)
+    with open(log_file, 'w') as log:
+        wall0 = time.perf_counter()
+        process = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 gives the rusage of this one child, unlike RUSAGE_CHILDREN
+        _, status, rusage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - wall0
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    result = {'wall_time': wall,
+              'process_wall_time': wall,
+              'cpu_time': rusage.ru_utime + rusage.ru_stime,
+              'peak_rss_mb': rusage.ru_maxrss / 1024.,
+              'returncode': process.returncode}
+    # the kernel stages time themselves, leaving out the imports
+    if os.path.exists(timing_file):
+        with open(timing_file, 'r') as tf:
+            timing = json.load(tf)
+        os.remove(timing_file)
+        result['wall_time'] = timing['kernel_wall_time']
+        result['kernel_cpu_time'] = timing['kernel_cpu_time']
+        result['info'] = timing['info']
+    return result
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Compare each stage against a baseline run
+
+    Returns
+    -------
+    regressions : list
+        (stage, metric, baseline value, new value) for every stage whose
+        wall time or peak RSS grew by more than the tolerance
+    """
+    regressions = []
+    print(f"{'stage':<12} {'wall (s)':>10} {'baseline':>10} {'ratio':>7} "
+          f"{'RSS (MB)':>10} {'baseline':>10} {'ratio':>7}")
+    for stage, result in results['stages'].items():
+        base = baseline['stages'].get(stage)
+        if base is None or result['returncode'] != 0 or base['returncode'] != 0:
+            print(f"{stage:<12} {result['wall_time']:>10.2f} {'-':>10} {'-':>7} "
+                  f"{result['peak_rss_mb']:>10.1f} {'-':>10} {'-':>7}")
+            continue
+        if result.get('info', {}).get('stand_in') != base.get('info', {}).get('stand_in'):
+            print(f"Warning: {stage} is a stand-in in only one of the runs")
+        wall_ratio = result['wall_time'] / max(base['wall_time'], 1e-9)
+        rss_ratio = result['peak_rss_mb'] / max(base['peak_rss_mb'], 1e-9)
+        print(f"{stage:<12} {result['wall_time']:>10.2f} {base['wall_time']:>10.2f} "
+              f"{wall_ratio:>7.2f} {result['peak_rss_mb']:>10.1f} "
+              f"{base['peak_rss_mb']:>10.1f} {rss_ratio:>7.2f}")
+        if wall_ratio > 1 + tolerance:
+            regressions.append((stage, 'wall_time', base['wall_time'], result['wall_time']))
+        if rss_ratio > 1 + tolerance:
+            regressions.append((stage, 'peak_rss_mb', base['peak_rss_mb'], result['peak_rss_mb']))
+    if results.get('pipeline') != baseline.get('pipeline'):
+        print("Warning: only one of the runs timed the real pipeline, "
+              "the other timed the stand-ins")
+    if results['shape'] != baseline.get('shape'):
+        print(f"Warning: baseline data set shape {baseline.get('shape')} differs "
+              f"from {results['shape']}")
+    return regressions
+
+if __name__ == "__main__":
+    args = arg_parse()
+
+    # a single kernel stage, run by the harness in a child process
+    if args.run_stage:
+        run_kernel(args.config, args.run_stage, args.aperture, args.timing_file,
+                   pipeline=args.pipeline)
+        sys.exit(0)
+
+    config = cuts.load_config(args.config)
+    root = config['global']['root']
+    aperture = args.aperture or config_apertures(config)[0]
+    log_dir = os.path.join(root, 'benchmark_logs')
+    os.makedirs(log_dir, exist_ok=True)
+
+    # time the real pipeline if we can, otherwise the stand-ins
+    pipeline, reason = None, "--stand_ins was given"
+    if not args.stand_ins:
+        pipeline, reason = import_pipeline()
+    pipeline = pipeline is not None
+    if pipeline:
+        print("Timing the real pipeline with cotrendy")
+        all_stages = PIPELINE_STAGES
+    else:
+        print(f"Not timing the real pipeline, {reason}. The cotrending stages "
+              "are STAND-INS for cotrendy's, and only a guide to its timings")
+        all_stages = KERNEL_STAGES
+    skipped = [s for s in args.stages or [] if s not in all_stages]
+    if skipped:
+        print(f"Skipping stages {skipped}, they are not run when "
+              f"{'timing the pipeline' if pipeline else 'using the stand-ins'}")
+
+    stages = {}
+    for stage in [s for s in all_stages if s in (args.stages or all_stages)]:
+        print(f"Running stage {stage}...")
+        stages[stage] = profile_stage(stage, args.config, aperture,
+                                      os.path.join(log_dir, f"{stage}.log"),
+                                      pipeline=pipeline)
+        print(f"  {stages[stage]['wall_time']:.2f} s wall, {stages[stage]['cpu_time']:.2f} s CPU, "
+              f"{stages[stage]['peak_rss_mb']:.1f} MB peak RSS")
+        info = stages[stage].get('info', {})
+        for substage, wall in info.get('substages', {}).items():
+            print(f"    {substage:<24} {wall:>8.2f} s wall")
+        if info.get('stand_in'):
+            print(f"  STAND-IN: {info['engine']}, not what the pipeline runs")
+        if stages[stage]['returncode'] != 0:
+            print(f"Stage {stage} failed, see {log_dir}/{stage}.log. Stopping")
+            break
+
+    try:
+        shape = list(LightcurveStore(os.path.join(root, store_dirname(config)))[f"flux_{aperture}"].shape)
+    except (FileNotFoundError, KeyError):
+        shape = None
+    results = {'date': datetime.now(timezone.utc).isoformat(),
+               'host': platform.node(),
+               'cpu_count': os.cpu_count(),
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'config': os.path.abspath(args.config),
+               'aperture': aperture,
+               'shape': shape,
+               'pipeline': pipeline,
+               'stages': stages}
+
+    results_file = args.results or os.path.join(root, 'benchmark_results.json')
+    for filename in filter(None, (results_file, args.save_baseline)):
+        with open(filename, 'w') as rf:
+            json.dump(results, rf, indent=2)
+    print(f"Results saved to {results_file}")
+
+    n_failed = sum(result['returncode'] != 0 for result in stages.values())
+    if args.baseline:
+        with open(args.baseline, 'r') as bf:
+            baseline = json.load(bf)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        for stage, metric, old, new in regressions:
+            print(f"Regression in {stage}: {metric} {old:.2f} -> {new:.2f}")
+        n_failed += len(regressions)
+    sys.exit(1 if n_failed else 0)
@@ -0,0 +1,347 @@
+"""
+Write a synthetic TESS FFI data set for benchmarking
+
+Makes a directory that looks like one sector/camera/chip of the FFI
+extraction: TIC-<id>.fits light curves with BJD, SKY_MEDIAN and
+aperture columns, a cadence mask FITS and a master catalog FITS,
+plus a config file pointing at them, so every stage can be run
+without access to /tess/photometry
+
+Each light curve is a star whose flux scales with Tmag, multiplied
+by a set of common mode systematics (thermal settling after each
+orbit gap, scattered light ramps, pointing jitter and slow drifts).
+The systematics coefficients vary smoothly over the field, with some
+scatter, so the MAP priors have something to work with. A fraction of
+the stars also get sinusoidal variability or transits. Sky, with the
+scattered light, is added through the apertures and photon noise is
+added last
+"""
+import os
+import argparse as ap
+import numpy as np
+from astropy.io import fits
+
+# pylint: disable=invalid-name
+
+# 30 minute FFI cadence, in days
+CADENCE = 30. / 60. / 24.
+# electrons/s for a Tmag = 10 star in the largest aperture
+FLUX_TMAG_10 = 15000.
+# effective exposure of each FFI cadence in seconds, the fluxes are in electrons
+EXPOSURE = 1425.6
+# PSF width in pixels, for the fraction of flux in each aperture
+PSF_SIGMA = 1.0
+
+def arg_parse():
+    """
+    Parse the command line arguments
+    """
+    p = ap.ArgumentParser(description='Write a synthetic TESS FFI data set')
+    p.add_argument('output_dir',
+                   help='directory to write the data set into')
+    p.add_argument('--n_stars',
+                   help='number of light curves',
+                   type=int,
+                   default=2000)
+    p.add_argument('--n_cadences',
+                   help='number of cadences, split over two orbits',
+                   type=int,
+                   default=1300)
+    p.add_argument('--apertures',
+                   help='aperture columns to write',
+                   nargs='+',
+                   default=['AP2.5'])
+    p.add_argument('--n_systematics',
+                   help='number of common mode systematics',
+                   type=int,
+                   default=4)
+    p.add_argument('--variable_fraction',
+                   help='fraction of stars with sinusoidal variability',
+                   type=float,
+                   default=0.2)
+    p.add_argument('--transit_fraction',
+                   help='fraction of stars with transits',
+                   type=float,
+                   default=0.02)
+    p.add_argument('--missing_fraction',
+                   help='fraction of catalog objects without a light curve file',
+                   type=float,
+                   default=0.05)
+    p.add_argument('--sector_id',
+                   help='sector ID used in the file names',
+                   default='S05')
+    p.add_argument('--camera_id',
+                   help='camera ID used in the file names',
+                   default='1')
+    p.add_argument('--chip_id',
+                   help='chip ID used in the file names',
+                   default='1')
+    p.add_argument('--cbv_mode',
+                   help='CBV fitting mode written to the config, MAP | LS',
+                   choices=['MAP', 'LS'],
+                   default='LS')
+    p.add_argument('--pool_size',
+                   help='pool sizes written to the config',
+                   type=int,
+                   default=1)
+    p.add_argument('--seed',
+                   help='random seed',
+                   type=int,
+                   default=42)
+    return p.parse_args()
+
+def make_times(n_cadences, bjd0=2458437.0):
+    """
+    BJD of each cadence, two orbits with a one day gap for the downlink
+
+    Returns
+    -------
+    times : array-like
+        BJD of each cadence
+    orbit_start : array-like
+        Index of the first cadence of each orbit
+    """
+    half = n_cadences // 2
+    times = bjd0 + np.arange(n_cadences) * CADENCE
+    times[half:] += 1.0
+    return times, np.array([0, half])
+
+def make_mask(times, orbit_start, rng, dump_every=3.125, edge_days=0.5, flag_fraction=0.01):
+    """
+    Cadence mask, excluding the thermal settling at the start of each
+    orbit, the momentum dumps and a few randomly flagged cadences
+    """
+    mask = np.ones(len(times), dtype=bool)
+    for start in orbit_start:
+        mask &= ~((times >= times[start]) & (times < times[start] + edge_days))
+    dumps = np.abs(((times - times[0]) % dump_every)) < CADENCE
+    mask &= ~dumps
+    mask &= rng.random(len(times)) >= flag_fraction
+    return mask
+
+def make_systematics(times, orbit_start, n_systematics, rng):
+    """
+    Common mode systematics, (n_systematics, n_cadences), each with
+    unit standard deviation. They are, in turn, thermal settling after
+    each orbit gap, scattered light ramps towards the end of each orbit,
+    high frequency pointing jitter and a slow drift, repeating with
+    new random parameters if more are asked for
+    """
+    n_cadences = len(times)
+    orbit = np.searchsorted(orbit_start, np.arange(n_cadences), side='right') - 1
+    since_start = times - times[orbit_start][orbit]
+    orbit_length = np.array([np.ptp(times[orbit == o]) for o in range(len(orbit_start))])
+    phase = since_start / orbit_length[orbit]
+
+    systematics = np.empty((n_systematics, n_cadences))
+    for i in range(n_systematics):
+        kind = i % 4
+        if kind == 0:
+            s = np.exp(-since_start / rng.uniform(0.5, 2.0))
+        elif kind == 1:
+            s = np.clip(phase - rng.uniform(0.6, 0.8), 0, None)**2
+        elif kind == 2:
+            s = np.convolve(rng.normal(size=n_cadences), np.ones(5) / 5, mode='same')
+        else:
+            s = np.sin(2 * np.pi * (times - times[0]) / rng.uniform(10, 40) + rng.uniform(0, 2 * np.pi))
+        s = s - np.mean(s)
+        systematics[i] = s / np.std(s)
+    return systematics
+
+def make_catalog(n_stars, rng, ra0=90., dec0=-66., width=12.):
+    """
+    Catalog of random stars in a field, with Tmag drawn from a roughly
+    exponential distribution so there are many more faint stars
+
+    Returns
+    -------
+    catalog : dict
+        TIC_ID, RA, DEC and Tmag columns
+    """
+    tic_ids = rng.choice(np.arange(1000000, 500000000), size=n_stars, replace=False)
+    ras = ra0 + rng.uniform(-width / 2, width / 2, n_stars) / np.cos(np.radians(dec0))
+    decs = dec0 + rng.uniform(-width / 2, width / 2, n_stars)
+    mags = np.clip(16.5 - rng.exponential(2.0, n_stars), 6.5, 16.5)
+    return {'TIC_ID': np.sort(tic_ids).astype(np.int64),
+            'RA': ras,
+            'DEC': decs,
+            'Tmag': mags}
+
+def systematics_coeffs(catalog, n_systematics, rng, scatter=0.3):
+    """
+    Fractional amplitude of each systematic for each star, (n_stars,
+    n_systematics). Each varies linearly over the field, plus some
+    scatter, so nearby stars have similar coefficients
+    """
+    x = (catalog['RA'] - np.mean(catalog['RA'])) / np.ptp(catalog['RA'])
+    y = (catalog['DEC'] - np.mean(catalog['DEC'])) / np.ptp(catalog['DEC'])
+    scale = rng.uniform(0.001, 0.005, n_systematics)
+    gradient = rng.normal(size=(2, n_systematics))
+    smooth = 1 + x[:, None] * gradient[0] + y[:, None] * gradient[1]
+    noise = rng.normal(scale=scatter, size=smooth.shape)
+    return scale * (smooth + noise)
+
+def stellar_signal(times, n_stars, variable_fraction, transit_fraction, rng):
+    """
+    Fractional stellar variability of each star, (n_stars, n_cadences),
+    sinusoids for the variables and box shaped dips for the transits
+    """
+    signal = np.zeros((n_stars, len(times)))
+    t = times - times[0]
+    variables = np.where(rng.random(n_stars) < variable_fraction)[0]
+    periods = 10**rng.uniform(-1, 1.3, len(variables))
+    amplitudes = 10**rng.uniform(-3, -1.3, len(variables))
+    phases = rng.uniform(0, 2 * np.pi, len(variables))
+    signal[variables] = amplitudes[:, None] * np.sin(2 * np.pi * t / periods[:, None] +
+                                                     phases[:, None])
+    for i in np.where(rng.random(n_stars) < transit_fraction)[0]:
+        period = rng.uniform(1, 10)
+        duration = rng.uniform(0.05, 0.2)
+        in_transit = ((t - rng.uniform(0, period)) % period) < duration
+        signal[i, in_transit] -= rng.uniform(0.001, 0.02)
+    return signal
+
+def aperture_fraction(aperture):
+    """
+    Fraction of a star's flux falling in a circular aperture
+    """
+    radius = float(aperture[2:])
+    return 1 - np.exp(-radius**2 / (2 * PSF_SIGMA**2))
+
+def write_tic_file(filename, times, star_flux, sky_median, apertures, rng):
+    """
+    Write one TIC light curve file, each aperture holding the star's flux
+    in the aperture plus the sky over its area, with photon noise
+    """
+    columns = [fits.Column(name='BJD', format='D', array=times),
+               fits.Column(name='SKY_MEDIAN', format='D', array=sky_median)]
+    for aperture in apertures:
+        sky = sky_median * np.pi * float(aperture[2:])**2
+        flux = star_flux * aperture_fraction(aperture) + sky
+        flux = flux + rng.normal(size=len(flux)) * np.sqrt(np.abs(flux))
+        columns.append(fits.Column(name=aperture, format='D', array=flux))
+    fits.BinTableHDU.from_columns(columns).writeto(filename, overwrite=True)
+
+def config_text(args, output_dir, mask_file, cat_file):
+    """
+    A config file for the synthetic data, with the same options as
+    write_cotrendy_config_file.py but everything kept in output_dir
+    """
+    ccd = f"{args.sector_id}_{args.camera_id}-{args.chip_id}"
+    apertures = ", ".join(f'"{aperture}"' for aperture in args.apertures)
+    return f"""# Synthetic TESS data set for Sector {args.sector_id}
+[owner]
+name = "benchmark"
+version = "0.0.1"
+
+[global]
+debug = false
+root = "{output_dir}"
+timeslot = "{args.sector_id}"
+camera_id = "{args.camera_id}-{args.chip_id}"
+
+[data]
+time_file = "tess_{ccd}_times.pkl"
+flux_file = "tess_{ccd}_fluxes.pkl"
+error_file = "tess_{ccd}_errors.pkl"
+cadence_mask_file = "{mask_file}"
+cbv_file = "tess_{ccd}_cbvs.pkl"
+cbv_product_file = "tess_{ccd}_cbvs.fits"
+checkpoint_dir = "tess_{ccd}_checkpoints"
+pickle_cbvs_object = true
+objects_mask_file = "tess_{ccd}_objects_mask.pkl"
+store_dir = "tess_{ccd}_store"
+apertures = [{apertures}]
+reject_outliers = false
+ingest_pool_size = {args.pool_size}
+ingest_chunksize = 64
+ingest_pool_type = "process"
+output_mode = "tic"
+ccd_product_file = "tess_{ccd}_cotrended.h5"
+ccd_product_compression = "gzip"
+write_pool_size = {args.pool_size}
+cbv_cache = false
+precision = "float64"
+
+[catalog]
+master_cat_file = "{cat_file}"
+coords_units = "deg"
+input_cat_file = "tess_{ccd}_cat.pkl"
+dim_weights = [1, 1, 2]
+
+[cotrend]
+pool_size = {args.pool_size}
+max_n_cbvs = 8
+cbv_snr_limit = 5
+cbv_mode = "{args.cbv_mode}"
+ls_engine = "batched"
+ls_chunk_rows = 4096
+streaming = false
+stream_chunk_rows = 2048
+svd_mode = "randomised"
+svd_oversample = 10
+svd_power_iters = 2
+svd_report = false
+robust_engine = "batched"
+robust_block_rows = 256
+robust_pool_size = {args.pool_size}
+map_engine = "kde"
+prior_n_neighbours = 40
+map_n_theta = 500
+map_theta_mode = "adaptive"
+map_chunk_stars = 64
+normalised_variability_limit = 1.3
+prior_normalised_variability_limit = 0.85
+test_stars = [10]
+"""
+
+if __name__ == "__main__":
+    args = arg_parse()
+    rng = np.random.default_rng(args.seed)
+    output_dir = os.path.abspath(args.output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    ccd = f"{args.sector_id}_{args.camera_id}-{args.chip_id}"
+
+    times, orbit_start = make_times(args.n_cadences)
+    mask = make_mask(times, orbit_start, rng)
+    systematics = make_systematics(times, orbit_start, args.n_systematics, rng)
+
+    # the catalog has a few objects with no light curve, as in the real data
+    n_catalog = int(round(args.n_stars / (1 - args.missing_fraction)))
+    catalog = make_catalog(n_catalog, rng)
+    has_lc = np.zeros(n_catalog, dtype=bool)
+    has_lc[rng.choice(n_catalog, size=args.n_stars, replace=False)] = True
+
+    # the sky is a common background plus the scattered light ramps
+    sky_level = rng.uniform(50, 150, n_catalog) * EXPOSURE
+    scattered = np.clip(systematics[1 % args.n_systematics], 0, None)
+
+    coeffs = systematics_coeffs(catalog, args.n_systematics, rng)
+    signal = stellar_signal(times, n_catalog, args.variable_fraction,
+                            args.transit_fraction, rng)
+    base_flux = FLUX_TMAG_10 * EXPOSURE * 10**(-0.4 * (catalog['Tmag'] - 10))
+
+    for i in np.where(has_lc)[0]:
+        star_flux = base_flux[i] * (1 + coeffs[i] @ systematics + signal[i])
+        sky_median = sky_level[i] * (1 + 0.5 * scattered)
+        write_tic_file(os.path.join(output_dir, f"TIC-{catalog['TIC_ID'][i]}.fits"),
+                       times, star_flux, sky_median, args.apertures, rng)
+
+    mask_file = os.path.join(output_dir, f"{ccd}_mask.fits")
+    fits.BinTableHDU.from_columns([fits.Column(name='MASK', format='L', array=mask)]
+                                  ).writeto(mask_file, overwrite=True)
+
+    cat_file = os.path.join(output_dir, f"{ccd}_catalog.fits")
+    fits.BinTableHDU.from_columns([fits.Column(name='TIC_ID', format='K', array=catalog['TIC_ID']),
+                                   fits.Column(name='RA', format='D', array=catalog['RA']),
+                                   fits.Column(name='DEC', format='D', array=catalog['DEC']),
+                                   fits.Column(name='Tmag', format='D', array=catalog['Tmag'])]
+                                  ).writeto(cat_file, overwrite=True)
+
+    config_file = os.path.join(output_dir, f"config_{ccd}.toml")
+    with open(config_file, 'w') as of:
+        of.write(config_text(args, output_dir, mask_file, cat_file))
+
+    print(f"Wrote {args.n_stars} light curves of {args.n_cadences} cadences "
+          f"({int(np.sum(mask))} unmasked) to {output_dir}")
+    print(f"Config file: {config_file}")
@@ -0,0 +1,214 @@
+"""
+Content-addressed cache of CBV products
+
+The CBVs only depend on the CBV star fluxes, the times, the object
+mask and a handful of options, so the cache key is a hash of exactly
+those. Changing any of them (e.g. max_n_cbvs, cbv_snr_limit,
+reject_outliers, the CBV magnitude window through the object mask,
+or the light curves) gives a new key, while changing only the fitting options (e.g. cbv_mode)
+finds the cached CBVs and skips the SVD and the CBV star fits
+
+Each entry is a directory named after its key, holding the CBV
+product and a provenance.json recording what went into the key.
+The least recently used entries are evicted to bound the disk use
+"""
+import os
+import json
+import shutil
+import hashlib
+from datetime import datetime, timezone
+from lc_store import array_digest, config_precision
+from cbv_product import CBVProduct, CBV_PRODUCT_VERSION
+
+# pylint: disable=invalid-name
+
+PRODUCT_FILE = "cbvs.fits"
+PROVENANCE_FILE = "provenance.json"
+
+# the [data] options that change the CBV star light curves cotrendy
+# loads, with their defaults. The normalisation itself, by each star's
+# median, has no options
+CBV_DATA_OPTIONS = {'reject_outliers': False}
+
+# the [cotrend] options the CBVs depend on, with their defaults
+CBV_OPTIONS = {'max_n_cbvs': None,
+               'cbv_snr_limit': None,
+               'normalised_variability_limit': None,
+               'svd_mode': "cotrendy",
+               'svd_oversample': 10,
+               'svd_power_iters': 2}
+
+def cbv_cache_key(config, store, aperture):
+    """
+    Cache key for the CBVs of one aperture
+
+    Parameters
+    ----------
+    config : dict
+        Cotrendy configuration for the aperture
+    store : LightcurveStore
+        Light curve store from the prepare step
+    aperture : str
+        Aperture column, e.g. AP2.5
+
+    Returns
+    -------
+    key : str
+        SHA1 of everything the CBVs depend on
+    inputs : dict
+        What went into the key, for the provenance
+    """
+    objects_mask = store['objects_mask']
+    cbv_rows = store.rows(f"flux_{aperture}", objects_mask)
+    inputs = {'cbv_product_version': CBV_PRODUCT_VERSION,
+              'aperture': aperture,
+              'precision': config_precision(config).name,
+              'times_sha1': array_digest(store['times']),
+              'objects_mask_sha1': array_digest(objects_mask),
+              'cbv_star_flux_sha1': array_digest(cbv_rows),
+              'n_cbv_stars': int(len(cbv_rows)),
+              'data_options': {option: config['data'].get(option, default)
+                               for option, default in CBV_DATA_OPTIONS.items()},
+              'options': {option: config['cotrend'].get(option, default)
+                          for option, default in CBV_OPTIONS.items()}}
+    key = hashlib.sha1(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+    return key, inputs
+
+class CBVCache():
+    """
+    A directory of CBV products keyed by cbv_cache_key
+    """
+    def __init__(self, directory, max_bytes=None, max_entries=None):
+        """
+        Initialise the class
+
+        Parameters
+        ----------
+        directory : str
+            Path to the cache directory
+        max_bytes : int | None
+            Evict entries once the cache is bigger than this
+        max_entries : int | None
+            Evict entries once there are more than this
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        """
+        Directory of a cache entry
+        """
+        return os.path.join(self.directory, key)
+
+    def _read_provenance(self, key):
+        with open(os.path.join(self.path(key), PROVENANCE_FILE), 'r') as pf:
+            return json.load(pf)
+
+    def _write_provenance(self, key, provenance):
+        provenance_file = os.path.join(self.path(key), PROVENANCE_FILE)
+        tmp_file = f"{provenance_file}.tmp"
+        with open(tmp_file, 'w') as pf:
+            json.dump(provenance, pf, indent=2)
+        os.replace(tmp_file, provenance_file)
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self.path(key), PRODUCT_FILE))
+
+    def get(self, key):
+        """
+        Load the CBV product for a key, marking the entry as used
+
+        Returns
+        -------
+        product : CBVProduct | None
+            The cached product, None on a miss
+        """
+        product_file = os.path.join(self.path(key), PRODUCT_FILE)
+        if not os.path.exists(product_file):
+            return None
+        try:
+            product = CBVProduct.read(product_file)
+            provenance = self._read_provenance(key)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable CBV cache entry {key}: {e}")
+            return None
+        provenance['last_used'] = datetime.now(timezone.utc).isoformat()
+        provenance['n_hits'] = provenance.get('n_hits', 0) + 1
+        self._write_provenance(key, provenance)
+        return product
+
+    def put(self, key, product, inputs, info=None):
+        """
+        Add a CBV product to the cache, then evict old entries
+
+        Parameters
+        ----------
+        key : str
+            Cache key, see cbv_cache_key
+        product : CBVProduct
+            The CBVs to cache
+        inputs : dict
+            What went into the key
+        info : dict
+            Any other provenance, e.g. the config file and host
+        """
+        # build the entry alongside and rename it into place
+        tmp_dir = f"{self.path(key)}.tmp{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        product.write(os.path.join(tmp_dir, PRODUCT_FILE))
+        now = datetime.now(timezone.utc).isoformat()
+        with open(os.path.join(tmp_dir, PROVENANCE_FILE), 'w') as pf:
+            json.dump(dict(info or {}, key=key, inputs=inputs, created=now,
+                           last_used=now, n_hits=0), pf, indent=2)
+        shutil.rmtree(self.path(key), ignore_errors=True)
+        os.replace(tmp_dir, self.path(key))
+        self.evict()
+
+    def entries(self):
+        """
+        Provenance and size of each entry, least recently used first
+        """
+        entries = []
+        for key in os.listdir(self.directory):
+            if not os.path.isfile(os.path.join(self.path(key), PROVENANCE_FILE)):
+                continue
+            provenance = self._read_provenance(key)
+            provenance['bytes'] = sum(entry.stat().st_size for entry in os.scandir(self.path(key)))
+            entries.append(provenance)
+        return sorted(entries, key=lambda entry: entry['last_used'])
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache
+        is within max_bytes and max_entries
+
+        Returns
+        -------
+        evicted : list
+            Keys of the removed entries
+        """
+        entries = self.entries()
+        total = sum(entry['bytes'] for entry in entries)
+        evicted = []
+        while entries and ((self.max_bytes is not None and total > self.max_bytes) or
+                           (self.max_entries is not None and len(entries) > self.max_entries)):
+            entry = entries.pop(0)
+            shutil.rmtree(self.path(entry['key']), ignore_errors=True)
+            total -= entry['bytes']
+            evicted.append(entry['key'])
+        return evicted
+
+def config_cbv_cache(config):
+    """
+    The CBV cache named in a config, None if it is turned off
+    """
+    data = config['data']
+    if not data.get('cbv_cache', True):
+        return None
+    max_gb = data.get('cbv_cache_max_gb', 5)
+    return CBVCache(data.get('cbv_cache_dir', "cbv_cache"),
+                    max_bytes=int(max_gb * 1024**3) if max_gb is not None else None,
+                    max_entries=data.get('cbv_cache_max_entries', 50))
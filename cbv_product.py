@@ -0,0 +1,190 @@
+"""
+Slim, standalone CBV product
+
+Rather than pickling the whole CBVs object (flux arrays, SVD
+matrices, fit coefficients etc) we keep just what is needed to
+cotrend with the CBVs in a small FITS file, similar in spirit to
+the SPOC *_cbv.fits products. It holds the basis vectors, their
+SNRs, the CBV star mask, the singular values and some provenance
+"""
+import os
+from datetime import datetime, timezone
+import numpy as np
+from astropy.io import fits
+
+# pylint: disable=invalid-name
+
+CBV_PRODUCT_VERSION = 1
+
+def cbv_product_filename(config):
+    """
+    Name of the CBV product file for a config, by
+    default the cbv_file with a .fits extension
+
+    Parameters
+    ----------
+    config : dict
+        Cotrendy configuration
+
+    Returns
+    -------
+    cbv_product_file : str
+        Name of the CBV product file
+    """
+    default = f"{os.path.splitext(config['data']['cbv_file'])[0]}.fits"
+    return config['data'].get('cbv_product_file', default)
+
+class CBVProduct():
+    """
+    The CBVs and the bits needed to use them, without any
+    of the per-star arrays from the CBVs object
+    """
+    def __init__(self, cbvs, vect_store, cbvs_snr, cbv_mask, s, meta=None):
+        """
+        Initialise the class
+
+        Parameters
+        ----------
+        cbvs : dict
+            CBV id -> basis vector
+        vect_store : array-like
+            Basis vectors, (n_cbvs, n_cadences)
+        cbvs_snr : array-like | dict
+            SNR of each basis vector
+        cbv_mask : array-like
+            Mask of the stars used to make the CBVs
+        s : array-like
+            Singular values
+        meta : dict
+            Provenance information, stored in the primary header
+        """
+        self.cbvs = cbvs
+        self.vect_store = np.asarray(vect_store)
+        self.cbvs_snr = cbvs_snr
+        self.cbv_mask = cbv_mask
+        self.s = s
+        self.n_cbvs = len(self.vect_store)
+        self.meta = meta if meta is not None else {}
+
+    @classmethod
+    def from_cbvs(cls, cbvs, config, aperture):
+        """
+        Pull the CBV product out of a CBVs object
+
+        Parameters
+        ----------
+        cbvs : cotrendy.cbvs.CBVs
+            CBVs object after calculate_cbvs has been run
+        config : dict
+            Cotrendy configuration
+        aperture : str
+            Aperture column the CBVs were made for, e.g. AP2.5
+
+        Returns
+        -------
+        product : CBVProduct
+            The slim CBV product
+        """
+        meta = {'VERSION': CBV_PRODUCT_VERSION,
+                'SECTOR': config['global']['timeslot'],
+                'CAMERA': config['global']['camera_id'],
+                'APERTURE': aperture,
+                'DATE': datetime.now(timezone.utc).isoformat(),
+                'NSTARS': len(cbvs.norm_flux_array),
+                'MAXNCBVS': config['cotrend']['max_n_cbvs'],
+                'SNRLIMIT': config['cotrend']['cbv_snr_limit'],
+                'VARLIMIT': config['cotrend']['normalised_variability_limit'],
+                'FLUXFILE': config['data']['flux_file']}
+        return cls(cbvs.cbvs, cbvs.vect_store, cbvs.cbvs_snr,
+                   cbvs.cbv_mask, cbvs.s, meta)
+
+    def apply_to(self, cbvs):
+        """
+        Set the CBVs on a CBVs object, ready for fitting. The
+        left and right singular vectors are not kept in the
+        product, so U and VT are left as None
+
+        Parameters
+        ----------
+        cbvs : cotrendy.cbvs.CBVs
+            CBVs object to update
+        """
+        cbvs.U = None
+        cbvs.VT = None
+        cbvs.s = self.s
+        cbvs.cbv_mask = self.cbv_mask
+        cbvs.cbvs_snr = self.cbvs_snr
+        cbvs.cbvs = self.cbvs
+        cbvs.vect_store = self.vect_store
+        cbvs.n_cbvs = self.n_cbvs
+
+    def write(self, filename):
+        """
+        Save the product to a FITS file
+
+        Parameters
+        ----------
+        filename : str
+            Name of the output FITS file
+        """
+        primary = fits.PrimaryHDU()
+        for key, value in self.meta.items():
+            primary.header[key] = value
+
+        cbv_ids = sorted(self.cbvs.keys())
+        snr_is_dict = isinstance(self.cbvs_snr, dict)
+        if snr_is_dict:
+            snr = np.array([self.cbvs_snr[cbv_id] for cbv_id in cbv_ids], dtype=np.float64)
+        else:
+            snr = np.asarray(self.cbvs_snr, dtype=np.float64)
+        primary.header['SNRDICT'] = snr_is_dict
+
+        vect_hdu = fits.ImageHDU(self.vect_store, name='VECT_STORE')
+        cbvs_hdu = fits.ImageHDU(np.array([self.cbvs[cbv_id] for cbv_id in cbv_ids]),
+                                 name='CBVS')
+        ids_hdu = fits.ImageHDU(np.array(cbv_ids, dtype=np.int64), name='CBV_IDS')
+        snr_hdu = fits.ImageHDU(snr, name='CBV_SNR')
+        s_hdu = fits.ImageHDU(np.asarray(self.s, dtype=np.float64), name='SINGULAR')
+
+        # FITS images can't be boolean, keep the original dtype in the header
+        cbv_mask = np.asarray(self.cbv_mask)
+        mask_hdu = fits.ImageHDU(cbv_mask.astype(np.int64), name='CBV_MASK')
+        mask_hdu.header['MASKTYPE'] = cbv_mask.dtype.str
+
+        hdul = fits.HDUList([primary, vect_hdu, cbvs_hdu, ids_hdu,
+                             snr_hdu, s_hdu, mask_hdu])
+        tmp_file = f"{filename}.tmp"
+        hdul.writeto(tmp_file, overwrite=True)
+        os.replace(tmp_file, filename)
+
+    @classmethod
+    def read(cls, filename):
+        """
+        Load a product from a FITS file
+
+        Parameters
+        ----------
+        filename : str
+            Name of the CBV product file
+
+        Returns
+        -------
+        product : CBVProduct
+            The slim CBV product
+        """
+        with fits.open(filename) as hdul:
+            header = hdul[0].header
+            if header.get('VERSION') != CBV_PRODUCT_VERSION:
+                raise ValueError(f"{filename} has CBV product version {header.get('VERSION')}, "
+                                 f"expected {CBV_PRODUCT_VERSION}")
+            meta = {key: header[key] for key in header
+                    if key not in ('SIMPLE', 'BITPIX', 'NAXIS', 'EXTEND', 'SNRDICT')}
+            vect_store = np.array(hdul['VECT_STORE'].data)
+            cbv_ids = [int(cbv_id) for cbv_id in hdul['CBV_IDS'].data]
+            cbvs = dict(zip(cbv_ids, np.array(hdul['CBVS'].data)))
+            snr = np.array(hdul['CBV_SNR'].data)
+            if header['SNRDICT']:
+                snr = dict(zip(cbv_ids, snr))
+            s = np.array(hdul['SINGULAR'].data)
+            cbv_mask = np.array(hdul['CBV_MASK'].data).astype(hdul['CBV_MASK'].header['MASKTYPE'])
+        return cls(cbvs, vect_store, snr, cbv_mask, s, meta)
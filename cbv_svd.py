@@ -0,0 +1,273 @@
+"""
+Truncated and randomised SVD for extracting the CBVs
+
+Only the leading max_n_cbvs components of the CBV star flux matrix
+are ever kept, so rather than a full SVD we can compute just those.
+The randomised SVD projects the flux matrix onto a random subspace
+a little larger than needed (oversampling), sharpens it with a few
+power iterations and does a small exact SVD in that subspace
+
+calculate_cbvs_svd runs cotrendy's own calculate_cbvs, with its
+variability cut and CBV selection, and only swaps the SVD it calls
+for truncated_svd. compare_svd checks the result against cotrendy's
+full SVD of the same stars
+
+select_cbvs is a stand-in for cotrendy's selection, used by the
+benchmark when cotrendy is not installed. It keeps the leading
+right singular vectors with an SNR above cbv_snr_limit, where the
+SNR of a unit vector v is
+
+    SNR = 10 log10(var(v) / (var(diff(v)) / 2))
+
+in dB, i.e. the variance of the vector over the variance of its
+point to point scatter
+"""
+import sys
+import contextlib
+import numpy as np
+import scipy.linalg
+from scipy.linalg import svd, subspace_angles
+
+# pylint: disable=invalid-name
+
+SVD_MODES = ("exact", "randomised")
+
+def randomised_svd(A, k, oversample=10, power_iters=2, seed=0):
+    """
+    Leading k components of the SVD of A
+
+    Parameters
+    ----------
+    A : array-like
+        Matrix to decompose, (n_rows, n_cols)
+    k : int
+        Number of components to keep
+    oversample : int
+        Extra random directions sampled beyond k
+    power_iters : int
+        Number of power iterations, each sharpens the decay of
+        the spectrum so the leading components are found better
+    seed : int
+        Seed for the random projection
+
+    Returns
+    -------
+    U : array-like
+        Left singular vectors, (n_rows, k)
+    s : array-like
+        Singular values, (k,)
+    VT : array-like
+        Right singular vectors, (k, n_cols)
+    """
+    A = np.asarray(A, dtype=np.float64)
+    n_sample = min(k + oversample, min(A.shape))
+    rng = np.random.default_rng(seed)
+
+    # orthonormal basis for the range of A, re-orthonormalising
+    # between power iterations to keep it numerically stable
+    Q, _ = np.linalg.qr(A @ rng.standard_normal((A.shape[1], n_sample)))
+    for _ in range(power_iters):
+        Q, _ = np.linalg.qr(A.T @ Q)
+        Q, _ = np.linalg.qr(A @ Q)
+
+    # small exact SVD in the sampled subspace
+    Ub, s, VT = svd(Q.T @ A, full_matrices=False)
+    U = Q @ Ub
+    return U[:, :k], s[:k], VT[:k]
+
+def truncated_svd(A, k, mode="randomised", oversample=10, power_iters=2, seed=0):
+    """
+    Leading k components of the SVD of A, exactly or randomised
+
+    Parameters
+    ----------
+    A : array-like
+        Matrix to decompose, (n_rows, n_cols)
+    k : int
+        Number of components to keep
+    mode : str
+        "exact" or "randomised"
+    oversample, power_iters, seed
+        Passed on to randomised_svd
+
+    Returns
+    -------
+    U, s, VT : array-like
+        Leading k components of the SVD
+    """
+    if mode == "exact":
+        U, s, VT = svd(np.asarray(A, dtype=np.float64), full_matrices=False)
+        return U[:, :k], s[:k], VT[:k]
+    if mode == "randomised":
+        return randomised_svd(A, k, oversample=oversample,
+                              power_iters=power_iters, seed=seed)
+    raise ValueError(f"Unknown svd_mode {mode}, expected one of {SVD_MODES}")
+
+def cbv_snr(vectors):
+    """
+    SNR in dB of each basis vector, see the module docstring
+
+    Parameters
+    ----------
+    vectors : array-like
+        Basis vectors, (n_vectors, n_cadences)
+
+    Returns
+    -------
+    snr : array-like
+        SNR of each vector in dB
+    """
+    vectors = np.atleast_2d(vectors)
+    signal = np.var(vectors, axis=1)
+    noise = np.var(np.diff(vectors, axis=1), axis=1) / 2.
+    noise = np.maximum(noise, np.finfo(float).tiny)
+    return 10. * np.log10(signal / noise)
+
+def select_cbvs(VT, max_n_cbvs, snr_limit):
+    """
+    Pick the CBVs from the leading right singular vectors
+
+    Parameters
+    ----------
+    VT : array-like
+        Right singular vectors, (n_components, n_cadences)
+    max_n_cbvs : int
+        Maximum number of CBVs to keep
+    snr_limit : float
+        Minimum SNR in dB
+
+    Returns
+    -------
+    cbvs : dict
+        CBV id -> basis vector, ids run from 0 with no gaps
+    snr : dict
+        CBV id -> SNR of each selected CBV
+    component_snr : list
+        SNR of every component considered, in component order
+    """
+    component_snr = [float(value) for value in cbv_snr(VT[:max_n_cbvs])]
+    components = [i for i, value in enumerate(component_snr) if value >= snr_limit]
+    cbvs = {cbv_id: VT[i] for cbv_id, i in enumerate(components)}
+    snr = {cbv_id: component_snr[i] for cbv_id, i in enumerate(components)}
+    return cbvs, snr, component_snr
+
+@contextlib.contextmanager
+def swapped_svd(k, modules=(), **kwargs):
+    """
+    Swap numpy's and scipy's svd, and any svd imported into the given
+    modules, for the leading k components from truncated_svd, for as
+    long as the context is open
+
+    Parameters
+    ----------
+    k : int
+        Number of components to keep
+    modules : list
+        Modules that may have imported svd by name, e.g. cotrendy.cbvs
+    kwargs : dict
+        Passed on to truncated_svd
+
+    Yields
+    ------
+    calls : list
+        Shape of each matrix decomposed through the swap
+    """
+    calls = []
+
+    def leading_svd(a, full_matrices=True, compute_uv=True, *args, **options):
+        # pylint: disable=unused-argument,keyword-arg-before-vararg
+        calls.append(np.shape(a))
+        U, s, VT = truncated_svd(a, k, **kwargs)
+        return (U, s, VT) if compute_uv else s
+
+    targets = [(np.linalg, 'svd'), (scipy.linalg, 'svd')]
+    targets += [(module, 'svd') for module in modules if hasattr(module, 'svd')]
+    originals = [(target, name, getattr(target, name)) for target, name in targets]
+    try:
+        for target, name, _ in originals:
+            setattr(target, name, leading_svd)
+        yield calls
+    finally:
+        for target, name, original in originals:
+            setattr(target, name, original)
+
+def calculate_cbvs_svd(cbvs, config):
+    """
+    Run cotrendy's CBVs.calculate_cbvs, with its own variability cut
+    and CBV selection, but with only the leading max_n_cbvs components
+    of the SVD computed, see svd_mode
+
+    Parameters
+    ----------
+    cbvs : cotrendy.cbvs.CBVs
+        CBVs object for the CBV stars
+    config : dict
+        Cotrendy configuration
+
+    Returns
+    -------
+    calls : list
+        Shape of each matrix decomposed by the truncated SVD, empty
+        if cotrendy's SVD could not be swapped and ran in full
+    """
+    cotrend = config['cotrend']
+    modules = [module for name, module in sys.modules.items()
+               if name.startswith('cotrendy') and module is not None]
+    with swapped_svd(cotrend['max_n_cbvs'], modules=modules,
+                     mode=cotrend.get('svd_mode', "randomised"),
+                     oversample=cotrend.get('svd_oversample', 10),
+                     power_iters=cotrend.get('svd_power_iters', 2)) as calls:
+        cbvs.calculate_cbvs()
+    if not calls:
+        print("cotrendy's SVD could not be swapped, its full SVD was used")
+    return calls
+
+def _snr_list(cbvs):
+    """
+    SNR of each CBV in id order, cotrendy keeps them as a dict or array
+    """
+    snr = cbvs.cbvs_snr
+    if isinstance(snr, dict):
+        return [float(snr[cbv_id]) for cbv_id in sorted(snr)]
+    return [float(value) for value in np.ravel(snr)]
+
+def compare_svd(reference, cbvs):
+    """
+    Compare the CBVs from calculate_cbvs_svd against cotrendy's own
+    full SVD of the same stars
+
+    Parameters
+    ----------
+    reference : cotrendy.cbvs.CBVs
+        CBVs object for the CBV stars after cotrendy's calculate_cbvs
+    cbvs : cotrendy.cbvs.CBVs
+        CBVs object for the same stars after calculate_cbvs_svd
+
+    Returns
+    -------
+    report : dict
+        Number of CBVs, singular values and SNRs from both, the
+        principal angles (degrees) between the two sets of CBVs and
+        the |cosine| between the CBVs with the same id
+    """
+    vect_ref = np.atleast_2d(np.asarray(reference.vect_store, dtype=np.float64))
+    vect = np.atleast_2d(np.asarray(cbvs.vect_store, dtype=np.float64))
+    vect_ref = vect_ref / np.linalg.norm(vect_ref, axis=1, keepdims=True)
+    vect = vect / np.linalg.norm(vect, axis=1, keepdims=True)
+    n_common = min(len(vect_ref), len(vect))
+
+    k = len(cbvs.s)
+    s_ref = np.asarray(reference.s, dtype=np.float64)[:k]
+    s = np.asarray(cbvs.s, dtype=np.float64)[:len(s_ref)]
+    angles = []
+    if n_common:
+        angles = np.degrees(subspace_angles(vect_ref.T, vect.T)).tolist()
+    return {'n_cbvs_cotrendy': len(vect_ref),
+            'n_cbvs': len(vect),
+            'singular_values_cotrendy': s_ref.tolist(),
+            'singular_values': s.tolist(),
+            'singular_value_rel_diff': (np.abs(s - s_ref) / s_ref).tolist(),
+            'snr_cotrendy': _snr_list(reference),
+            'snr': _snr_list(cbvs),
+            'abs_cosine': [float(abs(vect_ref[i] @ vect[i])) for i in range(n_common)],
+            'principal_angles_deg': angles}
@@ -0,0 +1,254 @@
+"""
+Consolidated per-CCD output product
+
+Rather than rewriting every TIC-<id>.fits file with the cotrended
+columns, the results for a whole sector/camera/CCD can be kept in a
+single chunked (and optionally compressed) HDF5 file. This holds the
+cotrended flux and CBV correction matrices for each aperture, the TIC
+ids, the cadence mask and the time axis. CCDProduct gives per-star
+rows by TIC id, and the per-star FITS files are only written when
+asked for, by running this module as a script
+
+This needs h5py, which is only imported when a product is used
+"""
+import os
+import argparse as ap
+from multiprocessing import Pool
+import numpy as np
+from tess_io import write_cotrended_columns
+
+# pylint: disable=invalid-name
+
+CCD_PRODUCT_VERSION = 1
+
+def _import_h5py():
+    """
+    Import h5py, which is only needed for the per-CCD product
+    """
+    try:
+        import h5py
+    except ImportError as e:
+        raise ImportError("The per-CCD output product needs h5py, "
+                          "install it or use output_mode = \"tic\"") from e
+    return h5py
+
+def ccd_product_filename(config):
+    """
+    Name of the per-CCD product file for a config
+    """
+    timeslot = config['global']['timeslot']
+    camera_id = config['global']['camera_id']
+    default = f"tess_{timeslot}_{camera_id}_cotrended.h5"
+    return config['data'].get('ccd_product_file', default)
+
+def write_ccd_product(filename, store, apertures, mask, compression=None,
+                      chunk_rows=256, meta=None):
+    """
+    Write the cotrended outputs kept in the light curve store
+    to a single per-CCD HDF5 product
+
+    Parameters
+    ----------
+    filename : str
+        Name of the output HDF5 file
+    store : LightcurveStore
+        Light curve store holding cor_<aperture> and cbv_<aperture>
+    apertures : list
+        Apertures to write, e.g. ['AP2.5']
+    mask : array-like
+        Boolean cadence mask
+    compression : str | None
+        HDF5 compression filter, e.g. 'gzip' or 'lzf', None for none
+    chunk_rows : int
+        Number of stars per HDF5 chunk, also the number of
+        rows copied from the store at a time
+    meta : dict
+        Provenance information, stored as file attributes
+    """
+    h5py = _import_h5py()
+    tic_ids = np.asarray(store['tic_ids'])
+    n_objects = len(tic_ids)
+
+    tmp_file = f"{filename}.tmp"
+    with h5py.File(tmp_file, 'w') as h5:
+        h5.attrs['version'] = CCD_PRODUCT_VERSION
+        for key, value in (meta or {}).items():
+            h5.attrs[key] = value
+        h5.create_dataset('tic_ids', data=tic_ids)
+        h5.create_dataset('cadence_mask', data=np.asarray(mask, dtype=bool))
+        times = h5.create_dataset('time', data=np.asarray(store['times']))
+        times.attrs['units'] = 'BJD - int(BJD[0]), masked cadences only'
+
+        for aperture in apertures:
+            group = h5.create_group(aperture)
+            for name, store_name in (('cotrended_flux', f"cor_{aperture}"),
+                                     ('cbv_correction', f"cbv_{aperture}")):
+                data = store[store_name]
+                dataset = group.create_dataset(name, shape=data.shape, dtype=data.dtype,
+                                               chunks=(min(chunk_rows, max(n_objects, 1)),
+                                                       data.shape[1]),
+                                               compression=compression)
+                for i in range(0, n_objects, chunk_rows):
+                    dataset[i:i+chunk_rows] = data[i:i+chunk_rows]
+    os.replace(tmp_file, filename)
+
+class CCDProduct():
+    """
+    Read per-star rows from a per-CCD product by TIC id
+    """
+    def __init__(self, filename):
+        """
+        Open a per-CCD product
+
+        Parameters
+        ----------
+        filename : str
+            Name of the HDF5 product
+        """
+        h5py = _import_h5py()
+        self.filename = filename
+        self.h5 = h5py.File(filename, 'r')
+        if self.h5.attrs.get('version') != CCD_PRODUCT_VERSION:
+            raise ValueError(f"{filename} has per-CCD product version "
+                             f"{self.h5.attrs.get('version')}, expected {CCD_PRODUCT_VERSION}")
+        self.tic_ids = np.array(self.h5['tic_ids'])
+        self.cadence_mask = np.array(self.h5['cadence_mask'])
+        self.time = np.array(self.h5['time'])
+        self.apertures = [name for name in self.h5.keys()
+                          if name not in ('tic_ids', 'cadence_mask', 'time')]
+        self._rows = {int(tic_id): i for i, tic_id in enumerate(self.tic_ids)}
+
+    def row(self, tic_id):
+        """
+        Row of a TIC id in the product matrices
+        """
+        try:
+            return self._rows[int(tic_id)]
+        except KeyError:
+            raise KeyError(f"TIC-{tic_id} is not in {self.filename}") from None
+
+    def lightcurve(self, tic_id, aperture='AP2.5', fill=True):
+        """
+        Get the cotrended flux and CBV correction for one star
+
+        Parameters
+        ----------
+        tic_id : int
+            TIC id of the star
+        aperture : str
+            Aperture column, e.g. AP2.5
+        fill : boolean
+            Expand to every cadence, with -99 for the masked ones, as
+            in the TIC files? Otherwise only the unmasked cadences
+
+        Returns
+        -------
+        cotrended_flux, cbv_correction : array-like
+            Cotrended flux and CBV correction for the star
+        """
+        i = self.row(tic_id)
+        cor = self.h5[aperture]['cotrended_flux'][i]
+        cbv = self.h5[aperture]['cbv_correction'][i]
+        if not fill:
+            return cor, cbv
+
+        output_lc = np.ones(len(self.cadence_mask)) * -99.0
+        output_cbv = np.ones(len(self.cadence_mask)) * -99.0
+        output_lc[self.cadence_mask] = cor
+        output_cbv[self.cadence_mask] = cbv
+        return output_lc, output_cbv
+
+    def close(self):
+        """
+        Close the underlying HDF5 file
+        """
+        self.h5.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# the product is opened once in each export worker
+_export_state = {}
+
+def _init_export(filename):
+    """
+    Open the per-CCD product in an export worker
+    """
+    _export_state['product'] = CCDProduct(filename)
+
+def _export_one(tic_id):
+    """
+    Write the COR/CBV columns for one star into its TIC file
+    """
+    product = _export_state['product']
+    try:
+        columns = {}
+        for aperture in product.apertures:
+            cor, cbv = product.lightcurve(tic_id, aperture, fill=False)
+            columns[f"COR_{aperture}"] = cor
+            columns[f"CBV_{aperture}"] = cbv
+        write_cotrended_columns(f"TIC-{tic_id}.fits", product.cadence_mask, columns)
+    except Exception as e:
+        return tic_id, f"{type(e).__name__}: {e}"
+    return tic_id, None
+
+def export_fits(filename, tic_ids=None, pool_size=1):
+    """
+    Write the per-star COR_/CBV_ columns from a per-CCD product
+    back into the TIC-<id>.fits files in the working directory
+
+    Parameters
+    ----------
+    filename : str
+        Name of the per-CCD product
+    tic_ids : list | None
+        TIC ids to export, None for all of them
+    pool_size : int
+        Number of workers, 1 writes the files serially
+
+    Returns
+    -------
+    failures : dict
+        TIC id -> error, for each file that could not be updated
+    """
+    if tic_ids is None:
+        with CCDProduct(filename) as product:
+            tic_ids = [int(tic_id) for tic_id in product.tic_ids]
+
+    if pool_size <= 1:
+        _init_export(filename)
+        failures = dict(result for result in map(_export_one, tic_ids) if result[1] is not None)
+    else:
+        with Pool(pool_size, initializer=_init_export, initargs=(filename,)) as pool:
+            results = pool.imap_unordered(_export_one, tic_ids, chunksize=16)
+            failures = dict(result for result in results if result[1] is not None)
+
+    for tic_id, error in failures.items():
+        print(f"Failed to update TIC-{tic_id}.fits: {error}")
+    return failures
+
+def arg_parse():
+    """
+    Parse the command line arguments
+    """
+    p = ap.ArgumentParser(description='Export a per-CCD product to the TIC files')
+    p.add_argument('ccd_product_file',
+                   help='path to the per-CCD product')
+    p.add_argument('--tic_ids',
+                   help='only export these TIC ids',
+                   type=int,
+                   nargs='+')
+    p.add_argument('--pool_size',
+                   help='number of workers writing the TIC files',
+                   type=int,
+                   default=1)
+    return p.parse_args()
+
+if __name__ == "__main__":
+    args = arg_parse()
+    failed = export_fits(args.ccd_product_file, tic_ids=args.tic_ids,
+                         pool_size=args.pool_size)
+    print(f"Export finished, {len(failed)} failed.")
@@ -0,0 +1,187 @@
+"""
+Stage-aware checkpointing for the cotrending
+
+Each stage writes only its own new outputs to a .npz file in the
+checkpoint directory. Files are written to a temporary name and
+renamed into place, so a crash mid-write never corrupts an existing
+checkpoint. A small JSON ledger records which stages are complete,
+so a rerun can pick up at the first incomplete stage
+
+The ledger is tied to a key of the inputs, e.g. the light curve store's
+inputs_key. When the key changes every checkpoint is dropped, so stages
+made from old light curves are never reused
+"""
+import os
+import json
+from datetime import datetime, timezone
+import numpy as np
+
+# pylint: disable=invalid-name
+
+LEDGER_FILE = "stages.json"
+
+class CheckpointStore():
+    """
+    A directory of per-stage .npz checkpoints plus a ledger
+    """
+    def __init__(self, directory, stages, inputs_key=None):
+        """
+        Initialise the class
+
+        Parameters
+        ----------
+        directory : str
+            Path to the checkpoint directory
+        stages : list
+            Names of the stages, in the order they run. Completing
+            a stage invalidates any later stages
+        inputs_key : str | None
+            Key of the inputs the stages are made from. Checkpoints
+            recorded with a different key are dropped
+        """
+        self.directory = directory
+        self.stages = list(stages)
+        self.inputs_key = inputs_key
+        os.makedirs(directory, exist_ok=True)
+        ledger_file = os.path.join(directory, LEDGER_FILE)
+        if os.path.exists(ledger_file):
+            with open(ledger_file, 'r') as lf:
+                self.ledger = json.load(lf)
+        else:
+            self.ledger = {}
+
+        stale = [stage for stage, entry in self.ledger.items()
+                 if entry.get('inputs_key') != inputs_key]
+        if stale:
+            print(f"Inputs have changed since the checkpoints in {directory} "
+                  f"were made, dropping {', '.join(stale)}")
+            self.drop(stale)
+
+    def drop(self, stages):
+        """
+        Forget some stages and delete their checkpoint files
+        """
+        for stage in stages:
+            self.ledger.pop(stage, None)
+            if os.path.exists(self.path(stage)):
+                os.remove(self.path(stage))
+        self._write_ledger()
+
+    def invalidate(self, stage):
+        """
+        Drop a stage and every later stage, e.g. when the outputs a
+        stage recorded have gone missing. The ledger is saved at once,
+        so a crash straight after never resumes from the stale stages
+        """
+        self.drop(self.stages[self.stages.index(stage):])
+
+    def _write_ledger(self):
+        """
+        Atomically write the ledger of complete stages
+        """
+        ledger_file = os.path.join(self.directory, LEDGER_FILE)
+        tmp_file = f"{ledger_file}.tmp"
+        with open(tmp_file, 'w') as lf:
+            json.dump(self.ledger, lf, indent=2)
+        os.replace(tmp_file, ledger_file)
+
+    def path(self, stage):
+        """
+        Path to the .npz file for a stage
+        """
+        return os.path.join(self.directory, f"{stage}.npz")
+
+    def is_complete(self, stage, **info):
+        """
+        Has a stage been completed? If info is given, the stage only
+        counts as complete if it was recorded with the same info
+        """
+        entry = self.ledger.get(stage, {})
+        return entry.get('complete', False) and \
+            all(entry.get(key) == value for key, value in info.items())
+
+    def first_incomplete(self):
+        """
+        Name of the first stage not yet complete, None if all are
+        """
+        for stage in self.stages:
+            if not self.is_complete(stage):
+                return stage
+        return None
+
+    def save(self, stage, info=None, **arrays):
+        """
+        Save the new outputs of a stage and mark it complete.
+        Any later stages are marked incomplete, as they were
+        made from the old outputs of this stage
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage
+        info : dict
+            Extra information to keep in the ledger
+        arrays : array-like
+            Named arrays to save for this stage
+        """
+        tmp_file = f"{self.path(stage)}.tmp.npz"
+        np.savez(tmp_file, **arrays)
+        os.replace(tmp_file, self.path(stage))
+        self.mark_complete(stage, **(info or {}))
+
+    def mark_complete(self, stage, **info):
+        """
+        Record a stage as complete without saving anything, e.g.
+        when its output is kept elsewhere. Any later stages are
+        marked incomplete
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage
+        info : dict
+            Extra information to keep in the ledger
+        """
+        for later in self.stages[self.stages.index(stage)+1:]:
+            self.ledger.pop(later, None)
+        self.ledger[stage] = dict(info, complete=True, inputs_key=self.inputs_key,
+                                  time=datetime.now(timezone.utc).isoformat())
+        self._write_ledger()
+
+    def load(self, stage):
+        """
+        Load the outputs of a complete stage
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage
+
+        Returns
+        -------
+        arrays : dict
+            Named arrays saved for this stage
+        """
+        with np.load(self.path(stage)) as data:
+            return {name: data[name] for name in data.files}
+
+def checkpoint_dirname(config):
+    """
+    Name of the checkpoint directory for a config, by default
+    named after the cbv_file with a _checkpoints suffix
+    """
+    default = f"{os.path.splitext(config['data']['cbv_file'])[0]}_checkpoints"
+    return config['data'].get('checkpoint_dir', default)
+
+def pack_fit_coeffs(fit_coeffs):
+    """
+    Turn a fit_coeffs dictionary, CBV id -> coefficient per star,
+    into named arrays for saving
+    """
+    return {f"cbv_{cbv_id}": np.asarray(coeffs) for cbv_id, coeffs in fit_coeffs.items()}
+
+def unpack_fit_coeffs(arrays):
+    """
+    Inverse of pack_fit_coeffs
+    """
+    return {int(name[4:]): coeffs for name, coeffs in arrays.items()}
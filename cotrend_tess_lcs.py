@@ -1,22 +1,57 @@
 """
 Example layout of using Cotrendy
 """
-import gc
 import os
-from copy import deepcopy
+import copy
+import tempfile
 import argparse as ap
 import matplotlib
 matplotlib.use('Agg')
 import numpy as np
 from astropy.io import fits
-from astropy.table import Table, Column
 import cotrendy.utils as cuts
 import cotrendy.lightcurves as clc
 from cotrendy.catalog import Catalog
 from cotrendy.cbvs import CBVs
+from lc_store import (LightcurveStore, store_dirname, config_apertures, aperture_config,
+                      config_precision)
+from tess_io import write_back
+from ccd_product import write_ccd_product, ccd_product_filename
+from fitting import (cotrend_data_ls_batched, calculate_robust_fit_coeffs_batched,
+                     cotrend_ls_stream, check_ls_engine, check_robust_engine,
+                     sample_rows, LS_TOLERANCE, ROBUST_TOLERANCE)
+from map_fit import (cotrend_data_map_kde, check_map_engine, scaled_coordinates,
+                     MAP_TOLERANCE, DEFAULT_DIM_WEIGHTS)
+from map_cotrendy import cotrend_data_map_cotrendy
+from map_journal import discard_journal
+from cbv_svd import calculate_cbvs_svd, compare_svd
+from cbv_product import CBVProduct, cbv_product_filename
+from cbv_cache import cbv_cache_key, config_cbv_cache
+from checkpoint import (CheckpointStore, checkpoint_dirname,
+                        pack_fit_coeffs, unpack_fit_coeffs)
+from instrumentation import Instrumentation
 
 # pylint: disable=invalid-name
 
+# the cotrending stages, in the order they run. 'stream' replaces
+# the last three when the full catalog is streamed in chunks
+STAGES = ['cbvs', 'variability', 'robust_fits', 'fits', 'stream']
+
+# the options the robust fit coefficients depend on, a change means refitting
+ROBUST_OPTIONS = {'robust_engine': "cotrendy",
+                  'robust_n_iter': 20,
+                  'robust_huber_t': 1.345,
+                  'robust_tol': 1e-6}
+
+# the options the final fits depend on, a change means refitting
+FIT_OPTIONS = {'cbv_mode': None,
+               'ls_engine': "batched",
+               'map_engine': "cotrendy",
+               'map_theta_mode': "fixed",
+               'map_n_theta': 500,
+               'prior_n_neighbours': 40,
+               'prior_radius': None}
+
 def arg_parse():
     """
     Parse the command line arguments
@@ -29,123 +64,419 @@ def arg_parse():
                    action='store_true')
     return p.parse_args()
 
-if __name__ == "__main__":
-    # load the command line arguments
-    args = arg_parse()
+def plot_fit_coeff_correlations(config, cbv_stars):
+    """
+    Plot the fit coefficient correlations for the CBV stars
+    """
+    try:
+        cbv_stars.plot_fit_coeff_correlations(Catalog(config, apply_object_mask=True))
+    except Exception:
+        print('Binning likely failed. Fix this later')
 
-    # load the configuration
-    config = cuts.load_config(args.config)
-    camera_id = config['global']['camera_id']
+def calculate_robust_fit_coeffs(config, cbvs):
+    """
+    Fill cbvs.fit_coeffs with the robust fit coefficients, either
+    with cotrendy's star by star fits or the batched engine. The
+    batched engine is checked against cotrendy on a sample first
+    """
+    if config['cotrend'].get('robust_engine', "cotrendy") == "batched":
+        block_rows = config['cotrend'].get('robust_block_rows', 256)
+        irls = {'n_iter': config['cotrend'].get('robust_n_iter', ROBUST_OPTIONS['robust_n_iter']),
+                'huber_t': config['cotrend'].get('robust_huber_t', ROBUST_OPTIONS['robust_huber_t']),
+                'tol': config['cotrend'].get('robust_tol', ROBUST_OPTIONS['robust_tol'])}
+        n_check = config['cotrend'].get('robust_check_stars', 100)
+        if n_check > 0:
+            max_diff = check_robust_engine(cbvs, n_check=n_check, block_rows=block_rows, **irls)
+            print(f"Batched robust fits vs cotrendy on {n_check} stars: "
+                  f"max difference {max_diff:.3f} x the coefficient spread")
+            if not max_diff <= ROBUST_TOLERANCE:
+                raise RuntimeError(f"Batched robust fits differ from cotrendy by {max_diff:.3f} x "
+                                   f"the coefficient spread, more than {ROBUST_TOLERANCE:g}, "
+                                   f"use robust_engine = \"cotrendy\"")
+        calculate_robust_fit_coeffs_batched(cbvs, block_rows=block_rows,
+                                            pool_size=config['cotrend'].get('robust_pool_size', 1),
+                                            **irls)
+    else:
+        cbvs.calculate_robust_fit_coeffs_sequen()
+
+def check_map_kde(config, store, aperture, cbvs, catalog):
+    """
+    Compare the kde MAP engine with cotrendy's MAP on the test stars, or
+    map_check_stars random stars if there are none, save the comparison
+    as map_check_<aperture>.json and stop if they differ too much
+    """
+    n_check = config['cotrend'].get('map_check_stars', 10)
+    if n_check <= 0:
+        return
+    check_rows = config['cotrend'].get('test_stars', []) or \
+        sample_rows(len(store['tic_ids']), n_check)
+    dim_weights = config['catalog'].get('dim_weights', DEFAULT_DIM_WEIGHTS)
+    coords = scaled_coordinates(*catalog, dim_weights)
+    report = check_map_engine(cbvs, config, Catalog(config, apply_object_mask=False),
+                              coords, check_rows,
+                              n_context=5*config['cotrend'].get('prior_n_neighbours', 40))
+    store.write_report(report, filename=f"map_check_{aperture}.json")
+    print(f"kde MAP vs cotrendy on {len(report['rows'])} stars: max difference "
+          f"{report['max_coeff_diff']:.3f} x the coefficient spread, "
+          f"{report['max_model_diff']:.2e} of the CBV model")
+    if not report['max_coeff_diff'] <= MAP_TOLERANCE:
+        raise RuntimeError(f"kde MAP differs from cotrendy by {report['max_coeff_diff']:.3f} x "
+                           f"the coefficient spread, more than {MAP_TOLERANCE:g}, "
+                           f"use map_engine = \"cotrendy\"")
+
+def check_ls_stream(config, store, aperture, cbv_product, n_check):
+    """
+    Compare the streamed LS fits against cotrendy's cotrend_data_ls for
+    a random sample of stars. The sample is loaded by cotrendy itself,
+    through a temporary object mask, so its normalisation is the one the
+    in memory path uses. Stars cotrendy cannot normalise, e.g. with NaN
+    cadences, are left out
+
+    Returns
+    -------
+    report : dict
+        The rows compared, those left out and the largest difference
+        in the cotrended fluxes relative to cotrendy's, with the
+        tolerance, LS_TOLERANCE or 100 x the precision's resolution
+    """
+    flux = store[f"flux_{aperture}"]
+    rows = sample_rows(len(flux), n_check)
+    sample_mask = np.zeros(len(flux), dtype=bool)
+    sample_mask[rows] = True
+
+    # cotrendy loads the object mask from root, the working directory
+    handle, mask_file = tempfile.mkstemp(prefix="stream_check_", suffix=".pkl", dir=".")
+    os.close(handle)
+    try:
+        cuts.picklify(mask_file, sample_mask)
+        sample_config = copy.deepcopy(config)
+        sample_config['data']['objects_mask_file'] = os.path.basename(mask_file)
+        times, lightcurves = clc.load_photometry(sample_config, apply_object_mask=True)
+    finally:
+        os.remove(mask_file)
+    sample = CBVs(sample_config, times, lightcurves)
+    cbv_product.apply_to(sample)
+    sample.cotrend_data_ls()
+    med = np.array([lc.median_flux for lc in lightcurves], dtype=np.float64)[:, None]
+    reference = np.asarray(sample.cotrended_flux_array, dtype=np.float64) * med + med
+
+    cor = np.empty(reference.shape)
+    cbv = np.empty(reference.shape)
+    _, bad = cotrend_ls_stream(flux[rows], cbv_product.vect_store, cor, cbv)
+    usable = np.isfinite(reference).all(axis=1) & ~bad
+    reference, cor = reference[usable], cor[usable]
+    scale = np.maximum(np.max(np.abs(reference), axis=1), np.finfo(float).tiny)
+    rel_diff = np.max(np.abs(cor - reference), axis=1) / scale
+    return {'rows': rows[usable].tolist(),
+            'skipped': rows[~usable].tolist(),
+            'max_rel_diff': float(np.max(rel_diff, initial=0.)),
+            'tolerance': max(LS_TOLERANCE, 100 * np.finfo(config_precision(config)).eps)}
+
+def cotrend_aperture_streaming(config, store, aperture, cbv_product, checkpoints):
+    """
+    LS cotrend the full catalog a chunk of stars at a time, reading the
+    fluxes from the store and writing cor_<aperture> and cbv_<aperture>
+    straight back to it, so peak memory is set by stream_chunk_rows.
+    The stream is checked against cotrendy on ls_check_stars stars
+    first, and the stars it cannot normalise are reported
+    """
+    if checkpoints.is_complete('stream') and f"cor_{aperture}" in store:
+        print(f"Streamed cotrending of {aperture} already complete")
+        return
+
+    report = {}
+    n_check = config['cotrend'].get('ls_check_stars', 100)
+    if n_check > 0:
+        report['check'] = check_ls_stream(config, store, aperture, cbv_product, n_check)
+        max_rel_diff = report['check']['max_rel_diff']
+        tolerance = report['check']['tolerance']
+        print(f"Streamed LS vs cotrendy on {len(report['check']['rows'])} stars: "
+              f"max relative difference {max_rel_diff:.2e}")
+        if not max_rel_diff <= tolerance:
+            store.write_report(report, filename=f"stream_report_{aperture}.json")
+            raise RuntimeError(f"Streamed LS differs from cotrendy by {max_rel_diff:.2e}, "
+                               f"more than {tolerance:g}, set streaming = false")
+
+    flux = store[f"flux_{aperture}"]
+    cor = store.add_array(f"cor_{aperture}", flux.shape, dtype=config_precision(config))
+    cbv = store.add_array(f"cbv_{aperture}", flux.shape, dtype=config_precision(config))
+    _, bad = cotrend_ls_stream(flux, cbv_product.vect_store, cor, cbv,
+                               chunk_rows=config['cotrend'].get('stream_chunk_rows', 2048))
+    store.flush()
+    report['bad_tic_ids'] = store['tic_ids'][bad].tolist()
+    if report['bad_tic_ids']:
+        print(f"{len(report['bad_tic_ids'])} stars of {aperture} have no positive median "
+              f"flux, their outputs are NaN, see stream_report_{aperture}.json")
+    store.write_report(report, filename=f"stream_report_{aperture}.json")
+    checkpoints.mark_complete('stream')
+
+def cotrend_aperture(config, store, aperture, cbvs_only=False, profiler=None):
+    """
+    Extract the CBVs for one aperture and, unless cbvs_only is set,
+    cotrend every light curve with them. The cotrended flux and the
+    CBV correction are saved to the light curve store as cor_<aperture>
+    and cbv_<aperture> for writing back to the TIC files later
+
+    Parameters
+    ----------
+    config : dict
+        Cotrendy configuration for this aperture, see aperture_config
+    store : LightcurveStore
+        Writeable light curve store from the prepare step
+    aperture : str
+        Aperture column, e.g. AP2.5
+    cbvs_only : boolean
+        Stop after calculating the CBVs?
+    profiler : Instrumentation
+        Records each stage as <aperture>/<stage>
+    """
+    profiler = profiler or Instrumentation('cotrend')
     root = config['global']['root']
     cbv_mode = config['cotrend']['cbv_mode']
 
     # grab the locations of the data
     cbv_pickle_file = config['data']['cbv_file']
     cbv_pickle_file_output = f"{root}/{cbv_pickle_file}"
-
-    # move into the working directory
-    os.chdir(root)
-
-    # load the external catalog
-    catalog = Catalog(config, apply_object_mask=True)
-
-    # check if we have the cbv pickle file
-    print(f"Looking for pickle file {cbv_pickle_file_output}...")
-    cbvs = cuts.depicklify(f"{cbv_pickle_file_output}")
-    # if there is no pickle file, extract the CBVs from scratch
-    if cbvs is None:
-        print(f"Pickle file {cbv_pickle_file_output} not found, doing detrending from scratch...")
-
-        # step 1, load the photometry, this is done here and not prior to
-        # the check for CBVs because the flux array is pickled with the CBVs
-        times, lightcurves = clc.load_photometry(config, apply_object_mask=True)
-
-        # create a CBVs object for our targets, we want the top n_CBVs
+    pickle_cbvs_object = config['data'].get('pickle_cbvs_object', True)
+
+    # each stage checkpoints only its own new outputs, find where to start.
+    # All are dropped if the prepare step has changed any light curve
+    # since, and the CBVs are only reused if nothing they depend on has changed
+    checkpoints = CheckpointStore(checkpoint_dirname(config), STAGES,
+                                  inputs_key=store.inputs_key())
+    cbv_product_file = cbv_product_filename(config)
+    cbv_key, cbv_inputs = cbv_cache_key(config, store, aperture)
+    cbv_cache = config_cbv_cache(config)
+    if checkpoints.is_complete('cbvs') and (not os.path.exists(cbv_product_file) or
+                                            not checkpoints.is_complete('cbvs', key=cbv_key)):
+        checkpoints.invalidate('cbvs')
+    robust_options = {option: config['cotrend'].get(option, default)
+                      for option, default in ROBUST_OPTIONS.items()}
+    fit_options = {option: config['cotrend'].get(option, default)
+                   for option, default in FIT_OPTIONS.items()}
+    print(f"Resuming at stage: {checkpoints.first_incomplete()}")
+
+    # the full catalog can be streamed through the LS fit in chunks
+    streaming = config['cotrend'].get('streaming', False) and not cbvs_only
+    if streaming and cbv_mode != "LS":
+        print("Streaming is only supported for cbv_mode = \"LS\", cotrending in memory")
+        streaming = False
+    if streaming and config['data'].get('reject_outliers', False):
+        # the outlier rejection is part of cotrendy's photometry loading
+        print("Streaming does not reject outliers, cotrending in memory")
+        streaming = False
+
+    with profiler.stage(f"{aperture}/load_photometry"):
+        # load the photometry once, the CBV stars are picked out of the
+        # full set with the object mask rather than reloaded. When only
+        # the CBVs are wanted only the CBV stars are loaded, and when
+        # streaming only those and only if the CBVs have to be made, the
+        # rest are read from the store
+        cbv_rows = np.where(store['objects_mask'])[0]
+        times, cbv_lightcurves = None, None
+        if cbvs_only:
+            times, cbv_lightcurves = clc.load_photometry(config, apply_object_mask=True)
+        elif streaming:
+            if not checkpoints.is_complete('cbvs') and \
+                    (cbv_cache is None or cbv_key not in cbv_cache):
+                times, cbv_lightcurves = clc.load_photometry(config, apply_object_mask=True)
+        else:
+            times, lightcurves = clc.load_photometry(config, apply_object_mask=False)
+            cbv_lightcurves = [lightcurves[i] for i in cbv_rows]
+
+    with profiler.stage(f"{aperture}/cbvs"):
+        # if we already have the CBV product load it, it only holds
+        # the vectors and a little metadata so loads in no time
+        cbv_stars = None
+        if checkpoints.is_complete('cbvs'):
+            print(f"Loading CBVs from {cbv_product_file}...")
+            cbv_product = CBVProduct.read(cbv_product_file)
+        # or they may be in the cache from an earlier run with the same inputs
+        elif cbv_cache is not None and (cbv_product := cbv_cache.get(cbv_key)) is not None:
+            print(f"Loading CBVs {cbv_key} from the CBV cache...")
+            cbv_product.write(cbv_product_file)
+            checkpoints.mark_complete('cbvs', product=cbv_product_file, key=cbv_key)
+        # otherwise, extract the CBVs from scratch
+        else:
+            print(f"No valid CBV product {cbv_product_file} or cached CBVs, doing detrending from scratch...")
+            if cbv_lightcurves is None:
+                # the cached CBVs went missing after the photometry was skipped
+                times, cbv_lightcurves = clc.load_photometry(config, apply_object_mask=True)
+
+            # create a CBVs object for the CBV stars, it shares the light curve
+            # objects of the full set, so nothing is loaded or copied again
+            cbv_stars = CBVs(config, times, cbv_lightcurves)
+            # the CBV star block is small, promote it so cotrendy's SVD
+            # and the CBV star fits run in float64 whatever the precision
+            cbv_stars.norm_flux_array = np.asarray(cbv_stars.norm_flux_array, dtype=np.float64)
+
+            # calculate the basis vectors and save them, either with
+            # cotrendy's full SVD or only the leading components
+            svd_mode = config['cotrend'].get('svd_mode', "cotrendy")
+            if svd_mode == "cotrendy":
+                cbv_stars.calculate_cbvs()
+            else:
+                calculate_cbvs_svd(cbv_stars, config)
+                if config['cotrend'].get('svd_report', False):
+                    # compare with the CBVs cotrendy makes from the same stars
+                    reference = copy.copy(cbv_stars)
+                    reference.calculate_cbvs()
+                    store.write_report(compare_svd(reference, cbv_stars),
+                                       filename=f"svd_report_{aperture}.json")
+            cbv_product = CBVProduct.from_cbvs(cbv_stars, config, aperture)
+            cbv_product.write(cbv_product_file)
+            checkpoints.mark_complete('cbvs', product=cbv_product_file, key=cbv_key)
+            if cbv_cache is not None:
+                cbv_cache.put(cbv_key, cbv_product, cbv_inputs,
+                              info={'sector': config['global']['timeslot'],
+                                    'camera': config['global']['camera_id'],
+                                    'root': root})
+
+    # if we only want the CBVs, or are streaming the rest, fit the CBV stars
+    if cbvs_only or streaming:
+        with profiler.stage(f"{aperture}/cbv_star_fits"):
+            if cbv_stars is not None:
+                calculate_robust_fit_coeffs(config, cbv_stars)
+                plot_fit_coeff_correlations(config, cbv_stars)
+                if pickle_cbvs_object:
+                    cuts.picklify(cbv_pickle_file_output, cbv_stars)
+        if streaming:
+            with profiler.stage(f"{aperture}/streaming"):
+                cotrend_aperture_streaming(config, store, aperture, cbv_product, checkpoints)
+        return
+
+    with profiler.stage(f"{aperture}/variability"):
+        # At this point we have the CBVs, now we cotrend everything using them
         cbvs = CBVs(config, times, lightcurves)
-        # pickle the intermediate CBVs object incase it crashes later
-        cuts.picklify(cbv_pickle_file_output, cbvs)
+        cbv_product.apply_to(cbvs)
 
-        # calculate the basis vectors
-        cbvs.calculate_cbvs()
-        # pickle the intermediate CBVs object incase it crashes later
-        cuts.picklify(cbv_pickle_file_output, cbvs)
+        if checkpoints.is_complete('variability'):
+            cbvs.variability = checkpoints.load('variability')['variability']
+        else:
+            cbvs.calculate_normalised_variability()
+            checkpoints.save('variability', variability=cbvs.variability)
 
-        # work out the fit coefficients, needed for the Prior PDF
-        cbvs.calculate_robust_fit_coeffs_sequen()
-        # pickle the intermediate CBVs object incase it crashes later
-        cuts.picklify(cbv_pickle_file_output, cbvs)
+    with profiler.stage(f"{aperture}/robust_fits"):
+        # work out the fit coefficients for everything in one go, needed for the Prior PDF
+        if checkpoints.is_complete('robust_fits', **robust_options):
+            cbvs.fit_coeffs = unpack_fit_coeffs(checkpoints.load('robust_fits'))
+        else:
+            calculate_robust_fit_coeffs(config, cbvs)
+            checkpoints.save('robust_fits', info=robust_options,
+                             **pack_fit_coeffs(cbvs.fit_coeffs))
+
+            # the CBV star fit coefficients are just a subset of these
+            if cbv_stars is not None:
+                cbv_stars.fit_coeffs = {cbv_id: coeffs[cbv_rows]
+                                        for cbv_id, coeffs in cbvs.fit_coeffs.items()}
+                plot_fit_coeff_correlations(config, cbv_stars)
+
+    with profiler.stage(f"{aperture}/{cbv_mode.lower()}_fits"):
+        # fit using MAP or LS. The fits are only kept in the store, as
+        # cor_<aperture> and cbv_<aperture>, so no copy is checkpointed
+        fits_done = checkpoints.is_complete('fits', **fit_options) and \
+            f"cor_{aperture}" in store and f"cbv_{aperture}" in store
+        if fits_done:
+            print(f"Fits of {aperture} already complete, loading them from the store")
+        else:
+            if cbv_mode == "MAP" and config['cotrend'].get('map_engine', "cotrendy") == "kde":
+                # a separate MAP estimator, checked against cotrendy first,
+                # whose workers share one copy of the arrays
+                tic_ids = store['tic_ids']
+                catalog = [store.catalog_column(column) for column in ('ra', 'dec', 'mag')]
+                check_map_kde(config, store, aperture, cbvs, catalog)
+                details = cotrend_data_map_kde(cbvs, config, catalog, tic_ids=tic_ids)
+                for star_id, result in details.items():
+                    cuts.picklify(f"TIC-{tic_ids[star_id]}_map.pkl", result)
+            elif cbv_mode == "MAP":
+                # cotrendy's own MAP fits, with the large arrays of the
+                # CBVs and catalog shared with its workers, whose
+                # finished stars are timed and journaled
+                catalog = Catalog(config, apply_object_mask=False)
+                cotrend_data_map_cotrendy(cbvs, catalog, config, tic_ids=store['tic_ids'])
+            elif config['cotrend'].get('ls_engine', "batched") == "batched":
+                # check the batched fits against cotrendy's on a sample first
+                n_check = config['cotrend'].get('ls_check_stars', 100)
+                if n_check > 0:
+                    max_rel_diff = check_ls_engine(cbvs, n_check=n_check)
+                    print(f"Batched LS vs cotrendy on {n_check} stars: "
+                          f"max relative difference {max_rel_diff:.2e}")
+                    if not max_rel_diff <= LS_TOLERANCE:
+                        raise RuntimeError(f"Batched LS differs from cotrendy by {max_rel_diff:.2e}, "
+                                           f"more than {LS_TOLERANCE:g}, use ls_engine = \"cotrendy\"")
+                # factorise the CBVs once and fit blocks of stars at a time
+                cotrend_data_ls_batched(cbvs, chunk_rows=config['cotrend'].get('ls_chunk_rows', 4096),
+                                        dtype=config_precision(config))
+            else:
+                cbvs.cotrend_data_ls()
+
+    with profiler.stage(f"{aperture}/store_outputs"):
+        # keep the results in the store for the write back
+        # norm_flux_array = (flux - median) / median
+        med = np.array([lc.median_flux for lc in lightcurves])
+        if fits_done:
+            # the CBVs object only needs the fits for the pickle
+            if pickle_cbvs_object:
+                cbvs.cotrended_flux_array = (np.asarray(store[f"cor_{aperture}"], dtype=np.float64)
+                                             - med[:, None]) / med[:, None]
+                cbvs.cotrending_flux_array = np.asarray(store[f"cbv_{aperture}"])
+        else:
+            precision = config_precision(config)
+            cor = store.add_array(f"cor_{aperture}", cbvs.cotrended_flux_array.shape,
+                                  dtype=precision)
+            cor[:] = (cbvs.cotrended_flux_array * med[:, None]) + med[:, None]
+            cbv = store.add_array(f"cbv_{aperture}", cbvs.cotrending_flux_array.shape,
+                                  dtype=precision)
+            cbv[:] = cbvs.cotrending_flux_array
+            store.flush()
+            checkpoints.mark_complete('fits', **fit_options)
+            # the fits are in the store, the MAP journal is no longer needed
+            discard_journal(config['data'].get('map_journal_dir'))
+
+    with profiler.stage(f"{aperture}/pickling"):
+        # the whole CBVs object is only pickled once, for the diagnostics
+        if pickle_cbvs_object:
+            cuts.picklify(cbv_pickle_file_output, cbvs)
 
-        # calculate fit coefficient correlations
-        try:
-            cbvs.plot_fit_coeff_correlations(catalog)
-        except Exception:
-            print('Binning likely failed. Fix this later')
+if __name__ == "__main__":
+    # load the command line arguments
+    args = arg_parse()
 
-    # if we want to do the full detrend, continue
-    if not args.cbvs_only:
-        # At this point we have the CBVs, now we need to go back and
-        # cotrend everything using them. We have to reload all the phot
-        # the catalog and redo the variability calc etc
-
-        # TODO: This is super sloppy, there is likely a better way to structure the code
-        # to do this. Come back to it later.
-
-        # Copy the things we want to keep in the larger instance of CBVs
-        # with all the fainter objects now included
-        print('Copying results...')
-        vectors = deepcopy(cbvs.vect_store)
-        cbvs_copy = deepcopy(cbvs.cbvs)
-        U_copy = deepcopy(cbvs.U)
-        Sigma_copy = deepcopy(cbvs.s)
-        VT_copy = deepcopy(cbvs.VT)
-        cbv_mask_copy = deepcopy(cbvs.cbv_mask)
-        cbvs_snr_copy = deepcopy(cbvs.cbvs_snr)
-
-        # free up some resources
-        print('Freeing up some resources...')
-        try:
-            del cbvs
-            del catalog
-            del times
-            del lightcurves
-            gc.collect()
-        except NameError:
-            print('Some requested free items did not exist, using existing cbv.pkl?')
-
-        # start reloading things
-        catalog = Catalog(config, apply_object_mask=False)
-        times, lightcurves = clc.load_photometry(config, apply_object_mask=False)
-        # recreate the cbvs class but now manually insert some stuff from
-        # the previous run and rerun the required parts for the cotrending
-        cbvs = CBVs(config, times, lightcurves)
-        cbvs.calculate_normalised_variability()
-        cbvs.U = U_copy
-        cbvs.s = Sigma_copy
-        cbvs.VT = VT_copy
-        cbvs.cbv_mask = cbv_mask_copy
-        cbvs.cbvs_snr = cbvs_snr_copy
-        # set the previously calculate parameters
-        cbvs.cbvs = cbvs_copy
-        cbvs.vect_store = vectors
-        cbvs.n_cbvs = len(vectors)
-
-        # work out the fit coefficients, needed for the Prior PDF
-        cbvs.calculate_robust_fit_coeffs_sequen()
-        # pickle the intermediate CBVs object incase it crashes later
-        cuts.picklify(cbv_pickle_file_output, cbvs)
+    # load the configuration
+    config = cuts.load_config(args.config)
+    root = config['global']['root']
 
-        # fit using MAP or LS
-        if cbv_mode == "MAP":
-            # use multiprocessing to fit everything
-            cbvs.cotrend_data_map_mp(catalog)
-        else:
-            cbvs.cotrend_data_ls()
+    # move into the working directory
+    os.chdir(root)
 
-        # pickle the intermediate CBVs object incase it crashes later
-        cuts.picklify(cbv_pickle_file_output, cbvs)
+    # the store is where the cotrended outputs are kept until write back
+    store = LightcurveStore(store_dirname(config), mode='r+')
+    update_report = store.read_report()
+    if update_report and not update_report.get('full_rebuild', True):
+        print(f"Store updated by prepare: {len(update_report['added'])} added, "
+              f"{len(update_report['updated'])} updated, "
+              f"{len(update_report['removed'])} removed")
+
+    # each aperture gets its own flux matrix and set of CBVs
+    apertures = config_apertures(config)
+
+    # time and profile each stage, the report goes next to the outputs
+    profiler = Instrumentation('cotrend_cbvs' if args.cbvs_only else 'cotrend',
+                               meta={'sector': config['global']['timeslot'],
+                                     'camera': config['global']['camera_id'],
+                                     'cbv_mode': config['cotrend']['cbv_mode'],
+                                     'pool_size': config['cotrend'].get('pool_size', 1),
+                                     'shape': list(store[f"flux_{apertures[0]}"].shape)})
+
+    for aperture in apertures:
+        print(f"Cotrending aperture {aperture}...")
+        cotrend_aperture(aperture_config(config, aperture), store, aperture,
+                         cbvs_only=args.cbvs_only, profiler=profiler)
 
+    if not args.cbvs_only:
         # now we have the final cotrending and cotrended arrays we can
-        # bake them back into the input fits files
+        # bake them back into the input fits files, every aperture is
+        # written in a single rewrite of each file
         # This is TESS specific, other data might require the output differently
 
         # load the cadence mask
@@ -153,48 +484,27 @@ if __name__ == "__main__":
         with fits.open(cadence_mask_file) as mf:
             mask = mf[1].data['MASK']
 
-        # get a list of the light curve files for editing
-        n_cat_obj = len(catalog.ids)
-        for i, tic_id in enumerate(catalog.ids):
-            # load the fits lc file
-            fits_file = f"TIC-{np.int64(tic_id)}.fits"
-
-            with fits.open(fits_file) as ff:
-                table = Table(ff[1].data)
-
-            exists = os.path.exists(fits_file)
-            #print(f"[{i+1}/{n_cat_obj}] {fits_file} {exists}")
-
-            output_lc = np.ones(len(mask)) * -99.0
-            output_cbv = np.ones(len(mask)) * -99.0
-
-            # norm_flux_array = (flux - median) / median
-            med = lightcurves[i].median_flux
-            flux = (cbvs.cotrended_flux_array[i] * med) + med
-            output_lc[mask] = flux
-            output_cbv[mask] = cbvs.cotrending_flux_array[i]
-
-            # make table columns
-            cor_column = 'COR_AP2.5'
-            cbv_column = 'CBV_AP2.5'
-
-            # if this column already exists in the file
-            # update it, otherwise add a new Column object
-            if cor_column in table.keys():
-                table[cor_column] = output_lc
-            else:
-                col_corrected = Column(name=cor_column,
-                                       data=output_lc,
-                                       dtype=np.float64)
-                table.add_column(col_corrected)
-
-            if cbv_column in table.keys():
-                table[cbv_column] = output_cbv
-            else:
-                col_cbv = Column(name=cbv_column,
-                                 data=output_cbv,
-                                 dtype=np.float64)
-                table.add_column(col_cbv)
-
-            # write out the final light curve
-            table.write(fits_file, format="fits", overwrite=True)
+        # either keep everything in one per-CCD product, or update
+        # the light curve files with a bounded pool of writers
+        output_mode = config['data'].get('output_mode', "tic")
+        if output_mode == "ccd":
+            ccd_product_file = ccd_product_filename(config)
+            print(f"Writing per-CCD product {ccd_product_file}...")
+            with profiler.stage('ccd_product'):
+                write_ccd_product(ccd_product_file, store, apertures, mask,
+                                  compression=config['data'].get('ccd_product_compression'),
+                                  meta={'sector': config['global']['timeslot'],
+                                        'camera': config['global']['camera_id']})
+        else:
+            write_pool_size = config['data'].get('write_pool_size', 1)
+            with profiler.stage('write_back'):
+                failures = write_back(store.directory, mask, apertures, pool_size=write_pool_size)
+            store.write_report({'n_files': len(store['tic_ids']),
+                                'failures': {str(tic_id): error
+                                             for tic_id, error in failures.items()}},
+                               filename='write_back_report.json')
+            print(f"Updated {len(store['tic_ids']) - len(failures)} light curves, "
+                  f"{len(failures)} failed.")
+
+    profiler.print_summary()
+    print(f"Instrumentation report saved to {profiler.write()}")
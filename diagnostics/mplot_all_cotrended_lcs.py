@@ -31,13 +31,17 @@ def arg_parse():
                    help='number of cores to run on')
     p.add_argument('--object_mask',
                    help='use the object mask if limited set')
+    p.add_argument('--aperture',
+                   help='aperture column to plot (e.g. AP2.5)',
+                   default='AP2.5')
     return p.parse_args()
 
 def worker_fn(star_id, constants):
     """
     Read the files and do the plotting
     """
-    tic_ids, t_mags, variability, mask = constants
+    tic_ids, t_mags, variability, mask, aperture = constants
+    radius = float(aperture[2:])
 
     # grab some info about the object
     tic_id = int(tic_ids[star_id])
@@ -53,10 +57,10 @@ def worker_fn(star_id, constants):
             data = ff[1].data
 
         bjd = data['BJD'][mask] - int(data['BJD'][mask][0])
-        flux = data['AP2.5'][mask]
-        sky = data['SKY_MEDIAN'][mask] * np.pi * (2.5**2)
-        cbvs = data['CBV_AP2.5'][mask]
-        flux_corr = data['COR_AP2.5'][mask]
+        flux = data[aperture][mask]
+        sky = data['SKY_MEDIAN'][mask] * np.pi * (radius**2)
+        cbvs = data[f'CBV_{aperture}'][mask]
+        flux_corr = data[f'COR_{aperture}'][mask]
 
         # generate some intermediate products
         flux_sky_corr = flux - sky
@@ -66,7 +70,7 @@ def worker_fn(star_id, constants):
         # now make a plot of the data, the correction and the corrected data
         fig, ax = plt.subplots(nrows=5, ncols=1, figsize=(10, 10), sharex=True)
         ax[0].set_title(f"TIC-{tic_id} T={t_mag} Var_n={var_n}")
-        ax[0].plot(bjd, flux, 'k.', label='AP2.5')
+        ax[0].plot(bjd, flux, 'k.', label=aperture)
         ax[0].legend()
         ax[0].set_ylabel('Flux')
 
@@ -74,7 +78,7 @@ def worker_fn(star_id, constants):
         ax[1].legend()
         ax[1].set_ylabel('Flux')
 
-        ax[2].plot(bjd, flux_sky_corr, 'k.', label='AP2.5 - Sky median')
+        ax[2].plot(bjd, flux_sky_corr, 'k.', label=f'{aperture} - Sky median')
         ax[2].legend()
         ax[2].set_ylabel('Flux')
 
@@ -122,7 +126,7 @@ if __name__ == "__main__":
             cadence_mask = ff[1].data['MASK']
 
         # set up constants tuple
-        const = (tic_ids, t_mags, cbvs.variability, cadence_mask)
+        const = (tic_ids, t_mags, cbvs.variability, cadence_mask, args.aperture)
 
         # make a partial function with the constants baked in
         fn = partial(worker_fn, constants=const)
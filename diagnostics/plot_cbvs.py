@@ -0,0 +1,45 @@
+"""
+Plot the CBVs from a CBV product file
+"""
+import os
+import sys
+import argparse as ap
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cbv_product import CBVProduct
+
+# pylint: disable=invalid-name
+# pylint: disable=wrong-import-position
+
+def arg_parse():
+    """
+    Parse the command line arguments
+    """
+    p = ap.ArgumentParser()
+    p.add_argument('cbv_product_file',
+                   help='Path to CBV product file (e.g. tess_S05_1-1_cbvs.fits)')
+    return p.parse_args()
+
+if __name__ == "__main__":
+    args = arg_parse()
+
+    product = CBVProduct.read(args.cbv_product_file)
+    cbv_ids = sorted(product.cbvs.keys())
+
+    fig, ax = plt.subplots(nrows=len(cbv_ids), ncols=1, figsize=(10, 2*len(cbv_ids)),
+                           sharex=True, squeeze=False)
+    ax[0, 0].set_title(f"{product.meta.get('SECTOR')} {product.meta.get('CAMERA')} "
+                       f"{product.meta.get('APERTURE')}")
+    for i, cbv_id in enumerate(cbv_ids):
+        if isinstance(product.cbvs_snr, dict):
+            snr = product.cbvs_snr[cbv_id]
+        else:
+            snr = product.cbvs_snr[i]
+        ax[i, 0].plot(product.cbvs[cbv_id], 'k.', label=f'CBV {cbv_id} SNR={snr:.2f}')
+        ax[i, 0].legend()
+    ax[-1, 0].set_xlabel('Image ID')
+
+    fig.tight_layout()
+    fig.savefig(f"{os.path.splitext(args.cbv_product_file)[0]}.png")
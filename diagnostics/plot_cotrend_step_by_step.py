@@ -64,20 +64,22 @@ def worker_fn(star_id, constants):
     # if there is a map file make a bunch of plots, otherwise, just plot
     # the LS results instead
     if map_file:
-        # shrink some names
-        pr_w8 = mapp.prior_weight
-        pr_w8_var = mapp.prior_weight_pt_var
-        pr_w8_gd = mapp.prior_weight_pt_gen_good
-        pr_gen_gd = mapp.prior_general_goodness
-        pr_noi_gd = mapp.prior_noise_goodness
+        # shrink some names, the kde MAP engine has no goodness
+        # terms, so only show those that are there
         mode = mapp.mode
+        title = f'Mag: {t_mag} Var: {var:.3f} Prior Wt: {mapp.prior_weight:.3f}'
+        if hasattr(mapp, 'prior_weight_pt_gen_good'):
+            title += f' [{mapp.prior_weight_pt_var:.3f}:{mapp.prior_weight_pt_gen_good:.3f}]'
+        if hasattr(mapp, 'prior_general_goodness'):
+            title += f' Prior Gdness: {mapp.prior_general_goodness:.3f} [{mapp.prior_noise_goodness:.3f}]'
+        title += f' -  Mode: {mode}'
+        hist_bins = getattr(mapp, 'hist_bins', 'auto')
 
         # PLOT THE COND, PRIOR AND POSTERIOR STEP BY STEP #
         #fig, ax = plt.subplots(ncols=3, nrows=n_cbvs+3, figsize=(20, 20), sharex=True, sharey=True)
         fig, ax = plt.subplots(ncols=2, nrows=3, figsize=(15, 10), sharex=True, sharey=True)
 
         # row 0 is the raw fluxes, duplicate them to guide the eye
-        title = f'Mag: {t_mag} Var: {var:.3f} Prior Wt: {pr_w8:.3f} [{pr_w8_var:.3f}:{pr_w8_gd:.3f}] Prior Gdness: {pr_gen_gd:.3f} [{pr_noi_gd:.3f}] -  Mode: {mode}'
         fig.suptitle(title)
         ax[0, 0].plot(flux, 'k.', label='raw data')
         ax[0, 0].legend()
@@ -193,7 +195,7 @@ def worker_fn(star_id, constants):
             axar_c = [axar_c]
 
         try:
-            _ = fig_c.suptitle(f'Mag: {t_mag} Var: {var:.3f} Prior Wt: {pr_w8:.3f} [{pr_w8_var:.3f}:{pr_w8_gd:.3f}] Prior Gdness: {pr_gen_gd:.3f} [{pr_noi_gd:.3f}]  -  Mode: {mode}')
+            _ = fig_c.suptitle(title)
             for i, ax_c in zip(sorted(cbvs.cbvs.keys()), axar_c):
                 # draw a vertical line for the max of each PDF
                 _ = ax_c.axvline(mapp.prior_peak_theta[i], color='blue', ls='--', label="prior")
@@ -223,15 +225,17 @@ def worker_fn(star_id, constants):
             axar_p = [axar_p]
 
         try:
-            _ = fig_p.suptitle(f'Mag: {t_mag} Var: {var:.3f} Prior Wt: {pr_w8:.3f} [{pr_w8_var:.3f}:{pr_w8_gd:.3f}] Prior Gdness: {pr_gen_gd:.3f} [{pr_noi_gd:.3f}]  -  Mode: {mode}')
+            _ = fig_p.suptitle(title)
             for i, ax_p in zip(sorted(cbvs.cbvs.keys()), axar_p):
                 # only plot the middle 96% of the objects, like the kepler plots
-                sorted_coeffs = sorted(cbvs.fit_coeffs[i][mapp.prior_mask])
+                # cotrendy's prior stars, or the kde engine's neighbours
+                prior_stars = getattr(mapp, 'prior_mask', getattr(mapp, 'neighbour_rows', None))
+                sorted_coeffs = sorted(cbvs.fit_coeffs[i][prior_stars])
                 llim = int(np.ceil(len(sorted_coeffs)*0.02))
                 ulim = int(np.ceil(len(sorted_coeffs)*0.98))
 
                 # make the plot
-                _ = ax_p.hist(sorted_coeffs[llim:ulim], bins=mapp.hist_bins,
+                _ = ax_p.hist(sorted_coeffs[llim:ulim], bins=hist_bins,
                               density=True, label='Theta Histogram')
                 # draw a vertical line for the max of each PDF
                 _ = ax_p.axvline(mapp.prior_peak_theta[i], color='blue', ls='--', label="prior")
@@ -259,7 +263,7 @@ def worker_fn(star_id, constants):
             axar_pt = [axar_pt]
 
         try:
-            _ = fig_pt.suptitle(f'Mag: {t_mag} Var: {var:.3f} Prior Wt: {pr_w8:.3f} [{pr_w8_var:.3f}:{pr_w8_gd:.3f}] Prior Gdness: {pr_gen_gd:.3f} [{pr_noi_gd:.3f}]  -  Mode: {mode}')
+            _ = fig_pt.suptitle(title)
             for i, ax_pt in zip(sorted(cbvs.cbvs.keys()), axar_pt):
                 _ = ax_pt.plot(cbvs.theta[i], mapp.posterior_pdf[i], 'k-')
                 # draw a vertical line for the max of each PDF
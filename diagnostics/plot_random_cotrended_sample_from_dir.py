@@ -1,10 +1,12 @@
 """
 Take an input dir and plot a random sample of the light curves
 
-We assume that the data is in AP2.5, COR_AP2.5 and CBV_AP2.5 columns
+By default we assume that the data is in AP2.5, COR_AP2.5 and CBV_AP2.5
+columns, use --aperture to plot another aperture
 """
 import gc
 import sys
+import argparse as ap
 import glob as g
 import numpy as np
 import matplotlib
@@ -12,6 +14,14 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from astropy.io import fits
 
+p = ap.ArgumentParser()
+p.add_argument('--aperture',
+               help='aperture column to plot (e.g. AP2.5)',
+               default='AP2.5')
+args = p.parse_args()
+aperture = args.aperture
+radius = float(aperture[2:])
+
 every = 50
 lcs = sorted(g.glob('TIC*.fits'))
 n_lcs = len(lcs)
@@ -35,10 +45,10 @@ while i < n_lcs:
             data = ff[1].data
 
         bjd = data['BJD'][mask] - int(data['BJD'][mask][0])
-        flux = data['AP2.5'][mask]
-        cbvs = data['CBV_AP2.5'][mask]
-        flux_corr = data['COR_AP2.5'][mask]
-        sky = data['SKY_MEDIAN'][mask] * np.pi * (2.5**2)
+        flux = data[aperture][mask]
+        cbvs = data[f'CBV_{aperture}'][mask]
+        flux_corr = data[f'COR_{aperture}'][mask]
+        sky = data['SKY_MEDIAN'][mask] * np.pi * (radius**2)
         flux_sky_corr = flux - sky
 
         # now make a plot of the data, the correction and the corrected data
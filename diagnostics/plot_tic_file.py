@@ -21,6 +21,9 @@ def arg_parse():
                    help='path to TIC lc file')
     p.add_argument('--mask_file',
                    help='path to mask file')
+    p.add_argument('--aperture',
+                   help='aperture column to plot (e.g. AP2.5)',
+                   default='AP2.5')
     return p.parse_args()
 
 if __name__ == "__main__":
@@ -29,10 +32,10 @@ if __name__ == "__main__":
     d = fits.open(args.tic_file)[1].data
 
     bjd = d['BJD'] - int(d['BJD'][0])
-    data = d['AP2.5']
+    data = d[args.aperture]
     sky = d['SKY_MEDIAN']
-    cbv = d['CBV_AP2.5']
-    corr = d['COR_AP2.5']
+    cbv = d[f'CBV_{args.aperture}']
+    corr = d[f'COR_{args.aperture}']
 
     data_no_sky = data - sky
 
@@ -0,0 +1,483 @@
+"""
+Batched fitting engines for the cotrending
+
+Every star is fitted against the same set of CBVs, so rather than
+solving star by star we factorise the CBV design matrix once and
+fit whole blocks of stars with a few matrix products. The robust
+fits use iteratively reweighted least squares on blocks of stars
+"""
+import copy
+import warnings
+from functools import partial
+from multiprocessing import Pool
+import numpy as np
+from scipy.linalg import qr, solve_triangular
+
+# pylint: disable=invalid-name
+
+# the batched least squares must agree with cotrendy's per-star
+# cotrend_data_ls to within this relative tolerance, see check_ls_engine
+LS_TOLERANCE = 1e-8
+
+# the batched robust fits are a different estimator to cotrendy's, they
+# must agree to within this fraction of the spread of each CBV's
+# coefficients over the stars, see check_robust_engine
+ROBUST_TOLERANCE = 0.05
+
+def factorise_cbvs(vect_store):
+    """
+    Thin QR factorisation of the CBV design matrix
+
+    Parameters
+    ----------
+    vect_store : array-like
+        CBVs, (n_cbvs, n_cadences)
+
+    Returns
+    -------
+    Q : array-like
+        Orthonormal basis of the CBVs, (n_cadences, n_cbvs)
+    R : array-like
+        Upper triangular factor, (n_cbvs, n_cbvs)
+    """
+    Q, R = qr(np.asarray(vect_store, dtype=np.float64).T, mode='economic')
+    return Q, R
+
+def fit_ls_block(flux_block, Q, R, out=None):
+    """
+    Least squares fit of a block of stars to the CBVs. Stars with
+    NaN or inf cadences are fitted star by star on their finite
+    cadences alone, and get NaN coefficients and models if fewer
+    cadences than CBVs are left
+
+    Parameters
+    ----------
+    flux_block : array-like
+        Normalised fluxes, (n_stars, n_cadences)
+    Q, R : array-like
+        QR factorisation of the CBVs, see factorise_cbvs
+    out : array-like | None
+        Optional preallocated output for the CBV models
+
+    Returns
+    -------
+    coeffs : array-like
+        Fit coefficients, (n_stars, n_cbvs)
+    cotrending : array-like
+        CBV model for each star, (n_stars, n_cadences)
+    """
+    # project onto the CBVs, Y Q is the only large product. Stars
+    # with gaps come out as NaN here and are refitted below
+    Y = np.asarray(flux_block, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        YQ = Y @ Q
+        coeffs = solve_triangular(R, YQ.T, check_finite=False).T
+        cotrending = np.matmul(YQ, Q.T, out=out)
+
+    gappy = np.where(~np.isfinite(YQ).all(axis=1))[0]
+    if len(gappy) > 0:
+        # the CBVs themselves, vect_store = (Q R)^T
+        V = (Q @ R).T
+        for j in gappy:
+            finite = np.isfinite(Y[j])
+            if finite.sum() < len(R):
+                coeffs[j] = np.nan
+            else:
+                coeffs[j] = np.linalg.lstsq(V[:, finite].T, Y[j, finite], rcond=None)[0]
+            cotrending[j] = coeffs[j] @ V
+    return coeffs, cotrending
+
+def cotrend_ls_batched(norm_flux, vect_store, chunk_rows=4096,
+                       cotrended=None, cotrending=None, dtype=np.float64):
+    """
+    Least squares cotrend every star against the CBVs, a block
+    of stars at a time so memory use is set by chunk_rows. Stars
+    with NaN cadences are fitted on the rest and keep their NaNs
+
+    Parameters
+    ----------
+    norm_flux : array-like
+        Normalised fluxes, (n_stars, n_cadences)
+    vect_store : array-like
+        CBVs, (n_cbvs, n_cadences)
+    chunk_rows : int
+        Number of stars fitted per block
+    cotrended : array-like | None
+        Optional preallocated output for the cotrended fluxes
+    cotrending : array-like | None
+        Optional preallocated output for the CBV models
+    dtype : np.dtype
+        dtype of the outputs when they are not given, the
+        fits themselves are always done in float64
+
+    Returns
+    -------
+    coeffs : array-like
+        Fit coefficients, (n_stars, n_cbvs)
+    cotrended : array-like
+        Cotrended fluxes, norm_flux - cotrending
+    cotrending : array-like
+        CBV model for each star
+    """
+    n_stars = len(norm_flux)
+    Q, R = factorise_cbvs(vect_store)
+    if cotrended is None:
+        cotrended = np.empty(np.shape(norm_flux), dtype=dtype)
+    if cotrending is None:
+        cotrending = np.empty(np.shape(norm_flux), dtype=dtype)
+    coeffs = np.empty((n_stars, len(R)))
+
+    for i in range(0, n_stars, chunk_rows):
+        block = np.asarray(norm_flux[i:i+chunk_rows], dtype=np.float64)
+        coeffs[i:i+chunk_rows], model = fit_ls_block(block, Q, R)
+        cotrending[i:i+chunk_rows] = model
+        cotrended[i:i+chunk_rows] = block - model
+    return coeffs, cotrended, cotrending
+
+def cotrend_data_ls_batched(cbvs, chunk_rows=4096, dtype=np.float64):
+    """
+    Drop in replacement for CBVs.cotrend_data_ls, filling
+    cotrended_flux_array and cotrending_flux_array with
+    the batched least squares engine
+
+    Parameters
+    ----------
+    cbvs : cotrendy.cbvs.CBVs
+        CBVs object with norm_flux_array and vect_store set
+    chunk_rows : int
+        Number of stars fitted per block
+    dtype : np.dtype
+        dtype of the cotrended and cotrending arrays
+
+    Returns
+    -------
+    coeffs : array-like
+        Fit coefficients, (n_stars, n_cbvs)
+    """
+    coeffs, cotrended, cotrending = cotrend_ls_batched(cbvs.norm_flux_array,
+                                                       cbvs.vect_store,
+                                                       chunk_rows=chunk_rows,
+                                                       dtype=dtype)
+    cbvs.cotrended_flux_array = cotrended
+    cbvs.cotrending_flux_array = cotrending
+    return coeffs
+
+def sample_rows(n_stars, n_sample, seed=0):
+    """
+    Sorted random sample of star rows, for checking an engine
+    """
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(n_stars, size=min(n_sample, n_stars), replace=False))
+
+def cbvs_sample(cbvs, rows):
+    """
+    Shallow copy of a CBVs object holding only some of the stars, so
+    cotrendy's own per-star methods can be run on a sample of them
+    without touching the original
+
+    Parameters
+    ----------
+    cbvs : cotrendy.cbvs.CBVs
+        CBVs object with norm_flux_array and vect_store set
+    rows : array-like
+        Rows of the stars to keep
+
+    Returns
+    -------
+    sample : cotrendy.cbvs.CBVs
+        Copy with the per-star attributes cut down to the sample
+    """
+    sample = copy.copy(cbvs)
+    sample.norm_flux_array = np.array(cbvs.norm_flux_array[rows], dtype=np.float64)
+    if getattr(cbvs, 'lightcurves', None) is not None:
+        sample.lightcurves = [cbvs.lightcurves[i] for i in rows]
+    if getattr(cbvs, 'variability', None) is not None:
+        sample.variability = np.asarray(cbvs.variability)[rows]
+    if isinstance(getattr(cbvs, 'fit_coeffs', None), dict):
+        sample.fit_coeffs = {cbv_id: np.asarray(coeffs)[rows]
+                             for cbv_id, coeffs in cbvs.fit_coeffs.items()}
+    return sample
+
+def check_ls_engine(cbvs, n_check=100, seed=0):
+    """
+    Compare the batched least squares against cotrendy's per-star
+    cotrend_data_ls for a random sample of stars
+
+    Parameters
+    ----------
+    cbvs : cotrendy.cbvs.CBVs
+        CBVs object with norm_flux_array and vect_store set,
+        it is not changed
+    n_check : int
+        Number of stars to compare
+    seed : int
+        Seed for picking the sample
+
+    Returns
+    -------
+    max_rel_diff : float
+        Largest difference in the CBV models, relative to
+        the largest absolute value of cotrendy's model of each star
+    """
+    sample = cbvs_sample(cbvs, sample_rows(len(cbvs.norm_flux_array), n_check, seed=seed))
+    sample.cotrend_data_ls()
+    reference = np.asarray(sample.cotrending_flux_array, dtype=np.float64)
+
+    _, _, cotrending = cotrend_ls_batched(sample.norm_flux_array, cbvs.vect_store)
+    scale = np.maximum(np.max(np.abs(reference), axis=1), np.finfo(float).tiny)
+    return float(np.max(np.max(np.abs(cotrending - reference), axis=1) / scale))
+
+def cbv_order(cbvs):
+    """
+    CBV ids in the order of the rows of vect_store, which is how the
+    per-star coefficient arrays line up with the ids in fit_coeffs.
+    Each row of vect_store is matched to the CBV it was made from, and
+    it is an error if any row does not match exactly one CBV
+
+    Parameters
+    ----------
+    cbvs : cotrendy.cbvs.CBVs
+        CBVs object with cbvs and vect_store set
+
+    Returns
+    -------
+    cbv_ids : list
+        CBV id of each row of vect_store
+    """
+    vect_store = np.asarray(cbvs.vect_store, dtype=np.float64)
+    ids = list(cbvs.cbvs.keys())
+    vectors = np.array([np.asarray(cbvs.cbvs[cbv_id], dtype=np.float64) for cbv_id in ids])
+    if vectors.shape != vect_store.shape:
+        raise ValueError(f"vect_store has shape {vect_store.shape} but there are "
+                         f"{len(ids)} CBVs of shape {vectors.shape[1:]}")
+
+    cbv_ids = []
+    for k, row in enumerate(vect_store):
+        matches = [cbv_id for cbv_id, vector in zip(ids, vectors)
+                   if np.allclose(vector, row, rtol=1e-6, atol=0.)]
+        if len(matches) != 1:
+            raise ValueError(f"Row {k} of vect_store matches {len(matches)} CBVs, "
+                             f"cannot line up the fit coefficients with the CBV ids")
+        cbv_ids.append(matches[0])
+    if len(set(cbv_ids)) != len(cbv_ids):
+        raise ValueError("Two rows of vect_store match the same CBV")
+    return cbv_ids
+
+def robust_fit_block(flux_block, vect_store, n_iter=20, huber_t=1.345, tol=1e-6):
+    """
+    Robust fit of a block of stars to the CBVs using iteratively
+    reweighted least squares with Huber weights. Every star in the
+    block is reweighted and solved at once
+
+    Parameters
+    ----------
+    flux_block : array-like
+        Normalised fluxes, (n_stars, n_cadences)
+    vect_store : array-like
+        CBVs, (n_cbvs, n_cadences)
+    n_iter : int
+        Maximum number of reweighting iterations
+    huber_t : float
+        Huber threshold, in units of the robust residual scatter
+    tol : float
+        Stop once no coefficient changes by more than this
+        fraction between iterations
+
+    Returns
+    -------
+    coeffs : array-like
+        Robust fit coefficients, (n_stars, n_cbvs)
+    """
+    Y = np.asarray(flux_block, dtype=np.float64)
+    X = np.asarray(vect_store, dtype=np.float64).T
+
+    # start from the ordinary least squares solution
+    Q, R = factorise_cbvs(vect_store)
+    coeffs, _ = fit_ls_block(Y, Q, R)
+
+    for _ in range(n_iter):
+        residuals = Y - coeffs @ X.T
+
+        # robust scatter of each star's residuals from the MAD
+        med = np.median(residuals, axis=1, keepdims=True)
+        scale = 1.4826 * np.median(np.abs(residuals - med), axis=1, keepdims=True)
+        scale[scale == 0] = np.finfo(float).tiny
+        u = np.abs(residuals) / scale
+        weights = np.minimum(1., huber_t / np.maximum(u, np.finfo(float).tiny))
+
+        # weighted normal equations for every star in the block at once
+        XtWX = np.einsum('tk,nt,tl->nkl', X, weights, X, optimize=True)
+        XtWy = (weights * Y) @ X
+        new_coeffs = np.linalg.solve(XtWX, XtWy[..., None])[..., 0]
+
+        converged = np.all(np.abs(new_coeffs - coeffs) <= tol * (np.abs(coeffs) + tol))
+        coeffs = new_coeffs
+        if converged:
+            break
+    return coeffs
+
+def robust_fit_coeffs_batched(norm_flux, vect_store, block_rows=256, pool_size=1, **kwargs):
+    """
+    Robust fit coefficients for every star, fitted in blocks
+    which can be spread over a pool of processes
+
+    Parameters
+    ----------
+    norm_flux : array-like
+        Normalised fluxes, (n_stars, n_cadences)
+    vect_store : array-like
+        CBVs, (n_cbvs, n_cadences)
+    block_rows : int
+        Number of stars fitted together
+    pool_size : int
+        Number of processes, 1 fits the blocks serially
+    kwargs : dict
+        Passed on to robust_fit_block
+
+    Returns
+    -------
+    coeffs : array-like
+        Robust fit coefficients, (n_stars, n_cbvs)
+    """
+    starts = range(0, len(norm_flux), block_rows)
+    blocks = (np.asarray(norm_flux[i:i+block_rows]) for i in starts)
+    fn = partial(robust_fit_block, vect_store=vect_store, **kwargs)
+
+    if pool_size <= 1:
+        results = [fn(block) for block in blocks]
+    else:
+        with Pool(pool_size) as pool:
+            results = pool.map(fn, blocks)
+
+    if not results:
+        return np.empty((0, len(vect_store)))
+    return np.vstack(results)
+
+def calculate_robust_fit_coeffs_batched(cbvs, block_rows=256, pool_size=1, **kwargs):
+    """
+    Drop in replacement for CBVs.calculate_robust_fit_coeffs_sequen,
+    filling cbvs.fit_coeffs with the batched robust fits. fit_coeffs
+    keeps the same layout, CBV id -> coefficient for each star
+
+    Parameters
+    ----------
+    cbvs : cotrendy.cbvs.CBVs
+        CBVs object with norm_flux_array, cbvs and vect_store set
+    block_rows : int
+        Number of stars fitted together
+    pool_size : int
+        Number of processes, 1 fits the blocks serially
+    kwargs : dict
+        IRLS options passed on to robust_fit_block
+    """
+    coeffs = robust_fit_coeffs_batched(cbvs.norm_flux_array, cbvs.vect_store,
+                                       block_rows=block_rows, pool_size=pool_size, **kwargs)
+    # the columns follow the rows of vect_store
+    cbvs.fit_coeffs = {cbv_id: coeffs[:, k] for k, cbv_id in enumerate(cbv_order(cbvs))}
+
+def check_robust_engine(cbvs, n_check=100, seed=0, block_rows=256, **kwargs):
+    """
+    Compare the batched robust fits against cotrendy's per-star
+    calculate_robust_fit_coeffs_sequen for a random sample of stars
+
+    Parameters
+    ----------
+    cbvs : cotrendy.cbvs.CBVs
+        CBVs object with norm_flux_array, cbvs and vect_store set,
+        it is not changed
+    n_check : int
+        Number of stars to compare
+    seed : int
+        Seed for picking the sample
+    block_rows : int
+        Number of stars fitted together
+    kwargs : dict
+        IRLS options passed on to robust_fit_block
+
+    Returns
+    -------
+    max_diff : float
+        Largest difference in any coefficient, relative to the standard
+        deviation of cotrendy's coefficients for that CBV over the sample
+    """
+    sample = cbvs_sample(cbvs, sample_rows(len(cbvs.norm_flux_array), n_check, seed=seed))
+    sample.calculate_robust_fit_coeffs_sequen()
+    cbv_ids = cbv_order(cbvs)
+    reference = np.column_stack([np.asarray(sample.fit_coeffs[cbv_id], dtype=np.float64)
+                                 for cbv_id in cbv_ids])
+
+    coeffs = robust_fit_coeffs_batched(sample.norm_flux_array, cbvs.vect_store,
+                                       block_rows=block_rows, **kwargs)
+    spread = np.maximum(np.std(reference, axis=0), np.finfo(float).tiny)
+    return float(np.max(np.abs(coeffs - reference) / spread))
+
+def cotrend_ls_stream(flux, vect_store, cotrended_out, cotrending_out, chunk_rows=4096):
+    """
+    Least squares cotrend raw fluxes a chunk of stars at a time, from
+    normalisation through to the outputs. One set of chunk buffers is
+    reused throughout, so with memmapped inputs and outputs the peak
+    memory depends on chunk_rows rather than the number of stars.
+    Stars with NaN cadences are fitted on the rest and keep their NaNs.
+    Stars whose median flux is not positive, e.g. all NaN, cannot be
+    normalised, they are flagged and their outputs set to NaN
+
+    Parameters
+    ----------
+    flux : array-like
+        Raw fluxes, (n_stars, n_cadences), e.g. a memmap from the store
+    vect_store : array-like
+        CBVs, (n_cbvs, n_cadences)
+    cotrended_out : array-like
+        Output for the cotrended fluxes, in flux units
+    cotrending_out : array-like
+        Output for the CBV models, in normalised units
+    chunk_rows : int
+        Number of stars per chunk
+
+    Returns
+    -------
+    coeffs : array-like
+        Fit coefficients, (n_stars, n_cbvs)
+    bad : array-like
+        True for the stars that could not be normalised
+    """
+    n_stars, n_cadences = np.shape(flux)
+    Q, R = factorise_cbvs(vect_store)
+    coeffs = np.empty((n_stars, len(R)))
+    bad = np.zeros(n_stars, dtype=bool)
+    block = np.empty((min(chunk_rows, n_stars), n_cadences))
+    model = np.empty_like(block)
+
+    for i in range(0, n_stars, chunk_rows):
+        n = min(chunk_rows, n_stars - i)
+        b, m = block[:n], model[:n]
+
+        # normalise, norm_flux = (flux - median) / median, ignoring
+        # any NaN cadences in the median. Stars without a positive
+        # median are left as NaN rather than divided by zero
+        b[...] = flux[i:i+n]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            med = np.nanmedian(b, axis=1)[:, None]
+        unusable = ~(med[:, 0] > 0)
+        bad[i:i+n] = unusable
+        med[unusable] = np.nan
+        b[unusable] = np.nan
+        b -= med
+        b /= med
+
+        # stars with gaps are fitted on their finite cadences alone
+        coeffs[i:i+n], _ = fit_ls_block(b, Q, R, out=m)
+        cotrending_out[i:i+n] = m
+
+        # back to flux units, cotrended * median + median
+        b -= m
+        b *= med
+        b += med
+        cotrended_out[i:i+n] = b
+
+        # write each chunk out so the dirty pages do not pile up
+        for out in (cotrended_out, cotrending_out):
+            if isinstance(out, np.memmap):
+                out.flush()
+    return coeffs, bad
@@ -0,0 +1,277 @@
+"""
+Per-stage timing, memory and I/O instrumentation
+
+Each named stage of a script is timed and profiled, and the results
+are written as a JSON report next to the outputs so the reports of
+every CCD in a sector can be gathered up and compared. For each stage
+the report holds:
+
+    * the wall time, and the CPU time of this process and of any
+      child processes (pool workers, cp) reaped during the stage
+    * the peak RSS of this process during the stage. On Linux the
+      high water mark is reset at the start of each stage through
+      /proc/self/clear_refs, elsewhere it is the peak so far
+    * the largest peak RSS of any child process reaped so far
+    * the bytes read and written, from /proc/self/io. read_bytes and
+      write_bytes are what reached the storage layer, rchar and wchar
+      include reads served from the page cache. Writes through memory
+      maps, e.g. to the light curve store, only show in write_bytes
+      once the pages are flushed. Reaped child processes are included.
+      These are None if /proc is missing
+
+Stages should not be nested, as the peak RSS of the outer stage
+would be reset by the inner one
+
+Run as a script to summarise the reports of many CCDs, e.g.
+
+    python instrumentation.py /tess/.../lightcurves/S05_*/profile_*.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import resource
+import argparse as ap
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# pylint: disable=invalid-name
+
+PROFILE_VERSION = 1
+IO_FIELDS = ('read_bytes', 'write_bytes', 'rchar', 'wchar')
+
+def profile_filename(script):
+    """
+    Name of the instrumentation report of a script, e.g. profile_prepare.json
+    """
+    return f"profile_{script}.json"
+
+def _rss_units():
+    """
+    ru_maxrss is in kB on Linux and bytes on macOS, return bytes per unit
+    """
+    return 1 if sys.platform == 'darwin' else 1024
+
+def read_proc_io():
+    """
+    Bytes read and written by this process so far, from /proc/self/io
+
+    Returns
+    -------
+    io : dict | None
+        read_bytes, write_bytes, rchar and wchar, None if unavailable
+    """
+    try:
+        with open('/proc/self/io', 'r') as pf:
+            fields = dict(line.split(':') for line in pf if ':' in line)
+    except OSError:
+        return None
+    return {field: int(fields[field]) for field in IO_FIELDS}
+
+def read_peak_rss():
+    """
+    Peak RSS of this process in bytes, the VmHWM high water mark
+    where there is /proc, otherwise the lifetime peak from rusage
+    """
+    try:
+        with open('/proc/self/status', 'r') as pf:
+            for line in pf:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _rss_units()
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS high water mark, returns False where not supported
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as cf:
+            cf.write('5')
+    except OSError:
+        return False
+    return True
+
+class Instrumentation():
+    """
+    Collects a profile of each named stage of a script
+    """
+    def __init__(self, script, meta=None):
+        """
+        Initialise the class
+
+        Parameters
+        ----------
+        script : str
+            Name of the script, e.g. prepare, cotrend, store_output
+        meta : dict
+            Anything else to record, e.g. the sector and camera
+        """
+        self.script = script
+        self.meta = dict(meta or {})
+        self.stages = []
+        self.start = time.time()
+        self._wall0 = time.perf_counter()
+        self._active = None
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Profile a block of code as the named stage
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage, e.g. fits_ingestion
+        """
+        if self._active is not None:
+            raise RuntimeError(f"Cannot start stage {name} inside stage {self._active}")
+        self._active = name
+        reset = reset_peak_rss()
+        io0 = read_proc_io()
+        self_usage0 = resource.getrusage(resource.RUSAGE_SELF)
+        child_usage0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.time()
+        wall0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall0
+            self_usage = resource.getrusage(resource.RUSAGE_SELF)
+            child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            io = read_proc_io()
+            self.stages.append({
+                'name': name,
+                'start': datetime.fromtimestamp(start, timezone.utc).isoformat(),
+                'wall_time': wall,
+                'cpu_time': (self_usage.ru_utime - self_usage0.ru_utime) +
+                            (self_usage.ru_stime - self_usage0.ru_stime),
+                'children_cpu_time': (child_usage.ru_utime - child_usage0.ru_utime) +
+                                     (child_usage.ru_stime - child_usage0.ru_stime),
+                'peak_rss_mb': read_peak_rss() / 1024**2,
+                'peak_rss_is_stage_peak': reset,
+                'children_peak_rss_mb': child_usage.ru_maxrss * _rss_units() / 1024**2,
+                **{field: (io[field] - io0[field]) if io and io0 else None
+                   for field in IO_FIELDS}})
+            self._active = None
+
+    def report(self):
+        """
+        The profile of every stage so far, with totals for the script
+        """
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {'profile_version': PROFILE_VERSION,
+                'script': self.script,
+                'host': socket.gethostname(),
+                'pid': os.getpid(),
+                'start': datetime.fromtimestamp(self.start, timezone.utc).isoformat(),
+                **self.meta,
+                'total': {'wall_time': time.perf_counter() - self._wall0,
+                          'cpu_time': self_usage.ru_utime + self_usage.ru_stime,
+                          'children_cpu_time': child_usage.ru_utime + child_usage.ru_stime,
+                          'peak_rss_mb': self_usage.ru_maxrss * _rss_units() / 1024**2,
+                          'children_peak_rss_mb': child_usage.ru_maxrss * _rss_units() / 1024**2},
+                'stages': self.stages}
+
+    def write(self, filename=None):
+        """
+        Atomically write the report as JSON, by default to
+        profile_<script>.json in the working directory
+
+        Returns
+        -------
+        filename : str
+            Where the report was written
+        """
+        filename = filename or profile_filename(self.script)
+        tmp_file = f"{filename}.tmp"
+        with open(tmp_file, 'w') as pf:
+            json.dump(self.report(), pf, indent=2)
+        os.replace(tmp_file, filename)
+        return filename
+
+    def print_summary(self):
+        """
+        Print a table of the stages
+        """
+        print(f"{'stage':<28} {'wall (s)':>9} {'cpu (s)':>9} {'peak RSS (MB)':>14} "
+              f"{'rchar (MB)':>10} {'wchar (MB)':>12}")
+        for stage in self.stages:
+            read = f"{stage['rchar'] / 1024**2:.1f}" if stage['rchar'] is not None else "-"
+            written = f"{stage['wchar'] / 1024**2:.1f}" if stage['wchar'] is not None else "-"
+            print(f"{stage['name']:<28} {stage['wall_time']:>9.2f} "
+                  f"{stage['cpu_time'] + stage['children_cpu_time']:>9.2f} "
+                  f"{stage['peak_rss_mb']:>14.1f} {read:>10} {written:>12}")
+
+def summarise_reports(reports):
+    """
+    Totals and maxima of each stage of each script over many reports,
+    e.g. those of every CCD in a sector
+
+    Parameters
+    ----------
+    reports : list
+        Loaded instrumentation reports
+
+    Returns
+    -------
+    summary : dict
+        (script, stage) -> n_reports, total and max wall time, total
+        CPU time, max peak RSS, total rchar and wchar (bytes passed
+        to read and write calls, including any served from the page
+        cache) and the camera of the slowest report
+    """
+    summary = {}
+    for report in reports:
+        for stage in report['stages']:
+            row = summary.setdefault((report['script'], stage['name']),
+                                     {'n_reports': 0, 'total_wall_time': 0., 'max_wall_time': 0.,
+                                      'total_cpu_time': 0., 'max_peak_rss_mb': 0.,
+                                      'total_rchar': 0, 'total_wchar': 0,
+                                      'slowest': None})
+            row['n_reports'] += 1
+            row['total_wall_time'] += stage['wall_time']
+            row['total_cpu_time'] += stage['cpu_time'] + stage['children_cpu_time']
+            row['max_peak_rss_mb'] = max(row['max_peak_rss_mb'], stage['peak_rss_mb'])
+            row['total_rchar'] += stage['rchar'] or 0
+            row['total_wchar'] += stage['wchar'] or 0
+            if stage['wall_time'] >= row['max_wall_time']:
+                row['max_wall_time'] = stage['wall_time']
+                row['slowest'] = f"{report.get('sector')} {report.get('camera')}"
+    return summary
+
+def arg_parse():
+    """
+    Parse the command line arguments
+    """
+    p = ap.ArgumentParser(description='Summarise instrumentation reports over many CCDs')
+    p.add_argument('reports',
+                   help='profile_*.json reports to summarise',
+                   nargs='+')
+    p.add_argument('--output',
+                   help='also save the summary as JSON to this file')
+    return p.parse_args()
+
+if __name__ == "__main__":
+    args = arg_parse()
+    loaded = []
+    for report_file in args.reports:
+        with open(report_file, 'r') as rf:
+            loaded.append(json.load(rf))
+    stage_summary = summarise_reports(loaded)
+
+    print(f"{'script':<14} {'stage':<26} {'n':>4} {'total wall (s)':>15} {'max wall (s)':>13} "
+          f"{'max RSS (MB)':>13} {'rchar (GB)':>10} {'wchar (GB)':>13}  slowest")
+    for (script, name), row in sorted(stage_summary.items(),
+                                      key=lambda item: -item[1]['total_wall_time']):
+        print(f"{script:<14} {name:<26} {row['n_reports']:>4} {row['total_wall_time']:>15.1f} "
+              f"{row['max_wall_time']:>13.1f} {row['max_peak_rss_mb']:>13.1f} "
+              f"{row['total_rchar'] / 1024**3:>10.2f} "
+              f"{row['total_wchar'] / 1024**3:>13.2f}  {row['slowest']}")
+    if args.output:
+        with open(args.output, 'w') as of:
+            json.dump([dict(row, script=script, stage=name)
+                       for (script, name), row in stage_summary.items()], of, indent=2)
@@ -0,0 +1,466 @@
+"""
+On-disk storage for the light curve products handed to Cotrendy
+
+The products of the prepare step (times, fluxes, errors, object mask
+and catalog) are kept in a versioned store. The store is a directory
+of .npy files, one per array, described by a JSON manifest. Every array
+can be memory mapped, so consumers only read the rows they touch.
+
+Cotrendy still expects pickles, so small pointer pickles are written
+in their place. Depicklifying a pointer returns the matrix as a read
+only memory map.
+"""
+import os
+import json
+import hashlib
+import pickle
+from copy import deepcopy
+from datetime import datetime, timezone
+import numpy as np
+
+# pylint: disable=invalid-name
+
+STORE_FORMAT = "cotrending_tess_store"
+STORE_VERSION = 2
+MANIFEST_FILE = "manifest.json"
+INPUTS_FILE = "inputs.json"
+REPORT_FILE = "update_report.json"
+CATALOG_COLUMNS = ['ra', 'dec', 'mag', 'tic_id']
+
+class NpyPointer():
+    """
+    Pickles as a call to np.load, so unpickling it returns a
+    read only memory map of the .npy file rather than the object
+
+    The filename is resolved relative to the working directory
+    when unpickled, i.e. the data root used by the scripts
+    """
+    def __init__(self, filename):
+        """
+        Initialise the class
+        """
+        self.filename = filename
+
+    def __reduce__(self):
+        """
+        Unpickle as np.load(filename, mmap_mode='r')
+        """
+        return (np.load, (self.filename, 'r'))
+
+class LightcurveStore():
+    """
+    A directory of memory mappable .npy arrays plus a JSON manifest
+    """
+    def __init__(self, directory, mode='r'):
+        """
+        Open an existing store
+
+        Parameters
+        ----------
+        directory : str
+            Path to the store directory
+        mode : str
+            Memory map mode for the arrays, 'r' or 'r+'
+        """
+        self.directory = directory
+        self.mode = mode
+        manifest_file = os.path.join(directory, MANIFEST_FILE)
+        with open(manifest_file, 'r') as mf:
+            self.manifest = json.load(mf)
+
+        if self.manifest.get('format') != STORE_FORMAT:
+            raise ValueError(f"{directory} is not a light curve store")
+        if self.manifest.get('version') != STORE_VERSION:
+            raise ValueError(f"{directory} has store version {self.manifest.get('version')}, "
+                             f"expected {STORE_VERSION}")
+        self._arrays = {}
+
+    @classmethod
+    def create(cls, directory):
+        """
+        Make a new, empty store. Any existing manifest
+        is replaced when the new store is flushed
+
+        Parameters
+        ----------
+        directory : str
+            Path to the store directory
+
+        Returns
+        -------
+        store : LightcurveStore
+            Writeable store
+        """
+        os.makedirs(directory, exist_ok=True)
+        store = cls.__new__(cls)
+        store.directory = directory
+        store.mode = 'r+'
+        store.manifest = {'format': STORE_FORMAT,
+                          'version': STORE_VERSION,
+                          'created': datetime.now(timezone.utc).isoformat(),
+                          'arrays': {}}
+        store._arrays = {}
+        return store
+
+    def path(self, name):
+        """
+        Path to the .npy file for a named array
+        """
+        return os.path.join(self.directory, f"{name}.npy")
+
+    def add_array(self, name, shape, dtype=np.float64):
+        """
+        Preallocate a named array on disk and return
+        it as a writeable memory map
+
+        Parameters
+        ----------
+        name : str
+            Name of the array, e.g. flux
+        shape : tuple
+            Shape of the array, e.g. (n_stars, n_cadences)
+        dtype : np.dtype
+            Data type of the array
+
+        Returns
+        -------
+        array : np.memmap
+            Writeable memory map of the array
+        """
+        array = np.lib.format.open_memmap(self.path(name), mode='w+',
+                                          dtype=dtype, shape=tuple(shape))
+        self._register(name, array)
+        return array
+
+    def write_array(self, name, data):
+        """
+        Write a small, in memory, array to the store
+
+        Parameters
+        ----------
+        name : str
+            Name of the array
+        data : array-like
+            Array to store
+        """
+        data = np.asarray(data)
+        np.save(self.path(name), data)
+        self._register(name, data)
+
+    def _register(self, name, array):
+        """
+        Record an array in the manifest
+        """
+        self.manifest['arrays'][name] = {'file': f"{name}.npy",
+                                         'shape': list(array.shape),
+                                         'dtype': np.dtype(array.dtype).str}
+        self._arrays[name] = array
+
+    def __contains__(self, name):
+        return name in self.manifest['arrays']
+
+    def __getitem__(self, name):
+        """
+        Return a named array as a memory map, opened lazily
+        """
+        if name not in self._arrays:
+            if name not in self:
+                raise KeyError(f"No array {name} in store {self.directory}")
+            self._arrays[name] = np.load(self.path(name), mmap_mode=self.mode)
+        return self._arrays[name]
+
+    def rows(self, name, row_mask):
+        """
+        Read a subset of rows from a named array, e.g. the CBV
+        stars, without touching the rest of the array on disk
+
+        Parameters
+        ----------
+        name : str
+            Name of the array
+        row_mask : array-like
+            Boolean mask or integer indices of the rows to read
+
+        Returns
+        -------
+        rows : array-like
+            In memory copy of the requested rows
+        """
+        return np.asarray(self[name][row_mask])
+
+    def catalog_column(self, column):
+        """
+        Return a column of the catalog (ra, dec, mag or tic_id)
+        """
+        return self['catalog'][CATALOG_COLUMNS.index(column)]
+
+    def flush(self):
+        """
+        Flush any writeable arrays and write the manifest
+        """
+        for array in self._arrays.values():
+            if isinstance(array, np.memmap):
+                array.flush()
+
+        self._write_json(MANIFEST_FILE, self.manifest)
+
+    def read_inputs(self):
+        """
+        Load the input manifest, filename -> size, mtime_ns,
+        sha1 and row. Empty if the store has no input manifest
+        """
+        inputs_file = os.path.join(self.directory, INPUTS_FILE)
+        if not os.path.exists(inputs_file):
+            return {}
+        with open(inputs_file, 'r') as inf:
+            return json.load(inf)
+
+    def write_inputs(self, inputs):
+        """
+        Save the input manifest, see read_inputs
+        """
+        self._write_json(INPUTS_FILE, inputs)
+
+    def inputs_key(self):
+        """
+        Hash of the contents of the store, from the input manifest
+        (the row and content hash of every light curve), the cadence
+        mask, apertures and precision. It changes whenever the prepare
+        step changes any row, so anything made from the store can be
+        tied to it
+        """
+        inputs = self.read_inputs()
+        parts = {'inputs': sorted((info['row'], info['sha1']) for info in inputs.values()),
+                 'mask_sha1': self.manifest.get('mask_sha1'),
+                 'apertures': self.manifest.get('apertures'),
+                 'precision': self.manifest.get('precision', "float64")}
+        return hashlib.sha1(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def read_report(self, filename=REPORT_FILE):
+        """
+        Load a report from the store, by default the update report of
+        the prepare step. Empty if there is no such report
+        """
+        report_file = os.path.join(self.directory, filename)
+        if not os.path.exists(report_file):
+            return {}
+        with open(report_file, 'r') as rf:
+            return json.load(rf)
+
+    def write_report(self, report, filename=REPORT_FILE):
+        """
+        Save a report to the store, by default the rows added,
+        removed and updated by the last run of the prepare step
+        """
+        self._write_json(filename, report)
+
+    def _write_json(self, filename, obj):
+        """
+        Atomically write a JSON file into the store directory
+        """
+        json_file = os.path.join(self.directory, filename)
+        tmp_file = f"{json_file}.tmp"
+        with open(tmp_file, 'w') as jf:
+            json.dump(obj, jf, indent=2)
+        os.replace(tmp_file, json_file)
+
+    def write_pointers(self, config):
+        """
+        Write the pointer pickles named in the config so
+        Cotrendy loads the store arrays as memory maps
+
+        Parameters
+        ----------
+        config : dict
+            Cotrendy configuration
+        """
+        pointers = {config['data']['time_file']: 'times',
+                    config['data']['objects_mask_file']: 'objects_mask',
+                    config['catalog']['input_cat_file']: 'catalog'}
+        for aperture in config_apertures(config):
+            ap_config = aperture_config(config, aperture)
+            pointers[ap_config['data']['flux_file']] = f"flux_{aperture}"
+            pointers[ap_config['data']['error_file']] = f"error_{aperture}"
+
+        for pickle_file, name in pointers.items():
+            picklify_pointer(pickle_file, self.path(name))
+
+def store_dirname(config):
+    """
+    Name of the light curve store directory for a config
+
+    Parameters
+    ----------
+    config : dict
+        Cotrendy configuration
+
+    Returns
+    -------
+    store_dir : str
+        Store directory, relative to the data root
+    """
+    timeslot = config['global']['timeslot']
+    camera_id = config['global']['camera_id']
+    return config['data'].get('store_dir', f"tess_{timeslot}_{camera_id}_store")
+
+def config_apertures(config):
+    """
+    List of aperture columns to cotrend, e.g. ['AP2.5']
+    """
+    return list(config['data'].get('apertures', ['AP2.5']))
+
+def config_precision(config):
+    """
+    dtype the large per-star arrays are stored and moved as,
+    float64 by default or float32 to halve memory and I/O
+    """
+    precision = config['data'].get('precision', "float64")
+    if precision not in ("float32", "float64"):
+        raise ValueError(f"Unknown precision {precision}, expected float32 or float64")
+    return np.dtype(precision)
+
+def aperture_filename(filename, aperture):
+    """
+    Add an aperture suffix to a filename
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file, e.g. tess_S05_1-1_fluxes.pkl
+    aperture : str
+        Aperture column, e.g. AP2.5
+
+    Returns
+    -------
+    aperture_file : str
+        Name of the file for this aperture,
+        e.g. tess_S05_1-1_fluxes_AP2.5.pkl
+    """
+    base, ext = os.path.splitext(filename)
+    return f"{base}_{aperture}{ext}"
+
+def aperture_config(config, aperture):
+    """
+    Copy of the config pointing at the flux, error and CBV files
+    for one aperture. Names only get an aperture suffix when more
+    than one aperture is cotrended, so single aperture runs keep
+    the file names given in the config
+
+    Parameters
+    ----------
+    config : dict
+        Cotrendy configuration
+    aperture : str
+        Aperture column, e.g. AP2.5
+
+    Returns
+    -------
+    ap_config : dict
+        Cotrendy configuration for this aperture
+    """
+    ap_config = deepcopy(config)
+    if len(config_apertures(config)) > 1:
+        for key in ('flux_file', 'error_file', 'cbv_file', 'cbv_product_file',
+                    'checkpoint_dir', 'map_status_file', 'map_latency_file',
+                    'map_journal_dir'):
+            if key in config['data']:
+                ap_config['data'][key] = aperture_filename(config['data'][key], aperture)
+    return ap_config
+
+def file_stats(filename, digest=True):
+    """
+    Size, modification time and (optionally) content hash of a file
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file
+    digest : boolean | callable
+        Hash the file contents too? A callable is given the filename
+        and returns the hash, e.g. of only the columns that are read
+
+    Returns
+    -------
+    stats : dict
+        size, mtime_ns and sha1 (None if digest is False)
+    """
+    st = os.stat(filename)
+    stats = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': None}
+    if callable(digest):
+        stats['sha1'] = digest(filename)
+    elif digest:
+        sha1 = hashlib.sha1()
+        with open(filename, 'rb') as ff:
+            for block in iter(lambda: ff.read(1 << 20), b''):
+                sha1.update(block)
+        stats['sha1'] = sha1.hexdigest()
+    return stats
+
+def array_digest(array):
+    """
+    Content hash of an in memory array, e.g. the cadence mask
+    """
+    array = np.ascontiguousarray(array)
+    return hashlib.sha1(array.tobytes() + str(array.dtype).encode()).hexdigest()
+
+def plan_update(inputs, filenames, digest=True):
+    """
+    Compare the input files of a store against a new list
+    of files and work out which need reading again
+
+    Files whose size and mtime are unchanged are trusted without
+    hashing. Otherwise the content hash decides if they changed.
+    Files that only changed elsewhere, e.g. the cotrended columns
+    written back to them, keep their rows and get their new stats
+
+    Parameters
+    ----------
+    inputs : dict
+        Input manifest of the existing store, filename -> stats and row
+    filenames : list
+        Input files for the new store, in row order
+    digest : boolean | callable
+        Content hash, see file_stats. Must match the one the
+        manifest was made with
+
+    Returns
+    -------
+    plan : dict
+        Lists of filenames that were added, updated, removed
+        and unchanged, plus the stats of the unchanged files
+    """
+    plan = {'added': [], 'updated': [], 'removed': [], 'unchanged': [], 'stats': {}}
+    for filename in filenames:
+        old = inputs.get(filename)
+        if old is None:
+            plan['added'].append(filename)
+            continue
+
+        stats = file_stats(filename, digest=False)
+        if stats['size'] == old['size'] and stats['mtime_ns'] == old['mtime_ns']:
+            stats['sha1'] = old['sha1']
+        else:
+            stats = file_stats(filename, digest=digest)
+            if stats['sha1'] != old['sha1']:
+                plan['updated'].append(filename)
+                continue
+        plan['unchanged'].append(filename)
+        plan['stats'][filename] = stats
+
+    new_files = set(filenames)
+    plan['removed'] = [filename for filename in inputs if filename not in new_files]
+    return plan
+
+def picklify_pointer(pickle_file, npy_file):
+    """
+    Write a pointer pickle for a .npy matrix
+
+    Parameters
+    ----------
+    pickle_file : str
+        Name of the pickle file to write
+    npy_file : str
+        Name of the .npy file to point to
+    """
+    with open(pickle_file, 'wb') as pf:
+        pickle.dump(NpyPointer(npy_file), pf)
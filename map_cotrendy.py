@@ -0,0 +1,423 @@
+"""
+cotrendy's own MAP cotrending, with its inputs in shared memory
+
+cotrendy's cotrend_data_map_mp fits every star with its own MAP code
+in a multiprocessing pool, and the CBVs object and catalog go to the
+workers with each task. Pickled, every large array in them (the
+normalised fluxes, the light curves, the fit coefficients, the
+variability, the catalog columns) is copied to every worker, so the
+memory grows with pool_size
+
+Here those arrays are moved into multiprocessing.shared_memory for the
+length of the cotrend_data_map_mp call, as SharedNDArray views. A
+SharedNDArray pickles as the name of its block and its place in it, not
+its data, so a worker unpickling the CBVs object maps the same pages
+rather than getting a copy. cotrendy's MAP code itself is unchanged:
+its grid, priors, PDFs and results are exactly those of a plain run.
+Arrays made from the shared ones, e.g. by arithmetic, are ordinary
+arrays and pickle as usual
+
+For the same call cotrendy's Pool is swapped for a TrackedPool, whose
+map calls time each task (one star) in the worker for the MAP telemetry
+and, with map_journal_dir set, journal each result in the parent as it
+comes back, see map_telemetry.py and map_journal.py. A rerun with the
+same inputs hands the journaled results straight back to cotrendy and
+only sends the missing stars to the workers. The tasks still run
+cotrendy's own code, so the results are unchanged
+"""
+import os
+import sys
+import time
+import math
+import contextlib
+import multiprocessing
+import multiprocessing.pool
+from functools import partial
+from multiprocessing import shared_memory
+import numpy as np
+from lc_store import array_digest
+from map_telemetry import MapTelemetry
+from map_journal import TaskJournal, journal_key, task_journal_key
+from fitting import cbv_order
+from map_fit import prior_weight
+
+# pylint: disable=invalid-name
+
+# arrays smaller than this are left alone, they cost little to copy
+SHARE_MIN_BYTES = 1 << 20
+
+# cotrend options that do not change the MAP fits, left out of the journal key
+UNKEYED_OPTIONS = ('pool_size', 'map_status_interval', 'map_slow_factor',
+                   'map_journal_fsync_interval', 'map_star_latency', 'test_stars')
+
+try:
+    byte_bounds = np.lib.array_utils.byte_bounds
+except AttributeError:
+    byte_bounds = np.byte_bounds
+
+# the blocks this process has made or attached to, by name
+_blocks = {}
+
+def _block_address(block):
+    """
+    Address of the start of a shared memory block in this process
+    """
+    return np.frombuffer(block.buf, dtype=np.uint8).__array_interface__['data'][0]
+
+def _shared_view(name, offset, shape, strides, dtype):
+    """
+    Rebuild a pickled SharedNDArray, attaching to its block the first
+    time it is seen. Arrays unpickled by a worker are read only
+    """
+    block = _blocks.get(name)
+    if block is None:
+        block = _blocks[name] = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset,
+                       strides=strides).view(SharedNDArray)
+    array.block = (name, _block_address(block), block.size)
+    array.flags.writeable = False
+    return array
+
+class SharedNDArray(np.ndarray):
+    """
+    A numpy array, or a view of one, held in a shared memory block. It
+    pickles as a reference to the block rather than a copy of its data
+    """
+    def __array_finalize__(self, obj):
+        # views and results alike inherit the block, __reduce_ex__
+        # checks the data really lies inside it before using it
+        self.block = getattr(obj, 'block', None)
+
+    def __reduce_ex__(self, protocol):
+        if self.block is not None:
+            name, address, size = self.block
+            lo, hi = byte_bounds(self)
+            if address <= lo and hi <= address + size:
+                start = self.__array_interface__['data'][0]
+                return (_shared_view, (name, start - address, self.shape,
+                                       self.strides, self.dtype.str))
+        return np.asarray(self).__reduce_ex__(protocol)
+
+    def __reduce__(self):
+        return self.__reduce_ex__(2)
+
+def _share(array):
+    """
+    Copy an array into a new shared memory block
+
+    Returns
+    -------
+    shared : SharedNDArray
+        The copy, writeable in this process
+    block : SharedMemory
+        Its block, for freeing it later
+    """
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    _blocks[block.name] = block
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf).view(SharedNDArray)
+    shared.block = (block.name, _block_address(block), block.size)
+    shared[...] = array
+    return shared, block
+
+def _shareable(value):
+    """
+    Is this a numeric array worth sharing?
+    """
+    return isinstance(value, np.ndarray) and not isinstance(value, SharedNDArray) and \
+        value.dtype.kind in 'biufc' and value.ndim > 0
+
+def _stackable(values):
+    """
+    Can these arrays go in one block as the rows of a stacked array?
+    """
+    return len(values) > 0 and all(_shareable(value) for value in values) and \
+        len({(value.shape, value.dtype.str) for value in values}) == 1
+
+class _Moved():
+    """
+    One attribute moved into shared memory, and how to put it back
+    """
+    def __init__(self, owner, name, original, replacement, shared):
+        self.owner = owner
+        self.name = name
+        self.original = original
+        self.replacement = replacement
+        self.shared = shared
+
+    def restore(self):
+        """
+        Put the original back, unless the attribute has been set to
+        something else since. Any change made to the shared copy in
+        place is copied back first
+        """
+        if getattr(self.owner, self.name, None) is not self.replacement:
+            return
+        if isinstance(self.original, dict):
+            for key, value in self.original.items():
+                _copy_back(value, self.replacement[key])
+        else:
+            _copy_back(self.original, self.shared)
+        setattr(self.owner, self.name, self.original)
+
+def _copy_back(original, shared):
+    """
+    Copy any in place change of a shared copy back to its original
+    """
+    if not np.array_equal(original, shared, equal_nan=original.dtype.kind in 'fc'):
+        np.copyto(original, shared)
+
+def _move_attributes(obj, min_bytes, moved, blocks):
+    """
+    Move the large array attributes of one object into shared memory:
+    arrays, dicts of arrays (e.g. fit_coeffs) stacked into one block,
+    and for a list of objects (e.g. the light curves) each array
+    attribute they all have stacked into one block
+    """
+    for name, value in list(vars(obj).items()):
+        if _shareable(value) and value.nbytes >= min_bytes:
+            shared, block = _share(value)
+            blocks.append(block)
+            setattr(obj, name, shared)
+            moved.append(_Moved(obj, name, value, shared, shared))
+        elif isinstance(value, dict) and _stackable(list(value.values())) and \
+                sum(v.nbytes for v in value.values()) >= min_bytes:
+            shared, block = _share(np.stack(list(value.values())))
+            blocks.append(block)
+            replacement = dict(zip(value.keys(), shared))
+            setattr(obj, name, replacement)
+            moved.append(_Moved(obj, name, value, replacement, shared))
+        elif isinstance(value, list) and value and all(hasattr(item, '__dict__') for item in value):
+            for attr in vars(value[0]):
+                values = [getattr(item, attr, None) for item in value]
+                if not _stackable(values) or sum(v.nbytes for v in values) < min_bytes:
+                    continue
+                shared, block = _share(np.stack(values))
+                blocks.append(block)
+                for item, original, row in zip(value, values, shared):
+                    setattr(item, attr, row)
+                    moved.append(_Moved(item, attr, original, row, row))
+
+@contextlib.contextmanager
+def shared_attributes(objects, min_bytes=SHARE_MIN_BYTES):
+    """
+    Move the large array attributes of some objects into shared memory
+    for as long as the context is open. Afterwards the original arrays
+    are put back, with any change made to them in place, and the blocks
+    are freed
+
+    Parameters
+    ----------
+    objects : list
+        Objects whose attributes are shared, e.g. the CBVs and catalog
+    min_bytes : int
+        Arrays smaller than this are left alone
+
+    Yields
+    ------
+    n_bytes : int
+        Total size of the shared blocks
+    """
+    moved, blocks = [], []
+    try:
+        for obj in objects:
+            _move_attributes(obj, min_bytes, moved, blocks)
+        yield sum(block.size for block in blocks)
+    finally:
+        for entry in reversed(moved):
+            entry.restore()
+        for block in blocks:
+            _blocks.pop(block.name, None)
+            block.close()
+            block.unlink()
+
+def _timed_task(func, star, indexed_task):
+    """
+    Run one task of a TrackedPool in a worker, timing it
+
+    Returns
+    -------
+    index : int
+        Index of the task in the map call
+    result : object
+        What func returned
+    pid : int
+        Process id of the worker
+    busy : float
+        Seconds the task took
+    """
+    index, task = indexed_task
+    start = time.perf_counter()
+    result = func(*task) if star else func(task)
+    return index, result, os.getpid(), time.perf_counter() - start
+
+class MapPoolTracker():
+    """
+    Telemetry and journal of the map calls of a TrackedPool
+    """
+    def __init__(self, status_file=None, interval=10., slow_factor=10.,
+                 journal_dir=None, key=None, fsync_interval=30.):
+        """
+        Initialise the class
+
+        Parameters
+        ----------
+        status_file : str | None
+            JSON file rewritten with the progress, see MapTelemetry
+        interval : float
+            Seconds between updates of the status
+        slow_factor : float
+            Tasks slower than this many times the median are flagged
+        journal_dir : str | None
+            Directory of the TaskJournal, None to not journal
+        key : str
+            Key of the fit inputs, see journal_key
+        fsync_interval : float
+            Seconds between forcing the journal to disk
+        """
+        self.status_file = status_file
+        self.interval = interval
+        self.slow_factor = slow_factor
+        self.journal_dir = journal_dir
+        self.key = key
+        self.fsync_interval = fsync_interval
+        self.telemetry = None
+
+    def run(self, pool, func, iterable, chunksize=None, star=False):
+        """
+        Map func over the tasks with the pool, skipping those in the
+        journal, recording the time of each and journaling its result
+
+        Returns
+        -------
+        results : list
+            Result of each task, in order
+        """
+        tasks = list(iterable)
+        results = [None] * len(tasks)
+        self.telemetry = MapTelemetry(len(tasks), status_file=self.status_file,
+                                      interval=self.interval, slow_factor=self.slow_factor)
+        journal = None
+        if self.journal_dir:
+            journal = TaskJournal(self.journal_dir, task_journal_key(self.key, func, tasks),
+                                  fsync_interval=self.fsync_interval)
+        try:
+            done = journal.load() if journal is not None else {}
+            for index, result in done.items():
+                results[index] = result
+            if done:
+                self.telemetry.resume(len(done))
+                print(f"MAP: resuming from the journal, {len(done)} stars already fitted")
+            todo = [(index, task) for index, task in enumerate(tasks) if index not in done]
+            # the chunks multiprocessing's map would use
+            chunksize = chunksize or max(1, math.ceil(len(todo) / (4 * pool.n_processes)))
+            for index, result, pid, busy in multiprocessing.pool.Pool.imap_unordered(
+                    pool, partial(_timed_task, func, star), todo, chunksize):
+                results[index] = result
+                self.telemetry.record({'pid': pid, 'busy': busy, 'rows': [index],
+                                       'latency': busy})
+                if journal is not None:
+                    journal.append(index, result)
+        finally:
+            if journal is not None:
+                journal.close()
+        return results
+
+class TrackedPool(multiprocessing.pool.Pool):
+    """
+    A multiprocessing pool whose map calls are timed and journaled by
+    a MapPoolTracker. The results come back all at once, in order
+    """
+    def __init__(self, *args, tracker=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tracker = tracker
+        self.n_processes = self._processes
+
+    def map(self, func, iterable, chunksize=None):
+        return self.tracker.run(self, func, iterable, chunksize)
+
+    def starmap(self, func, iterable, chunksize=None):
+        return self.tracker.run(self, func, iterable, chunksize, star=True)
+
+    def imap(self, func, iterable, chunksize=1):
+        return iter(self.map(func, iterable, chunksize))
+
+    def imap_unordered(self, func, iterable, chunksize=1):
+        return iter(self.map(func, iterable, chunksize))
+
+@contextlib.contextmanager
+def tracked_pools(modules, tracker):
+    """
+    Swap the Pool of some modules, and multiprocessing.Pool, for a
+    TrackedPool for as long as the context is open
+    """
+    pool = partial(TrackedPool, tracker=tracker)
+    patched = [(module, module.Pool) for module in modules if hasattr(module, 'Pool')]
+    patched.append((multiprocessing, multiprocessing.Pool))
+    try:
+        for module, _ in patched:
+            module.Pool = pool
+        yield
+    finally:
+        for module, original in reversed(patched):
+            module.Pool = original
+
+def catalog_digest(catalog):
+    """
+    Content hash of the numeric array attributes of a catalog
+    """
+    return {name: array_digest(value) for name, value in sorted(vars(catalog).items())
+            if isinstance(value, np.ndarray) and value.dtype.kind in 'biufc'}
+
+def cotrend_data_map_cotrendy(cbvs, catalog, config, tic_ids=None):
+    """
+    Run cotrendy's cotrend_data_map_mp with the large arrays of the
+    CBVs object and catalog shared with its workers, not copied to
+    them. Its pool reports the progress and the latency of each star
+    as the kde engine does, and with map_journal_dir set the finished
+    stars are journaled and a rerun picks up where it stopped
+
+    Parameters
+    ----------
+    cbvs : cotrendy.cbvs.CBVs
+        CBVs object with the CBVs, variability and fit_coeffs set
+    catalog : cotrendy.catalog.Catalog
+        Catalog of every star, in the same order as the fluxes
+    config : dict
+        Cotrendy configuration
+    tic_ids : array-like
+        TIC id of every star, for flagging the slow stars
+    """
+    cotrend = config['cotrend']
+    key = None
+    if config['data'].get('map_journal_dir'):
+        fit_coeffs = np.column_stack([cbvs.fit_coeffs[cbv_id] for cbv_id in cbv_order(cbvs)])
+        options = {option: value for option, value in cotrend.items()
+                   if option not in UNKEYED_OPTIONS}
+        # cotrendy finds the neighbours from its own catalog
+        key = journal_key(cbvs.vect_store, fit_coeffs, cbvs.variability, None,
+                          dict(options, catalog=catalog_digest(catalog)))
+    tracker = MapPoolTracker(status_file=config['data'].get('map_status_file'),
+                             interval=cotrend.get('map_status_interval', 10.),
+                             slow_factor=cotrend.get('map_slow_factor', 10.),
+                             journal_dir=config['data'].get('map_journal_dir'), key=key,
+                             fsync_interval=cotrend.get('map_journal_fsync_interval', 30.))
+
+    with shared_attributes([cbvs, catalog]) as n_bytes, \
+            tracked_pools([sys.modules[type(cbvs).__module__]], tracker):
+        print(f"MAP: {n_bytes / 2**20:.0f} MB of inputs shared with cotrendy's MAP workers")
+        cbvs.cotrend_data_map_mp(catalog)
+
+    telemetry = tracker.telemetry
+    if telemetry is None:
+        print("MAP: cotrendy did not map its stars over a Pool, "
+              "so there is no telemetry or journal for this run")
+        return
+    n_stars = len(cbvs.variability)
+    per_star = telemetry.n_stars == n_stars
+    telemetry.finish(tic_ids=tic_ids if per_star else None,
+                     variability=cbvs.variability if per_star else None,
+                     prior_weight=prior_weight(cbvs.variability,
+                                               cotrend['prior_normalised_variability_limit'])
+                     if per_star else None,
+                     test_stars=cotrend.get('test_stars', []),
+                     latency_file=config['data'].get('map_latency_file'))
@@ -0,0 +1,1035 @@
+"""
+A separate, shared memory MAP engine, map_engine = "kde"
+
+This is not cotrendy's MAP. It is a simpler model of its own, with its
+own coefficient grids, prior and prior weight, and its results are not
+expected to match cotrendy's cotrend_data_map_mp star for star. Before
+it is used, check_map_engine runs both on the test stars and their
+neighbours and the run stops if they differ by more than MAP_TOLERANCE.
+cotrendy's own MAP, the default, runs with its inputs shared between
+the workers as well, see map_cotrendy.py
+
+The large read-only arrays (fluxes, variability, fit coefficients,
+CBVs, catalog coordinates) and the outputs are put in
+multiprocessing.shared_memory once. The workers attach to them by name
+and are only sent blocks of star indices, so memory stays near one copy
+whatever the pool size
+
+For each star the MAP fit is made per CBV on a grid of coefficients:
+
+    * the conditional PDF is a Gaussian centred on the least squares
+      coefficient, with the width from the fit residuals
+    * the prior PDF is a weighted Gaussian KDE of the robust fit
+      coefficients of the prior_n_neighbours nearest stars in
+      (ra, dec, mag), each scaled by its spread and by dim_weights,
+      optionally only those within prior_radius. The neighbours come
+      from a KD-tree built once on the scaled coordinates and are
+      shared with the workers, so finding them is O(N log N). This is
+      for this engine only: cotrendy picks its own prior stars inside
+      cotrend_data_map_mp, and map_engine = "cotrendy" leaves that as is
+    * the prior weight is 0 for stars with a normalised variability
+      below prior_normalised_variability_limit, which are fitted with
+      plain LS, and 1 - limit / variability above it
+    * the posterior peak, log(cond) + weight * log(prior), gives
+      the coefficient for each CBV
+
+The coefficient grids are cotrendy's own, cbvs.theta, when the CBVs
+object has them, and otherwise are made by theta_grids. With
+map_theta_mode = "adaptive" the PDFs are not evaluated over the whole
+grid. Each peak is found coarse to fine, refining only near it, and
+snapped to the grid. Before the run check_adaptive compares this with
+the full grid evaluation on some stars, and the run stops if any peak
+moves by more than ADAPTIVE_TOLERANCE grid steps. Like the rest of
+this module, this applies to map_engine = "kde" only
+
+With a MapJournal the finished stars are journaled as the blocks come
+back, see map_journal.py, and a rerun only fits the missing stars
+"""
+import os
+import copy
+import time
+from types import SimpleNamespace
+from multiprocessing import Pool, shared_memory
+import numpy as np
+from scipy.linalg import solve_triangular
+from scipy.spatial import cKDTree
+from fitting import factorise_cbvs, fit_ls_block, cbv_order, cbvs_sample, sample_rows
+from lc_store import config_precision, array_digest
+from map_telemetry import MapTelemetry
+from map_journal import MapJournal, journal_key, STATUS_MAP, STATUS_LS
+
+# pylint: disable=invalid-name
+
+# the engine's MAP coefficients must agree with cotrendy's to within this
+# fraction of the spread of each CBV's robust fit coefficients over the
+# stars, see check_map_engine
+MAP_TOLERANCE = 0.1
+
+# weights of the scaled (ra, dec, mag) coordinates when dim_weights is not
+# set, the same as the config template
+DEFAULT_DIM_WEIGHTS = [1, 1, 2]
+
+# the adaptive peaks must lie within this many grid steps of the
+# full grid peaks, see check_adaptive
+ADAPTIVE_TOLERANCE = 1
+
+class SharedArrays():
+    """
+    A set of named numpy arrays in shared memory blocks
+    """
+    def __init__(self, specs, blocks, owner=False):
+        """
+        Initialise the class, use SharedArrays.create or
+        SharedArrays.attach rather than calling this directly
+        """
+        self.specs = specs
+        self._blocks = blocks
+        self._owner = owner
+        self.arrays = {name: np.ndarray(shape, dtype=dtype, buffer=blocks[name].buf)
+                       for name, (_, shape, dtype) in specs.items()}
+
+    @classmethod
+    def create(cls, arrays):
+        """
+        Copy arrays into new shared memory blocks
+
+        Parameters
+        ----------
+        arrays : dict
+            Name -> array-like to share. A (shape, dtype) tuple
+            allocates an uninitialised array instead, e.g. for outputs
+
+        Returns
+        -------
+        shared : SharedArrays
+            The shared arrays, owned by this process
+        """
+        specs, blocks, sources = {}, {}, {}
+        for name, array in arrays.items():
+            if isinstance(array, tuple):
+                shape, dtype = array
+            else:
+                array = np.asarray(array)
+                shape, dtype = array.shape, array.dtype
+                sources[name] = array
+            nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+            blocks[name] = shared_memory.SharedMemory(create=True, size=nbytes)
+            specs[name] = (blocks[name].name, tuple(shape), np.dtype(dtype).str)
+        shared = cls(specs, blocks, owner=True)
+        for name, array in sources.items():
+            shared.arrays[name][...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, specs):
+        """
+        Attach to shared arrays made in another process
+
+        Parameters
+        ----------
+        specs : dict
+            Name -> (block name, shape, dtype), from SharedArrays.specs
+        """
+        blocks = {name: shared_memory.SharedMemory(name=block_name)
+                  for name, (block_name, _, _) in specs.items()}
+        return cls(specs, blocks)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def close(self):
+        """
+        Drop the views and close the blocks, the owner also
+        frees them. Copy anything needed out first
+        """
+        self.arrays = {}
+        for block in self._blocks.values():
+            block.close()
+            if self._owner:
+                block.unlink()
+        self._blocks = {}
+
+def theta_grids(fit_coeffs, n_theta=500, pad=0.5):
+    """
+    Grid of trial coefficients for each CBV, spanning the bulk of the
+    robust fit coefficients, padded by a fraction of their range
+
+    Parameters
+    ----------
+    fit_coeffs : array-like
+        Robust fit coefficients, (n_stars, n_cbvs)
+    n_theta : int
+        Number of grid points
+    pad : float
+        Fraction of the range added either side
+
+    Returns
+    -------
+    theta : array-like
+        Grids of coefficients, (n_cbvs, n_theta)
+    """
+    lo, hi = np.nanpercentile(fit_coeffs, [0.5, 99.5], axis=0)
+    span = np.maximum(hi - lo, np.finfo(float).eps)
+    return np.linspace(lo - pad*span, hi + pad*span, n_theta, axis=1)
+
+def cotrendy_theta(cbvs, cbv_ids):
+    """
+    cotrendy's coefficient grids from a CBVs object, if it has them
+
+    Parameters
+    ----------
+    cbvs : cotrendy.cbvs.CBVs
+        CBVs object, theta is CBV id -> grid when cotrendy has set it
+    cbv_ids : list
+        CBV ids, in the order of the vect_store rows
+
+    Returns
+    -------
+    theta : array-like | None
+        Grids of coefficients, (n_cbvs, n_theta), or None if there
+        are none, or they are not evenly spaced grids of one length
+    """
+    grids = getattr(cbvs, 'theta', None)
+    if not isinstance(grids, dict) or any(cbv_id not in grids for cbv_id in cbv_ids):
+        return None
+    grids = [np.asarray(grids[cbv_id], dtype=np.float64) for cbv_id in cbv_ids]
+    if len({grid.shape for grid in grids}) != 1 or grids[0].ndim != 1 or len(grids[0]) < 2:
+        return None
+    theta = np.vstack(grids)
+    steps = np.diff(theta, axis=1)
+    if not np.allclose(steps, steps[:, :1]) or np.any(steps[:, 0] <= 0):
+        return None
+    return theta
+
+def scaled_coordinates(ra, dec, mag, dim_weights):
+    """
+    Catalog coordinates scaled by their spread and dim_weights,
+    so the neighbour distances are comparable between dimensions
+    """
+    coords = np.column_stack([ra, dec, mag]).astype(np.float64)
+    spread = np.std(coords, axis=0)
+    spread[spread == 0] = 1.
+    return coords / spread * np.asarray(dim_weights, dtype=np.float64)
+
+def prior_weight(variability, limit):
+    """
+    Weight given to the prior, 0 (plain LS) below the limit
+    and rising towards 1 for the most variable stars
+    """
+    variability = np.asarray(variability, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.where(variability > limit, 1. - limit / variability, 0.)
+    return np.nan_to_num(weight)
+
+def neighbour_index(coords, n_neighbours, radius=None):
+    """
+    The nearest neighbours of every star, excluding itself, from
+    a KD-tree of the scaled coordinates
+
+    Parameters
+    ----------
+    coords : array-like
+        Scaled catalog coordinates, see scaled_coordinates
+    n_neighbours : int
+        Maximum number of neighbours per star
+    radius : float | None
+        Only keep neighbours within this scaled distance
+
+    Returns
+    -------
+    rows : array-like
+        Rows of the neighbours, (n_stars, n_neighbours). Missing
+        neighbours (outside the radius) have a row of n_stars
+    distances : array-like
+        Their distances, inf for missing neighbours
+    """
+    n_stars = len(coords)
+    k = min(n_neighbours, n_stars - 1)
+    if k < 1:
+        return (np.full((n_stars, 0), n_stars, dtype=np.int64),
+                np.full((n_stars, 0), np.inf))
+
+    tree = cKDTree(coords)
+    bound = np.inf if radius is None else radius
+    distances, rows = tree.query(coords, k=k+1, distance_upper_bound=bound, workers=-1)
+
+    # drop each star from its own neighbours, or the furthest
+    # neighbour if duplicate coordinates pushed it out
+    is_self = rows == np.arange(n_stars)[:, None]
+    is_self[~is_self.any(axis=1), -1] = True
+    keep = ~is_self
+    return (rows[keep].reshape(n_stars, k).astype(np.int64),
+            distances[keep].reshape(n_stars, k))
+
+def kde_params(neighbour_coeffs, distances, step):
+    """
+    Neighbour weights and per CBV bandwidths of the prior KDE,
+    nearer neighbours count for more
+
+    Parameters
+    ----------
+    neighbour_coeffs : array-like
+        Neighbours' robust fit coefficients, (n_neighbours, n_cbvs)
+    distances : array-like
+        Neighbours' distances
+    step : array-like
+        Spacing of the theta grid of each CBV
+
+    Returns
+    -------
+    w : array-like
+        Normalised neighbour weights, (n_neighbours,)
+    h : array-like
+        Bandwidth for each CBV, (n_cbvs,)
+    """
+    w = 1. / (distances + np.median(distances) + np.finfo(float).eps)
+    w /= np.sum(w)
+
+    # weighted Silverman bandwidth, no narrower than the grid spacing
+    mean = w @ neighbour_coeffs
+    std = np.sqrt(w @ (neighbour_coeffs - mean)**2)
+    h = np.maximum(1.06 * std * len(w)**-0.2, step)
+    return w, h
+
+def kde(points, neighbour_coeffs, w, h):
+    """
+    Weighted Gaussian KDE of the neighbours' coefficients
+
+    Parameters
+    ----------
+    points : array-like
+        Coefficients to evaluate at for each CBV, (n_cbvs, n_points)
+    neighbour_coeffs : array-like
+        Neighbours' robust fit coefficients, (n_neighbours, n_cbvs)
+    w, h : array-like
+        Neighbour weights and bandwidths, see kde_params
+
+    Returns
+    -------
+    density : array-like
+        KDE at each point, (n_cbvs, n_points)
+    """
+    z = (points[:, :, None] - neighbour_coeffs.T[:, None, :]) / h[:, None, None]
+    return (np.exp(-0.5 * z**2) @ w) / (h[:, None] * np.sqrt(2. * np.pi))
+
+def prior_pdfs(theta, neighbour_coeffs, distances):
+    """
+    Prior PDF of each CBV on its theta grid
+
+    Parameters
+    ----------
+    theta : array-like
+        Grids of coefficients, (n_cbvs, n_theta)
+    neighbour_coeffs : array-like
+        Neighbours' robust fit coefficients, (n_neighbours, n_cbvs)
+    distances : array-like
+        Neighbours' distances
+
+    Returns
+    -------
+    pdfs : array-like
+        Normalised prior PDFs, (n_cbvs, n_theta)
+    """
+    step = theta[:, 1] - theta[:, 0]
+    w, h = kde_params(neighbour_coeffs, distances, step)
+    pdfs = kde(theta, neighbour_coeffs, w, h)
+    pdfs /= np.maximum(np.sum(pdfs, axis=1, keepdims=True) * step[:, None], np.finfo(float).tiny)
+    return pdfs
+
+def refine_peak(log_pdf, lo, hi, theta, n_points=16, n_coarse=None):
+    """
+    Find the peak of a PDF on the theta grid without evaluating it on
+    the whole grid. The PDF is evaluated on n_coarse points between lo
+    and hi, then repeatedly on n_points either side of the best point until the
+    spacing reaches that of the grid. The peak is snapped to the best
+    of the nearest grid points, so for a single peaked PDF it matches
+    the argmax over the full grid
+
+    Parameters
+    ----------
+    log_pdf : callable
+        Log PDF, called with (n_stars, n_cbvs, n) coefficients
+    lo, hi : array-like
+        Window to search, (n_stars, n_cbvs)
+    theta : array-like
+        Grids of coefficients, (n_cbvs, n_theta)
+    n_points : int
+        Number of points evaluated per refinement
+    n_coarse : int | None
+        Number of points in the first, coarse pass, by default
+        n_points. More helps pick the right peak of lumpy PDFs
+
+    Returns
+    -------
+    peak : array-like
+        Grid point at the peak, (n_stars, n_cbvs)
+    """
+    grid_step = theta[:, 1] - theta[:, 0]
+    n = n_coarse or n_points
+    while True:
+        points = np.linspace(lo, hi, n, axis=-1)
+        best = np.argmax(log_pdf(points), axis=-1)
+        peak = np.take_along_axis(points, best[..., None], axis=-1)[..., 0]
+        step = (hi - lo) / (n - 1)
+        n = n_points
+        if np.all(step <= grid_step):
+            break
+        lo, hi = peak - step, peak + step
+
+    # snap to the grid, checking the neighbouring grid points too
+    nearest = np.rint((peak - theta[:, 0]) / grid_step).astype(np.int64)
+    candidates = np.clip(nearest[..., None] + np.arange(-1, 2), 0, theta.shape[1] - 1)
+    points = theta[np.arange(len(theta))[:, None], candidates]
+    best = np.argmax(log_pdf(points), axis=-1)
+    return np.take_along_axis(points, best[..., None], axis=-1)[..., 0]
+
+def ls_fit_block(flux_block, Q, R, cov_diag):
+    """
+    Least squares fit of a block of stars and the uncertainties of the
+    coefficients, from the scatter of the residuals
+
+    Parameters
+    ----------
+    flux_block : array-like
+        Normalised fluxes, (n_stars, n_cadences)
+    Q, R : array-like
+        Factorised CBVs, see factorise_cbvs
+    cov_diag : array-like
+        Diagonal of (X^T X)^-1, (n_cbvs,)
+
+    Returns
+    -------
+    ls_coeffs, ls_sigma : array-like
+        Coefficients and their uncertainties, (n_stars, n_cbvs)
+    model : array-like
+        CBV models, (n_stars, n_cadences)
+    """
+    ls_coeffs, model = fit_ls_block(flux_block, Q, R)
+    dof = max(flux_block.shape[1] - len(R), 1)
+    resid_var = np.sum((flux_block - model)**2, axis=1) / dof
+    ls_sigma = np.sqrt(resid_var[:, None] * cov_diag[None, :])
+    return ls_coeffs, ls_sigma, model
+
+def map_fit_block_adaptive(theta, ls_coeffs, ls_sigma, neighbour_coeffs, distances, weights):
+    """
+    MAP fit a block of stars at once, finding the peaks by refining
+    the grid only near them (see refine_peak) rather than evaluating
+    the PDFs over the whole grid
+
+    Parameters
+    ----------
+    theta : array-like
+        Grids of coefficients, (n_cbvs, n_theta)
+    ls_coeffs, ls_sigma : array-like
+        Least squares coefficients and uncertainties, (n_stars, n_cbvs)
+    neighbour_coeffs : array-like
+        Neighbours' robust fit coefficients, (n_stars, n_neighbours, n_cbvs)
+    distances : array-like
+        Neighbours' distances, inf for missing ones, (n_stars, n_neighbours)
+    weights : array-like
+        Weight given to the prior for each star
+
+    Returns
+    -------
+    prior_peak, cond_peak, posterior_peak : array-like
+        Peaks of the PDFs, (n_stars, n_cbvs)
+    use_prior : array-like
+        Which stars were fitted with the prior, the rest are plain LS
+    """
+    tiny = np.finfo(float).tiny
+    grid_lo, grid_hi = theta[:, 0], theta[:, -1]
+    step = theta[:, 1] - theta[:, 0]
+    sigma = np.maximum(ls_sigma, tiny)
+
+    # the conditional is Gaussian, its peak is the nearest grid point
+    nearest = np.clip(np.rint((ls_coeffs - grid_lo) / step), 0, theta.shape[1] - 1)
+    cond_peak = theta[np.arange(len(theta)), nearest.astype(np.int64)]
+
+    # neighbour weights and bandwidths, as kde_params for each star
+    found = np.isfinite(distances)
+    use_prior = (weights > 0) & found.any(axis=1)
+    d = np.where(found, distances, np.nan)
+    with np.errstate(all='ignore'):
+        w = np.where(found, 1. / (d + np.nanmedian(d, axis=1, keepdims=True)
+                                  + np.finfo(float).eps), 0.)
+        w /= np.sum(w, axis=1, keepdims=True)
+    w = np.nan_to_num(w)
+    mean = np.einsum('sn,snk->sk', w, neighbour_coeffs)
+    std = np.sqrt(np.einsum('sn,snk->sk', w, (neighbour_coeffs - mean[:, None])**2))
+    n_found = np.maximum(found.sum(axis=1), 1)[:, None]
+    h = np.maximum(1.06 * std * n_found**-0.2, step)
+
+    # the exponentials dominate the cost, so scale everything
+    # up front and work in place on the one large array
+    scale = np.sqrt(0.5) / h
+    scaled_coeffs = (neighbour_coeffs * scale[:, None, :]).transpose(0, 2, 1)[:, :, None, :]
+    norm = h[..., None] * np.sqrt(2. * np.pi)
+
+    def log_prior(points):
+        z = (points * scale[..., None])[..., None] - scaled_coeffs
+        np.square(z, out=z)
+        np.negative(z, out=z)
+        np.exp(z, out=z)
+        density = (z @ w[:, None, :, None])[..., 0] / norm
+        return np.log(density + tiny)
+
+    def log_post(points):
+        return (-0.5 * ((points - ls_coeffs[..., None]) / sigma[..., None])**2
+                + weights[:, None, None] * log_prior(points))
+
+    # the prior mass lies within a few bandwidths of the neighbours
+    nb_lo = np.min(np.where(found[..., None], neighbour_coeffs, np.inf), axis=1)
+    nb_hi = np.max(np.where(found[..., None], neighbour_coeffs, -np.inf), axis=1)
+    prior_lo = np.clip(nb_lo - 3*h, grid_lo, grid_hi)
+    prior_hi = np.clip(nb_hi + 3*h, grid_lo, grid_hi)
+    prior_peak = refine_peak(log_prior, prior_lo, prior_hi, theta, n_coarse=32)
+
+    # the posterior mode lies between the conditional and prior peaks,
+    # give it a few bandwidths either side in case the prior is lumpy
+    post_lo = np.clip(np.minimum(prior_peak, ls_coeffs) - 3*h, grid_lo, grid_hi)
+    post_hi = np.clip(np.maximum(prior_peak, ls_coeffs) + 3*h, grid_lo, grid_hi)
+    posterior_peak = refine_peak(log_post, post_lo, post_hi, theta)
+
+    # stars without a prior are plain LS, as in map_fit_star
+    prior_peak[~use_prior] = grid_lo
+    posterior_peak[~use_prior] = ls_coeffs[~use_prior]
+    return prior_peak, cond_peak, posterior_peak, use_prior
+
+def map_fit_star(theta, ls_coeffs, ls_sigma, neighbour_coeffs, distances, weight):
+    """
+    MAP fit of one star
+
+    Parameters
+    ----------
+    theta : array-like
+        Grids of coefficients, (n_cbvs, n_theta)
+    ls_coeffs, ls_sigma : array-like
+        Least squares coefficients and their uncertainties, (n_cbvs,)
+    neighbour_coeffs : array-like
+        Neighbours' robust fit coefficients, (n_neighbours, n_cbvs)
+    distances : array-like
+        Neighbours' distances
+    weight : float
+        Weight given to the prior
+
+    Returns
+    -------
+    result : SimpleNamespace
+        Peaks and PDFs of the prior, conditional and posterior, named
+        as in cotrendy's MAP results for the diagnostics. There are no
+        goodness terms, the prior weight is from the variability alone
+    """
+    sigma = np.maximum(ls_sigma, np.finfo(float).tiny)[:, None]
+    log_cond = -0.5 * ((theta - ls_coeffs[:, None]) / sigma)**2
+    cond = np.exp(log_cond)
+
+    if weight > 0 and len(distances) > 0:
+        prior = prior_pdfs(theta, neighbour_coeffs, distances)
+        log_post = log_cond + weight * np.log(prior + np.finfo(float).tiny)
+        peak = np.argmax(log_post, axis=1)
+        posterior_peak = theta[np.arange(len(theta)), peak]
+        mode = "MAP"
+    else:
+        prior = np.zeros_like(theta)
+        log_post = log_cond
+        posterior_peak = np.asarray(ls_coeffs, dtype=np.float64)
+        mode = "LS"
+
+    rows = np.arange(len(theta))
+    return SimpleNamespace(mode=mode,
+                           prior_weight=weight,
+                           prior_peak_theta=theta[rows, np.argmax(prior, axis=1)],
+                           cond_peak_theta=theta[rows, np.argmax(cond, axis=1)],
+                           posterior_peak_theta=posterior_peak,
+                           prior_pdf=prior,
+                           cond_pdf=cond,
+                           posterior_pdf=np.exp(log_post - np.max(log_post, axis=1, keepdims=True)))
+
+def check_adaptive(norm_flux, vect_store, fit_coeffs, weights, neighbours,
+                   neighbour_distances, theta, check_rows):
+    """
+    Compare the adaptive peak search (map_fit_block_adaptive) against
+    the full grid evaluation (map_fit_star) for some stars
+
+    Parameters
+    ----------
+    norm_flux : array-like
+        Normalised fluxes, (n_stars, n_cadences)
+    vect_store : array-like
+        CBVs, (n_cbvs, n_cadences)
+    fit_coeffs : array-like
+        Robust fit coefficients, (n_stars, n_cbvs)
+    weights : array-like
+        Weight given to the prior for each star
+    neighbours, neighbour_distances : array-like
+        Neighbour index of every star, see neighbour_index
+    theta : array-like
+        Grids of coefficients, (n_cbvs, n_theta)
+    check_rows : array-like
+        Rows of the stars to compare
+
+    Returns
+    -------
+    report : dict
+        The rows compared, the largest difference in any posterior
+        peak of each star in grid steps (step_diff), the largest over
+        all stars (max_step_diff) and the tolerance
+    """
+    check_rows = np.unique(np.asarray(check_rows, dtype=np.int64))
+    (Q, R), cov_diag = ls_factors(vect_store)
+    block = np.asarray(norm_flux[check_rows], dtype=np.float64)
+    ls_coeffs, ls_sigma, _ = ls_fit_block(block, Q, R, cov_diag)
+
+    found = neighbours[check_rows] < len(neighbours)
+    nb_rows = np.where(found, neighbours[check_rows], 0)
+    nb_dist = np.where(found, neighbour_distances[check_rows], np.inf)
+    _, _, adaptive, _ = map_fit_block_adaptive(theta, ls_coeffs, ls_sigma, fit_coeffs[nb_rows],
+                                               nb_dist, weights[check_rows])
+    fixed = np.array([map_fit_star(theta, ls_coeffs[j], ls_sigma[j],
+                                   fit_coeffs[nb_rows[j][found[j]]],
+                                   nb_dist[j][found[j]], weights[i]).posterior_peak_theta
+                      for j, i in enumerate(check_rows)])
+
+    step = theta[:, 1] - theta[:, 0]
+    step_diff = np.max(np.abs(adaptive - fixed) / step, axis=1)
+    return {'rows': check_rows.tolist(),
+            'step_diff': step_diff.tolist(),
+            'max_step_diff': float(np.max(step_diff, initial=0.)),
+            'tolerance': ADAPTIVE_TOLERANCE}
+
+# attached shared arrays and settings, one set per worker
+_map_state = {}
+
+def ls_factors(vect_store):
+    """
+    Factorised CBVs and the diagonal of (X^T X)^-1, for ls_fit_block
+    """
+    Q, R = factorise_cbvs(vect_store)
+    Rinv = solve_triangular(R, np.eye(len(R)))
+    return (Q, R), np.sum(Rinv**2, axis=1)
+
+def _init_map_worker(specs, settings):
+    """
+    Attach a MAP worker to the shared arrays
+    """
+    _map_state['shared'] = SharedArrays.attach(specs)
+    _map_state['settings'] = settings
+    vect_store = _map_state['shared']['vect_store']
+    _map_state['QR'], _map_state['cov_diag'] = ls_factors(vect_store)
+
+def _map_fit_block(rows):
+    """
+    MAP fit a block of stars, writing the results straight
+    into the shared outputs. Only the detailed results of
+    the test stars and the timings are sent back
+    """
+    t0 = time.perf_counter()
+    shared = _map_state['shared']
+    settings = _map_state['settings']
+    Q, R = _map_state['QR']
+    flux = shared['norm_flux']
+    vect_store = shared['vect_store']
+    theta = shared['theta']
+    robust = shared['fit_coeffs']
+    neighbours = shared['neighbours']
+    neighbour_distances = shared['neighbour_distances']
+    weights = shared['prior_weight']
+
+    block = np.asarray(flux[rows], dtype=np.float64)
+    ls_coeffs, ls_sigma, _ = ls_fit_block(block, Q, R, _map_state['cov_diag'])
+
+    # the block LS fit is shared evenly, the MAP fits are timed per star
+    latency = np.full(len(rows), (time.perf_counter() - t0) / len(rows))
+
+    map_coeffs = np.empty_like(ls_coeffs)
+    status = np.empty(len(rows), dtype=np.int8)
+    is_test = np.isin(rows, list(settings['test_stars']))
+    if settings['adaptive']:
+        # all but the test stars refine the grid near the peaks, the test
+        # stars keep their full PDFs. Each star is fitted on its own so a
+        # slow one stands out, unless star_latency is off when they are
+        # fitted together and their latency is unknown
+        batch = np.where(~is_test)[0]
+        if settings['star_latency']:
+            groups = np.split(batch, np.arange(1, len(batch)))
+        else:
+            groups = [batch]
+        for group in groups:
+            if not len(group):
+                continue
+            t_group = time.perf_counter()
+            found = neighbours[rows[group]] < len(neighbours)
+            nb_rows = np.where(found, neighbours[rows[group]], 0)
+            nb_dist = np.where(found, neighbour_distances[rows[group]], np.inf)
+            _, _, map_coeffs[group], use_prior = map_fit_block_adaptive(
+                theta, ls_coeffs[group], ls_sigma[group],
+                robust[nb_rows], nb_dist, weights[rows[group]])
+            status[group] = np.where(use_prior, STATUS_MAP, STATUS_LS)
+            if settings['star_latency']:
+                latency[group] += time.perf_counter() - t_group
+            else:
+                latency[group] = np.nan
+        full = np.where(is_test)[0]
+    else:
+        full = range(len(rows))
+
+    details = {}
+    for j in full:
+        t_star = time.perf_counter()
+        i = rows[j]
+        found = neighbours[i] < len(neighbours)
+        nb_rows, nb_dist = neighbours[i][found], neighbour_distances[i][found]
+        result = map_fit_star(theta, ls_coeffs[j], ls_sigma[j],
+                              robust[nb_rows], nb_dist, weights[i])
+        map_coeffs[j] = result.posterior_peak_theta
+        status[j] = STATUS_MAP if result.mode == "MAP" else STATUS_LS
+        if is_test[j]:
+            result.neighbour_rows = nb_rows
+            details[int(i)] = result
+        latency[j] += time.perf_counter() - t_star
+
+    t_out = time.perf_counter()
+    cotrending = map_coeffs @ vect_store
+    shared['map_coeffs'][rows] = map_coeffs
+    shared['map_status'][rows] = status
+    shared['cotrending'][rows] = cotrending
+    shared['cotrended'][rows] = block - cotrending
+    latency += (time.perf_counter() - t_out) / len(rows)
+    timing = {'pid': os.getpid(),
+              'busy': time.perf_counter() - t0,
+              'rows': rows,
+              'latency': latency}
+    return details, timing
+
+def cotrend_map_kde(norm_flux, vect_store, fit_coeffs, variability, coords,
+                       prior_variability_limit, n_neighbours=40, radius=None,
+                       n_theta=500, theta_mode="fixed", pool_size=1, chunk_stars=64,
+                       test_stars=(), precision=np.float64, telemetry=None, journal=None,
+                       star_latency=False, theta=None, check_rows=()):
+    """
+    MAP cotrend every star with this module's engine, with the inputs
+    and outputs shared between the workers rather than copied to each
+
+    Parameters
+    ----------
+    norm_flux : array-like
+        Normalised fluxes, (n_stars, n_cadences)
+    vect_store : array-like
+        CBVs, (n_cbvs, n_cadences)
+    fit_coeffs : array-like
+        Robust fit coefficients, (n_stars, n_cbvs)
+    variability : array-like
+        Normalised variability of each star
+    coords : array-like
+        Scaled catalog coordinates, see scaled_coordinates
+    prior_variability_limit : float
+        Normalised variability below which the prior is not used
+    n_neighbours : int
+        Maximum number of neighbours making up each star's prior
+    radius : float | None
+        Only use neighbours within this scaled distance for the prior
+    n_theta : int
+        Number of points in the coefficient grids
+    theta_mode : str
+        "fixed" evaluates the PDFs on the whole grid, "adaptive"
+        only refines the grid near the peaks of a block of stars at
+        a time, see map_fit_block_adaptive
+    pool_size : int
+        Number of worker processes, 1 fits in this process
+    chunk_stars : int
+        Number of star indices sent to a worker at a time
+    test_stars : list
+        Star indices whose full PDFs are returned
+    precision : np.dtype
+        dtype the fluxes are shared and the outputs kept as, the
+        fits themselves are always done in float64
+    telemetry : MapTelemetry
+        Collects the progress and per-star latency, by default
+        the progress is only printed
+    journal : MapJournal
+        Journal of the finished stars. Stars already in it are not
+        refitted, except the test stars whose PDFs are needed
+    star_latency : boolean
+        Time every star in adaptive mode by fitting them one at a time.
+        Otherwise the stars of a block are fitted together, which is
+        quicker, and only the test stars get a latency
+    theta : array-like | None
+        Grids of coefficients, (n_cbvs, n_theta), evenly spaced, e.g.
+        cotrendy's. By default they are made by theta_grids
+    check_rows : array-like
+        In adaptive mode, stars the adaptive peaks are checked against
+        the full grid on first, see check_adaptive. A RuntimeError is
+        raised if they differ by more than ADAPTIVE_TOLERANCE grid steps
+
+    Returns
+    -------
+    map_coeffs : array-like
+        MAP coefficients, (n_stars, n_cbvs)
+    cotrended, cotrending : array-like
+        Cotrended fluxes and CBV models, (n_stars, n_cadences)
+    theta : array-like
+        Grids of coefficients, (n_cbvs, n_theta)
+    details : dict
+        Star index -> MAP result for each of the test stars
+    """
+    n_stars, n_cadences = np.shape(norm_flux)
+    n_cbvs = len(vect_store)
+    if theta is None:
+        theta = theta_grids(fit_coeffs, n_theta=n_theta)
+    neighbours, neighbour_distances = neighbour_index(coords, n_neighbours, radius=radius)
+    weights = prior_weight(variability, prior_variability_limit)
+    if theta_mode == "adaptive" and len(check_rows):
+        report = check_adaptive(norm_flux, vect_store, fit_coeffs, weights, neighbours,
+                                neighbour_distances, theta, check_rows)
+        print(f"MAP: adaptive vs full grid on {len(report['rows'])} stars, max difference "
+              f"{report['max_step_diff']:.1f} grid steps (tolerance {ADAPTIVE_TOLERANCE})")
+        if report['max_step_diff'] > ADAPTIVE_TOLERANCE:
+            raise RuntimeError("The adaptive MAP peaks differ from the full grid by "
+                               f"{report['max_step_diff']:.1f} grid steps, "
+                               "use map_theta_mode = \"fixed\"")
+
+    shared = SharedArrays.create({'norm_flux': np.asarray(norm_flux, dtype=precision),
+                                  'vect_store': vect_store,
+                                  'fit_coeffs': fit_coeffs,
+                                  'prior_weight': weights,
+                                  'neighbours': neighbours,
+                                  'neighbour_distances': neighbour_distances,
+                                  'theta': theta,
+                                  'map_coeffs': ((n_stars, n_cbvs), np.float64),
+                                  'map_status': ((n_stars,), np.int8),
+                                  'cotrended': ((n_stars, n_cadences), precision),
+                                  'cotrending': ((n_stars, n_cadences), precision)})
+    settings = {'test_stars': set(test_stars), 'adaptive': theta_mode == "adaptive",
+                'star_latency': star_latency}
+    telemetry = telemetry or MapTelemetry(n_stars)
+    details = {}
+    try:
+        todo = np.arange(n_stars)
+        if journal is not None:
+            rows, status, coeffs, cotrended = journal.load()
+            keep = ~np.isin(rows, list(settings['test_stars']))
+            rows = rows[keep]
+            if len(rows):
+                shared['map_coeffs'][rows] = coeffs[keep]
+                shared['map_status'][rows] = status[keep]
+                shared['cotrended'][rows] = cotrended[keep]
+                shared['cotrending'][rows] = coeffs[keep] @ vect_store
+                todo = np.setdiff1d(todo, rows)
+                telemetry.resume(len(rows))
+                print(f"MAP: resuming from the journal, {len(rows)} stars already fitted")
+        blocks = [todo[i:i + chunk_stars] for i in range(0, len(todo), chunk_stars)]
+
+        def collect(result, timing):
+            details.update(result)
+            telemetry.record(timing)
+            if journal is not None:
+                rows = timing['rows']
+                journal.append(rows, shared['map_status'][rows], shared['map_coeffs'][rows],
+                               shared['cotrended'][rows])
+
+        if pool_size <= 1:
+            _init_map_worker(shared.specs, settings)
+            try:
+                for result, timing in map(_map_fit_block, blocks):
+                    collect(result, timing)
+            finally:
+                # drop this process's attachment even if a fit fails,
+                # the owner frees the blocks below
+                _map_state.pop('shared').close()
+        else:
+            with Pool(pool_size, initializer=_init_map_worker,
+                      initargs=(shared.specs, settings)) as pool:
+                for result, timing in pool.imap_unordered(_map_fit_block, blocks):
+                    collect(result, timing)
+        map_coeffs = np.array(shared['map_coeffs'])
+        cotrended = np.array(shared['cotrended'])
+        cotrending = np.array(shared['cotrending'])
+    finally:
+        shared.close()
+        if journal is not None:
+            journal.close()
+    return map_coeffs, cotrended, cotrending, theta, details
+
+def cotrend_data_map_kde(cbvs, config, catalog, tic_ids=None):
+    """
+    MAP cotrend every star of a CBVs object with this module's engine,
+    for map_engine = "kde". This is a different estimator from
+    cotrendy's cotrend_data_map_mp, check it with check_map_engine.
+    Fills cotrended_flux_array, cotrending_flux_array and theta, CBV
+    id -> coefficient grid, keeping cotrendy's grids if theta is already
+    set. In adaptive mode the peaks are first checked against the full
+    grid on the test stars, or map_check_stars random stars. With
+    map_journal_dir set the finished stars are journaled and a rerun
+    picks up where it stopped
+
+    Parameters
+    ----------
+    cbvs : cotrendy.cbvs.CBVs
+        CBVs object with the CBVs, variability and fit_coeffs set
+    config : dict
+        Cotrendy configuration
+    catalog : array-like
+        (ra, dec, mag) of every star, in the same order as the fluxes
+    tic_ids : array-like
+        TIC id of every star, for flagging the slow stars
+
+    Returns
+    -------
+    details : dict
+        Star index -> MAP result for each of the test stars
+    """
+    cbv_ids = cbv_order(cbvs)
+    fit_coeffs = np.column_stack([cbvs.fit_coeffs[cbv_id] for cbv_id in cbv_ids])
+    ra, dec, mag = catalog
+    dim_weights = config['catalog'].get('dim_weights', DEFAULT_DIM_WEIGHTS)
+    coords = scaled_coordinates(ra, dec, mag, dim_weights)
+
+    cotrend = config['cotrend']
+    telemetry = MapTelemetry(len(fit_coeffs),
+                             status_file=config['data'].get('map_status_file'),
+                             interval=cotrend.get('map_status_interval', 10.),
+                             slow_factor=cotrend.get('map_slow_factor', 10.))
+    theta = cotrendy_theta(cbvs, cbv_ids)
+    if theta is not None:
+        print("MAP: using cotrendy's coefficient grids")
+    n_check = cotrend.get('map_check_stars', 10)
+    check_rows = []
+    if n_check > 0:
+        check_rows = cotrend.get('test_stars', []) or sample_rows(len(fit_coeffs), n_check)
+    fit_options = {'prior_normalised_variability_limit': cotrend['prior_normalised_variability_limit'],
+                   'prior_n_neighbours': cotrend.get('prior_n_neighbours', 40),
+                   'prior_radius': cotrend.get('prior_radius'),
+                   'map_n_theta': cotrend.get('map_n_theta', 500),
+                   'map_theta_mode': cotrend.get('map_theta_mode', "fixed"),
+                   'map_theta_grid': "own" if theta is None else array_digest(theta)}
+    journal = None
+    if config['data'].get('map_journal_dir'):
+        journal = MapJournal(config['data']['map_journal_dir'],
+                             journal_key(cbvs.vect_store, fit_coeffs, cbvs.variability,
+                                         coords, fit_options),
+                             len(cbvs.vect_store), np.shape(cbvs.norm_flux_array)[1],
+                             precision=config_precision(config),
+                             fsync_interval=cotrend.get('map_journal_fsync_interval', 30.))
+    _, cotrended, cotrending, theta, details = cotrend_map_kde(
+        cbvs.norm_flux_array, cbvs.vect_store, fit_coeffs, cbvs.variability, coords,
+        fit_options['prior_normalised_variability_limit'],
+        n_neighbours=fit_options['prior_n_neighbours'],
+        radius=fit_options['prior_radius'],
+        n_theta=fit_options['map_n_theta'],
+        theta_mode=fit_options['map_theta_mode'],
+        pool_size=cotrend.get('pool_size', 1),
+        chunk_stars=cotrend.get('map_chunk_stars', 64),
+        test_stars=cotrend.get('test_stars', []),
+        precision=config_precision(config),
+        telemetry=telemetry, journal=journal,
+        star_latency=cotrend.get('map_star_latency', False),
+        theta=theta, check_rows=check_rows)
+    telemetry.finish(tic_ids=tic_ids, variability=cbvs.variability,
+                     prior_weight=prior_weight(cbvs.variability,
+                                               cotrend['prior_normalised_variability_limit']),
+                     test_stars=cotrend.get('test_stars', []),
+                     latency_file=config['data'].get('map_latency_file'))
+
+    cbvs.cotrended_flux_array = cotrended
+    cbvs.cotrending_flux_array = cotrending
+    cbvs.theta = dict(zip(cbv_ids, theta))
+    return details
+
+def catalog_sample(catalog, rows, n_stars):
+    """
+    Shallow copy of a cotrendy Catalog holding only some of the stars.
+    Every array or list attribute with one entry per star is cut down
+
+    Parameters
+    ----------
+    catalog : cotrendy.catalog.Catalog
+        Catalog of every star
+    rows : array-like
+        Rows of the stars to keep
+    n_stars : int
+        Number of stars in the catalog
+
+    Returns
+    -------
+    sample : cotrendy.catalog.Catalog
+        Copy with the per-star attributes cut down to the sample
+    """
+    sample = copy.copy(catalog)
+    for name, value in vars(catalog).items():
+        if isinstance(value, np.ndarray) and value.ndim > 0 and value.shape[0] == n_stars:
+            setattr(sample, name, value[rows])
+        elif isinstance(value, np.ndarray) and value.ndim > 1 and value.shape[-1] == n_stars:
+            setattr(sample, name, value[..., rows])
+        elif isinstance(value, list) and len(value) == n_stars:
+            setattr(sample, name, [value[i] for i in rows])
+    return sample
+
+def check_map_engine(cbvs, config, catalog, coords, check_rows, n_context=200):
+    """
+    Compare this engine's MAP fits against cotrendy's cotrend_data_map_mp
+    for some stars. A star's prior depends on its neighbours, so both are
+    run on the same sample: the check stars and the n_context nearest
+    neighbours of each
+
+    Parameters
+    ----------
+    cbvs : cotrendy.cbvs.CBVs
+        CBVs object with the CBVs, variability and fit_coeffs set,
+        it is not changed
+    config : dict
+        Cotrendy configuration
+    catalog : cotrendy.catalog.Catalog
+        Catalog of every star, in the same order as the fluxes
+    coords : array-like
+        Scaled catalog coordinates, see scaled_coordinates
+    check_rows : array-like
+        Rows of the stars to compare, e.g. the test stars
+    n_context : int
+        Number of neighbours of each check star in the sample
+
+    Returns
+    -------
+    report : dict
+        The TIC rows compared, the largest difference in any MAP
+        coefficient relative to the spread of that CBV's robust fit
+        coefficients (max_coeff_diff), and the largest difference in
+        the CBV models relative to cotrendy's (max_model_diff)
+    """
+    n_stars = len(cbvs.norm_flux_array)
+    check_rows = np.unique(np.asarray(check_rows, dtype=np.int64))
+    _, context = cKDTree(coords).query(coords[check_rows], k=min(n_context + 1, n_stars))
+    rows = np.unique(np.concatenate([check_rows, np.ravel(context)]))
+    positions = np.searchsorted(rows, check_rows)
+
+    # cotrendy's MAP of the sample
+    sample = cbvs_sample(cbvs, rows)
+    sample.cotrend_data_map_mp(catalog_sample(catalog, rows, n_stars))
+    reference = np.asarray(sample.cotrending_flux_array, dtype=np.float64)[positions]
+    vect_store = np.asarray(cbvs.vect_store, dtype=np.float64)
+    reference_coeffs = np.linalg.lstsq(vect_store.T, reference.T, rcond=None)[0].T
+
+    # and this engine's, on the same stars
+    cotrend = config['cotrend']
+    cbv_ids = cbv_order(cbvs)
+    fit_coeffs = np.column_stack([cbvs.fit_coeffs[cbv_id] for cbv_id in cbv_ids])
+    map_coeffs, _, cotrending, _, _ = cotrend_map_kde(
+        sample.norm_flux_array, vect_store, fit_coeffs[rows],
+        np.asarray(cbvs.variability)[rows], coords[rows],
+        cotrend['prior_normalised_variability_limit'],
+        n_neighbours=cotrend.get('prior_n_neighbours', 40),
+        radius=cotrend.get('prior_radius'),
+        n_theta=cotrend.get('map_n_theta', 500),
+        theta_mode=cotrend.get('map_theta_mode', "fixed"),
+        theta=cotrendy_theta(sample, cbv_ids))
+
+    spread = np.maximum(np.nanstd(fit_coeffs, axis=0), np.finfo(float).tiny)
+    scale = np.maximum(np.max(np.abs(reference), axis=1), np.finfo(float).tiny)
+    coeff_diff = np.max(np.abs(map_coeffs[positions] - reference_coeffs) / spread, axis=1)
+    model_diff = np.max(np.abs(cotrending[positions] - reference), axis=1) / scale
+    return {'rows': check_rows.tolist(),
+            'n_sample': len(rows),
+            'coeff_diff': coeff_diff.tolist(),
+            'model_diff': model_diff.tolist(),
+            'max_coeff_diff': float(np.max(coeff_diff)),
+            'max_model_diff': float(np.max(model_diff)),
+            'tolerance': MAP_TOLERANCE}
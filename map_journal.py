@@ -0,0 +1,320 @@
+"""
+Resumable journals of the MAP engines' finished stars
+
+A MAP run over a full CCD can take longer than the batch system's
+walltime, and without a journal a killed run loses every star fitted.
+As each block of stars comes back from the pool its MAP coefficients,
+cotrended rows and status (MAP or plain LS) are appended to a file of
+fixed size records in the journal directory. Only the parent process
+writes, so the workers never contend for it. The records are flushed
+to the OS after every block, which survives the job being killed, and
+fsynced every fsync_interval seconds in case the node itself goes down
+
+A header records a key made from the inputs and options of the fit.
+On a restart with the same key the journaled stars are loaded and only
+the missing ones are fitted, a partly written last record is dropped.
+Any other key starts a fresh journal. The cotrending rows are not
+kept, they are remade from the coefficients and the CBVs
+
+cotrendy's MAP pool returns whatever its workers make of each star, not
+fixed size arrays, so for map_engine = "cotrendy" a TaskJournal keeps
+each task's index and pickled result instead, in the same way
+"""
+import os
+import json
+import time
+import pickle
+import struct
+import shutil
+import hashlib
+import numpy as np
+from lc_store import array_digest
+
+# pylint: disable=invalid-name
+
+JOURNAL_VERSION = 1
+HEADER_FILE = "header.json"
+RECORDS_FILE = "records.bin"
+TASKS_FILE = "tasks.bin"
+# index and length of the pickled result before each task record
+TASK_HEADER = struct.Struct('<qq')
+STATUS_LS = 0
+STATUS_MAP = 1
+
+def journal_dtype(n_cbvs, n_cadences, precision=np.float64):
+    """
+    Record of one star in the journal
+    """
+    return np.dtype([('row', '<i8'),
+                     ('status', 'i1'),
+                     ('map_coeffs', '<f8', (n_cbvs,)),
+                     ('cotrended', np.dtype(precision).newbyteorder('<'), (n_cadences,))])
+
+def journal_key(vect_store, fit_coeffs, variability, coords, options):
+    """
+    Hash of everything the MAP fits depend on, beyond the fluxes
+    themselves which also set the CBVs and robust fit coefficients
+
+    Parameters
+    ----------
+    vect_store : array-like
+        CBVs, (n_cbvs, n_cadences)
+    fit_coeffs : array-like
+        Robust fit coefficients, (n_stars, n_cbvs)
+    variability : array-like
+        Normalised variability of each star
+    coords : array-like | None
+        Scaled catalog coordinates the neighbours are found from, None
+        if they are not (then the catalog belongs in the options)
+    options : dict
+        Fit options, e.g. the theta grid and prior settings
+
+    Returns
+    -------
+    key : str
+        SHA1 hex digest
+    """
+    parts = {'version': JOURNAL_VERSION,
+             'vect_store': array_digest(vect_store),
+             'fit_coeffs': array_digest(fit_coeffs),
+             'variability': array_digest(variability),
+             'coords': array_digest(coords) if coords is not None else None,
+             'options': options}
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+def task_journal_key(key, func, tasks):
+    """
+    Key of one map call of a pool, the key of its inputs
+    with the function mapped and the tasks it was given
+
+    Parameters
+    ----------
+    key : str
+        Key of the fit inputs, see journal_key
+    func : callable
+        Function mapped over the tasks, or a partial of one
+    tasks : list
+        Arguments of each task
+
+    Returns
+    -------
+    key : str
+        SHA1 hex digest
+    """
+    func = getattr(func, 'func', func)
+    parts = {'key': key,
+             'func': f"{func.__module__}.{func.__qualname__}",
+             'tasks': hashlib.sha1(pickle.dumps(tasks)).hexdigest()}
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+def open_journal(directory, header):
+    """
+    Keep the journal in directory if its header matches, otherwise
+    start a fresh one there with this header
+    """
+    header_file = os.path.join(directory, HEADER_FILE)
+    old_header = None
+    if os.path.exists(header_file):
+        with open(header_file, 'r') as hf:
+            old_header = json.load(hf)
+    if old_header != header:
+        if old_header is not None:
+            print(f"MAP journal {directory} is for different inputs, starting afresh")
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        tmp_file = f"{header_file}.tmp"
+        with open(tmp_file, 'w') as hf:
+            json.dump(header, hf, indent=2)
+        os.replace(tmp_file, header_file)
+
+class MapJournal():
+    """
+    Append-only journal of the stars finished by the MAP pool
+    """
+    def __init__(self, directory, key, n_cbvs, n_cadences, precision=np.float64,
+                 fsync_interval=30.):
+        """
+        Initialise the class, reopening the journal in directory if it
+        was made with the same key or starting a fresh one otherwise
+
+        Parameters
+        ----------
+        directory : str
+            Path to the journal directory
+        key : str
+            Key of the fit inputs, see journal_key
+        n_cbvs, n_cadences : int
+            Shape of the records
+        precision : np.dtype
+            dtype of the cotrended rows
+        fsync_interval : float
+            Seconds between forcing the records to disk
+        """
+        self.directory = directory
+        self.key = key
+        self.dtype = journal_dtype(n_cbvs, n_cadences, precision)
+        self.fsync_interval = fsync_interval
+        self.records_file = os.path.join(directory, RECORDS_FILE)
+        header = {'version': JOURNAL_VERSION,
+                  'key': key,
+                  'record_bytes': self.dtype.itemsize,
+                  'n_cbvs': int(n_cbvs),
+                  'n_cadences': int(n_cadences),
+                  'precision': np.dtype(precision).name}
+
+        open_journal(directory, header)
+
+        # drop a record left half written when the last run was killed
+        self._file = open(self.records_file, 'ab')
+        torn = self._file.tell() % self.dtype.itemsize
+        if torn:
+            self._file.truncate(self._file.tell() - torn)
+            self._file.seek(0, os.SEEK_END)
+        self._last_fsync = time.time()
+
+    def load(self):
+        """
+        The stars already in the journal, the latest record of each
+
+        Returns
+        -------
+        rows : array-like
+            Rows of the journaled stars
+        status : array-like
+            STATUS_MAP or STATUS_LS for each
+        map_coeffs : array-like
+            MAP coefficients, (n_rows, n_cbvs)
+        cotrended : array-like
+            Cotrended rows, (n_rows, n_cadences)
+        """
+        records = np.fromfile(self.records_file, dtype=self.dtype)
+        # keep the last record of any star journaled twice
+        _, last = np.unique(records['row'][::-1], return_index=True)
+        records = records[len(records) - 1 - last]
+        return records['row'], records['status'], records['map_coeffs'], records['cotrended']
+
+    def append(self, rows, status, map_coeffs, cotrended):
+        """
+        Append the results of a block of stars
+
+        Parameters
+        ----------
+        rows : array-like
+            Rows of the stars
+        status : array-like
+            STATUS_MAP or STATUS_LS for each
+        map_coeffs : array-like
+            MAP coefficients, (n_rows, n_cbvs)
+        cotrended : array-like
+            Cotrended rows, (n_rows, n_cadences)
+        """
+        records = np.empty(len(rows), dtype=self.dtype)
+        records['row'] = rows
+        records['status'] = status
+        records['map_coeffs'] = map_coeffs
+        records['cotrended'] = cotrended
+        self._file.write(records.tobytes())
+        self._file.flush()
+        now = time.time()
+        if now - self._last_fsync >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._last_fsync = now
+
+    def close(self):
+        """
+        Force the records to disk and close the journal
+        """
+        if not self._file.closed:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+class TaskJournal():
+    """
+    Append-only journal of the results of the tasks of a pool, e.g.
+    cotrendy's MAP pool, each a task index and its pickled result
+    """
+    def __init__(self, directory, key, fsync_interval=30.):
+        """
+        Initialise the class, reopening the journal in directory if it
+        was made with the same key or starting a fresh one otherwise
+
+        Parameters
+        ----------
+        directory : str
+            Path to the journal directory
+        key : str
+            Key of the map call, see task_journal_key
+        fsync_interval : float
+            Seconds between forcing the records to disk
+        """
+        self.directory = directory
+        self.key = key
+        self.fsync_interval = fsync_interval
+        self.tasks_file = os.path.join(directory, TASKS_FILE)
+        open_journal(directory, {'version': JOURNAL_VERSION, 'kind': 'tasks', 'key': key})
+
+        # read the finished tasks, dropping a record left
+        # half written when the last run was killed
+        self.results = {}
+        size = 0
+        if os.path.exists(self.tasks_file):
+            with open(self.tasks_file, 'rb') as tf:
+                data = tf.read()
+            while size + TASK_HEADER.size <= len(data):
+                index, length = TASK_HEADER.unpack_from(data, size)
+                end = size + TASK_HEADER.size + length
+                if end > len(data):
+                    break
+                self.results[index] = pickle.loads(data[size + TASK_HEADER.size:end])
+                size = end
+        self._file = open(self.tasks_file, 'ab')
+        self._file.truncate(size)
+        self._file.seek(0, os.SEEK_END)
+        self._last_fsync = time.time()
+
+    def load(self):
+        """
+        The tasks finished by earlier runs
+
+        Returns
+        -------
+        results : dict
+            Task index -> result
+        """
+        return dict(self.results)
+
+    def append(self, index, result):
+        """
+        Append the result of one task
+
+        Parameters
+        ----------
+        index : int
+            Index of the task in the map call
+        result : object
+            What the task returned, it must pickle
+        """
+        data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        self._file.write(TASK_HEADER.pack(index, len(data)) + data)
+        self._file.flush()
+        now = time.time()
+        if now - self._last_fsync >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._last_fsync = now
+
+    def close(self):
+        """
+        Force the records to disk and close the journal
+        """
+        if not self._file.closed:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+def discard_journal(directory):
+    """
+    Remove a journal once the fits it holds are saved elsewhere
+    """
+    if directory and os.path.isdir(directory):
+        shutil.rmtree(directory)
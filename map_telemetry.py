@@ -0,0 +1,209 @@
+"""
+Progress and per-star latency telemetry for the MAP pool
+
+The MAP workers time each block of stars they fit and send the timings
+back with the results. These are gathered here to give the throughput,
+an ETA and the utilisation of each worker, written to a status file
+every few seconds so a long run can be watched. At the end the fit
+latency of every star is saved to a compact table, and stars slower
+than slow_factor times the median are flagged with their TIC id,
+variability and prior weight. Stars fitted with the prior are compared
+with the median of those fitted with the prior, and the plain LS stars,
+which are much quicker, with the median of the plain LS stars
+
+In fixed mode every star's MAP fit is timed on its own, plus an even
+share of its block's LS fit. In adaptive mode the stars of a block are
+fitted together and have no latency (NaN), so they are left out of the
+percentiles and the slow stars, unless star_latency is on when they
+are fitted and timed one at a time
+
+cotrendy's cotrend_data_map_mp is timed in the same way, one star per
+task of its pool, see map_cotrendy.py
+"""
+import os
+import time
+import json
+from datetime import datetime, timezone
+import numpy as np
+
+# pylint: disable=invalid-name
+
+LATENCY_COLUMNS = ('row', 'tic_id', 'latency_ms', 'worker', 'variability',
+                   'prior_weight', 'slow')
+
+class MapTelemetry():
+    """
+    Tracks the progress of a MAP pool and the latency of each star
+    """
+    def __init__(self, n_stars, status_file=None, interval=10., slow_factor=10.):
+        """
+        Initialise the class
+
+        Parameters
+        ----------
+        n_stars : int
+            Number of stars being fitted
+        status_file : str | None
+            JSON file rewritten with the progress, None to only print it
+        interval : float
+            Seconds between updates of the status
+        slow_factor : float
+            Stars slower than this many times the median are flagged
+        """
+        self.n_stars = n_stars
+        self.status_file = status_file
+        self.interval = interval
+        self.slow_factor = slow_factor
+        self.latency = np.full(n_stars, np.nan)
+        self.worker = np.zeros(n_stars, dtype=np.int64)
+        self.workers = {}
+        self.n_done = 0
+        self.n_resumed = 0
+        self.start = time.time()
+        self._last_update = self.start
+
+    def record(self, timing):
+        """
+        Add the timing of a block of stars from a worker, updating
+        the status if it is due
+
+        Parameters
+        ----------
+        timing : dict
+            pid, busy (seconds), rows and latency (seconds per star)
+        """
+        rows = timing['rows']
+        self.latency[rows] = timing['latency']
+        self.worker[rows] = timing['pid']
+        worker = self.workers.setdefault(timing['pid'], {'n_blocks': 0, 'n_stars': 0, 'busy': 0.})
+        worker['n_blocks'] += 1
+        worker['n_stars'] += len(rows)
+        worker['busy'] += timing['busy']
+        self.n_done += len(rows)
+
+        now = time.time()
+        if now - self._last_update >= self.interval:
+            self._last_update = now
+            self.update()
+
+    def resume(self, n_resumed):
+        """
+        Count stars fitted by an earlier run, e.g. from the MAP journal,
+        as done. They are left out of the throughput and latencies
+        """
+        self.n_resumed = n_resumed
+        self.n_done += n_resumed
+
+    def status(self):
+        """
+        Current progress, throughput, ETA, worker utilisation
+        and latency percentiles
+        """
+        elapsed = max(time.time() - self.start, 1e-9)
+        rate = (self.n_done - self.n_resumed) / elapsed
+        done = np.isfinite(self.latency)
+        latency_ms = self.latency[done] * 1e3
+        percentiles = {}
+        if latency_ms.size:
+            for name, q in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100)):
+                percentiles[name] = float(np.percentile(latency_ms, q))
+        return {'n_done': self.n_done,
+                'n_resumed': self.n_resumed,
+                'n_stars': self.n_stars,
+                'elapsed': elapsed,
+                'stars_per_s': rate,
+                'eta_s': (self.n_stars - self.n_done) / rate if rate > 0 else None,
+                'latency_ms': percentiles,
+                'workers': {str(pid): dict(worker, utilisation=worker['busy'] / elapsed)
+                            for pid, worker in self.workers.items()},
+                'updated': datetime.now(timezone.utc).isoformat()}
+
+    def update(self, extra=None):
+        """
+        Print a progress line and rewrite the status file
+        """
+        status = dict(self.status(), **(extra or {}))
+        eta = f"{status['eta_s']:.0f} s" if status['eta_s'] is not None else "?"
+        print(f"MAP: {status['n_done']}/{status['n_stars']} stars, "
+              f"{status['stars_per_s']:.1f} stars/s, ETA {eta}")
+        if self.status_file:
+            tmp_file = f"{self.status_file}.tmp"
+            with open(tmp_file, 'w') as sf:
+                json.dump(status, sf, indent=2)
+            os.replace(tmp_file, self.status_file)
+        return status
+
+    def slow_stars(self, groups=None):
+        """
+        Rows of the stars slower than slow_factor times the median
+
+        Parameters
+        ----------
+        groups : array-like
+            Group of each star, e.g. fitted with the prior or not, each
+            star is compared with the median of its own group
+        """
+        done = np.isfinite(self.latency)
+        groups = np.zeros(self.n_stars, dtype=bool) if groups is None else np.asarray(groups)
+        slow = np.zeros(self.n_stars, dtype=bool)
+        for group in np.unique(groups[done]):
+            members = done & (groups == group)
+            limit = self.slow_factor * np.median(self.latency[members])
+            slow |= members & (self.latency > limit)
+        return np.where(slow)[0]
+
+    def finish(self, tic_ids=None, variability=None, prior_weight=None,
+               test_stars=(), latency_file=None):
+        """
+        Flag the slow stars, save the latency table and write the
+        final status
+
+        Parameters
+        ----------
+        tic_ids : array-like
+            TIC id of each star, rows are used if not given
+        variability : array-like
+            Normalised variability of each star
+        prior_weight : array-like
+            Weight given to the prior for each star
+        test_stars : list
+            Rows of the test stars, which are slower as they keep their PDFs
+        latency_file : str | None
+            Text table of the latency of every star, see LATENCY_COLUMNS
+
+        Returns
+        -------
+        slow : list
+            Row, TIC id, latency, variability and prior weight
+            of each slow star, slowest first
+        """
+        rows = np.arange(self.n_stars)
+        tic_ids = rows if tic_ids is None else np.asarray(tic_ids)
+        variability = np.full(self.n_stars, np.nan) if variability is None else variability
+        prior_weight = np.full(self.n_stars, np.nan) if prior_weight is None else prior_weight
+        slow_rows = self.slow_stars(groups=prior_weight > 0)
+        slow_rows = slow_rows[np.argsort(-self.latency[slow_rows])]
+        slow = [{'row': int(i),
+                 'tic_id': int(tic_ids[i]),
+                 'latency_ms': float(self.latency[i] * 1e3),
+                 'variability': float(variability[i]),
+                 'prior_weight': float(prior_weight[i]),
+                 'test_star': int(i) in set(test_stars)}
+                for i in slow_rows]
+
+        if latency_file:
+            flags = np.zeros(self.n_stars, dtype=bool)
+            flags[slow_rows] = True
+            np.savetxt(latency_file,
+                       np.column_stack([rows, tic_ids, self.latency * 1e3, self.worker,
+                                        variability, prior_weight, flags]),
+                       fmt=['%d', '%d', '%.3f', '%d', '%.4f', '%.4f', '%d'],
+                       header=" ".join(LATENCY_COLUMNS))
+
+        print(f"MAP: {len(slow)} stars slower than {self.slow_factor:g} x the median latency")
+        for star in slow[:20]:
+            print(f"  TIC-{star['tic_id']}: {star['latency_ms']:.1f} ms, variability "
+                  f"{star['variability']:.3f}, prior weight {star['prior_weight']:.3f}"
+                  f"{' (test star)' if star['test_star'] else ''}")
+        self.update({'finished': True, 'slow_factor': self.slow_factor, 'slow_stars': slow})
+        return slow
@@ -4,10 +4,16 @@ for those objects and a with mask and
 prepare input files for cotrendy
 """
 import os
+import shutil
 import argparse as ap
+from functools import partial
 import numpy as np
 from astropy.io import fits
-from cotrendy.utils import picklify, load_config
+from cotrendy.utils import load_config
+from tess_io import ingest_lightcurves, tic_index, input_digest
+from lc_store import (LightcurveStore, store_dirname, array_digest,
+                      plan_update, config_apertures, config_precision)
+from instrumentation import Instrumentation
 
 # pylint: disable=invalid-name
 
@@ -18,6 +24,9 @@ def arg_parse():
     p = ap.ArgumentParser()
     p.add_argument('config',
                    help='config file')
+    p.add_argument('--full',
+                   help='Ignore any existing store and re-read every light curve',
+                   action='store_true')
     return p.parse_args()
 
 if __name__ == "__main__":
@@ -32,63 +41,173 @@ if __name__ == "__main__":
     # go into the root data directory
     os.chdir(root)
 
-    # load the sector cadence mask
-    with fits.open(mask_file) as m:
-        mask = m[1].data['MASK']
-
-    # load the catalog
-    with fits.open(cat_file) as cata:
-        cat = cata[1].data
-
-    # store some stuff for later
-    fluxes_to_cotrendy, ras, decs, mags, ids = [], [], [], [], []
-    neg_fluxes = []
-    dilutions = []
-    cbv_objects_mask = []
-
-    # loop over the catalog rows and pull out the ones we want to use for CBVs
-    skipped = 0
-    for row in cat:
-        tic_id = row['TIC_ID']
-        tic_file = f"TIC-{tic_id}.fits"
-
-        try:
-            with fits.open(tic_file) as ff:
-                h = ff[1].data
-
-            flux = h['AP2.5'][mask]
-            sky = h['SKY_MEDIAN'][mask] * np.pi * (2.5**2)
-            flux_corr = flux - sky
-            neg = np.sum([flux_corr < 0])
-        except FileNotFoundError:
-            #print(f"Skipping {tic_file}, not found...")
-            skipped += 1
-            continue
-
-        #if neg == 0:
-        ras.append(row['RA'])
-        decs.append(row['DEC'])
-        mags.append(row['Tmag'])
-        ids.append(tic_id)
-
-        fluxes_to_cotrendy.append(flux_corr)
-        times0 = int(h['BJD'][mask][0])
-        times = h['BJD'][mask] - times0
-
-        if 8.0 <= row['Tmag'] <= 12.0:# and neg == 0:
-            cbv_objects_mask.append(True)
+    # time and profile each stage, the report goes next to the outputs
+    profiler = Instrumentation('prepare', meta={'sector': config['global']['timeslot'],
+                                                'camera': config['global']['camera_id']})
+
+    with profiler.stage('load_mask_catalog'):
+        # load the sector cadence mask
+        with fits.open(mask_file) as m:
+            mask = m[1].data['MASK']
+
+        # load the catalog
+        with fits.open(cat_file) as cata:
+            cat = cata[1].data
+
+    # ingestion can be spread over a pool of workers
+    pool_size = config['data'].get('ingest_pool_size', 1)
+    chunksize = config['data'].get('ingest_chunksize', 64)
+    pool_type = config['data'].get('ingest_pool_type', "process")
+
+    # all apertures are read from each file in one pass
+    apertures = config_apertures(config)
+    precision = config_precision(config)
+
+    with profiler.stage('plan_update'):
+        # work out which catalog objects have light curves before reading any
+        # so the output matrix can be preallocated at its final size. The directory
+        # is scanned once and joined against the catalog, only files known to
+        # exist are opened
+        cat_ids = np.asarray(cat['TIC_ID'], dtype=np.int64)
+        exists = np.isin(cat_ids, tic_index('.'))
+        skipped = int(np.sum(~exists))
+        n_objects = int(np.sum(exists))
+        n_cadences = int(np.sum(mask))
+
+        # the catalog info for the objects we keep
+        ras = np.asarray(cat['RA'], dtype=np.float64)[exists]
+        decs = np.asarray(cat['DEC'], dtype=np.float64)[exists]
+        mags = np.asarray(cat['Tmag'], dtype=np.float64)[exists]
+        ids = cat_ids[exists]
+        cbv_objects_mask = (mags >= 8.0) & (mags <= 12.0)
+        tic_files = [f"TIC-{tic_id}.fits" for tic_id in ids]
+        row_of = {tic_file: i for i, tic_file in enumerate(tic_files)}
+
+        # check for a store from a previous run that we can update,
+        # it is only reusable if it was made with the same cadence mask, apertures and precision
+        store_dir = store_dirname(config)
+        mask_sha1 = array_digest(mask)
+        old_store = None
+        if not args.full:
+            try:
+                old_store = LightcurveStore(store_dir)
+            except (FileNotFoundError, ValueError):
+                pass
+        if old_store is not None and old_store.manifest.get('mask_sha1') != mask_sha1:
+            print(f"Cadence mask has changed since {store_dir} was made, rebuilding it...")
+            old_store = None
+        if old_store is not None and old_store.manifest.get('apertures') != apertures:
+            print(f"Apertures have changed since {store_dir} was made, rebuilding it...")
+            old_store = None
+        if old_store is not None and old_store.manifest.get('precision', "float64") != precision.name:
+            print(f"Precision has changed since {store_dir} was made, rebuilding it...")
+            old_store = None
+
+        # work out which files need reading, and where unchanged rows come from
+        if old_store is not None:
+            old_inputs = old_store.read_inputs()
+            # only the columns read are hashed, so the COR/CBV columns
+            # written back by the cotrending don't count as changes
+            plan = plan_update(old_inputs, tic_files,
+                               digest=partial(input_digest, apertures=apertures))
         else:
-            cbv_objects_mask.append(False)
-
-    fluxes_to_cotrendy = np.array(fluxes_to_cotrendy)
-    cbv_objects_mask = np.array(cbv_objects_mask)
-
-    # pickle the outputs
-    picklify(config['data']['time_file'], times)
-    picklify(config['data']['flux_file'], fluxes_to_cotrendy)
-    picklify(config['data']['error_file'], np.sqrt(fluxes_to_cotrendy))
-    picklify(config['data']['objects_mask_file'], cbv_objects_mask)
-    picklify(config['catalog']['input_cat_file'], np.array([ras, decs, mags, ids]))
-
-    print(f"Grabbed light curves for {len(fluxes_to_cotrendy)} objects.")
+            old_inputs = {}
+            plan = {'added': tic_files, 'updated': [], 'removed': [], 'unchanged': [], 'stats': {}}
+        to_read = set(plan['added']) | set(plan['updated'])
+        read_rows = [i for i, tic_file in enumerate(tic_files) if tic_file in to_read]
+
+    with profiler.stage('allocate_store'):
+        # if only existing rows changed we patch the store in place, otherwise
+        # a new store is built alongside the old one, copying unchanged rows over
+        in_place = old_store is not None and not plan['added'] and not plan['removed'] \
+            and [old_inputs[tic_file]['row'] for tic_file in tic_files] == list(range(n_objects))
+        if in_place:
+            store = LightcurveStore(store_dir, mode='r+')
+            fluxes_to_cotrendy = [store[f"flux_{aperture}"] for aperture in apertures]
+            errors = [store[f"error_{aperture}"] for aperture in apertures]
+        else:
+            store = LightcurveStore.create(f"{store_dir}.new")
+            fluxes_to_cotrendy = [store.add_array(f"flux_{aperture}", (n_objects, n_cadences),
+                                                  dtype=precision)
+                                  for aperture in apertures]
+            errors = [store.add_array(f"error_{aperture}", (n_objects, n_cadences), dtype=precision)
+                      for aperture in apertures]
+            if old_store is not None:
+                for tic_file in plan['unchanged']:
+                    new_row = row_of[tic_file]
+                    old_row = old_inputs[tic_file]['row']
+                    for j, aperture in enumerate(apertures):
+                        fluxes_to_cotrendy[j][new_row] = old_store[f"flux_{aperture}"][old_row]
+                        errors[j][new_row] = old_store[f"error_{aperture}"][old_row]
+
+        # record the row and stats of each input file in the new store
+        inputs = {}
+        for tic_file in plan['unchanged']:
+            inputs[tic_file] = dict(plan['stats'][tic_file], row=row_of[tic_file])
+
+    with profiler.stage('fits_ingestion'):
+        # read the new and changed light curves straight into the store
+        # the light curves come back in catalog order, even when read in parallel
+        times = np.array(old_store['times']) if old_store is not None else None
+        lcs = ingest_lightcurves([tic_files[i] for i in read_rows], mask,
+                                 pool_size=pool_size, chunksize=chunksize,
+                                 pool_type=pool_type, with_stats=True,
+                                 apertures=apertures)
+        for i, (flux_corr, lc_times, stats) in zip(read_rows, lcs):
+            if flux_corr is None:
+                raise FileNotFoundError(f"{tic_files[i]} disappeared during ingestion")
+            for j in range(len(apertures)):
+                fluxes_to_cotrendy[j][i] = flux_corr[j]
+                errors[j][i] = np.sqrt(flux_corr[j])
+            times = lc_times
+            inputs[tic_files[i]] = dict(stats, row=i)
+
+    with profiler.stage('write_store'):
+        # save the outputs to the store
+        store.manifest['mask_sha1'] = mask_sha1
+        store.manifest['apertures'] = apertures
+        store.manifest['precision'] = precision.name
+        store.write_array('times', np.array(times))
+        store.write_array('objects_mask', cbv_objects_mask)
+        store.write_array('catalog', np.array([ras, decs, mags, ids]))
+        store.write_array('tic_ids', ids)
+        store.write_inputs(inputs)
+
+        # report what changed so later stages know what to recompute
+        report = {'full_rebuild': not plan['unchanged'],
+                  'added': [{'tic_id': int(ids[row_of[f]]), 'row': row_of[f]}
+                            for f in plan['added']],
+                  'updated': [{'tic_id': int(ids[row_of[f]]), 'row': row_of[f]}
+                              for f in plan['updated']],
+                  'removed': [{'tic_id': int(old_store['tic_ids'][old_inputs[f]['row']]),
+                               'old_row': old_inputs[f]['row']} for f in plan['removed']],
+                  'n_unchanged': len(plan['unchanged'])}
+        store.write_report(report)
+        store.flush()
+
+    with profiler.stage('swap_store'):
+        # swap the new store in for the old one
+        if not in_place:
+            del fluxes_to_cotrendy, errors, old_store
+            if os.path.exists(store_dir):
+                os.rename(store_dir, f"{store_dir}.old")
+                os.rename(f"{store_dir}.new", store_dir)
+                shutil.rmtree(f"{store_dir}.old")
+            else:
+                os.rename(f"{store_dir}.new", store_dir)
+            store = LightcurveStore(store_dir)
+
+    with profiler.stage('write_pointers'):
+        # the pickles Cotrendy reads only point at the store arrays,
+        # depicklifying them gives read only memory maps
+        store.write_pointers(config)
+
+    print(f"Grabbed light curves for {n_objects} objects.")
     print(f"Skipped {skipped} objects from catalog, files not found.")
+    print(f"Read {len(read_rows)} light curves: {len(plan['added'])} added, "
+          f"{len(plan['updated'])} updated, {len(plan['removed'])} removed, "
+          f"{len(plan['unchanged'])} unchanged.")
+
+    profiler.meta.update(n_objects=n_objects, n_cadences=n_cadences, n_read=len(read_rows))
+    profiler.print_summary()
+    print(f"Instrumentation report saved to {profiler.write()}")
@@ -4,6 +4,7 @@ Take the products from SGE tmpdir and store them
 import os
 import glob as g
 import argparse as ap
+from instrumentation import Instrumentation, profile_filename
 
 # pylint: disable=invalid-name
 
@@ -23,6 +24,11 @@ def arg_parse():
                    type=str,
                    help='Chip ID (e.g. 1)',
                    choices=["1", "2", "3", "4"])
+    p.add_argument('--output_mode',
+                   type=str,
+                   help='tic to copy back the updated TIC files, ccd to copy only the per-CCD product',
+                   choices=['tic', 'ccd'],
+                   default='tic')
     return p.parse_args()
 
 args = arg_parse()
@@ -31,24 +37,65 @@ root = f"/tess/photometry/tessFFIextract/lightcurves/{args.sector_id}_{args.came
 
 os.chdir(tmpdir)
 
-# copy all the fits files etc back to main data dir
-templist = g.glob('TIC-*.fits')
-n_templist = len(templist)
-for i, t in zip(range(n_templist), templist):
-    comm = f"cp -fv {t} {root}/"
-    #print(f"[{i+1}/{n_templist}] " + comm)
-    os.system(comm)
-
-templist2 = g.glob('*.pkl')
-n_templist2 = len(templist2)
-for i, t in zip(range(n_templist2), templist2):
-    comm2 = f"cp -fv {t} {root}/"
-    #print(f"[{i+1}/{n_templist2}] " + comm2)
-    os.system(comm2)
-
-templist3 = g.glob('*.toml')
-n_templist3 = len(templist3)
-for i, t in zip(range(n_templist3), templist3):
-    comm3 = f"cp -fv {t} {root}/"
-    #print(f"[{i+1}/{n_templist3}] " + comm3)
-    os.system(comm3)
+# time and profile each copy, the report goes next to the outputs
+profiler = Instrumentation('store_output', meta={'sector': args.sector_id,
+                                                 'camera': f"{args.camera_id}-{args.chip_id}",
+                                                 'output_mode': args.output_mode})
+
+# copy all the fits files etc back to main data dir, in ccd
+# mode the TIC files are untouched so there is no need
+with profiler.stage('copy_lightcurves'):
+    if args.output_mode == 'tic':
+        templist = g.glob('TIC-*.fits')
+    else:
+        templist = g.glob('*_cotrended.h5')
+    n_templist = len(templist)
+    for i, t in zip(range(n_templist), templist):
+        comm = f"cp -fv {t} {root}/"
+        #print(f"[{i+1}/{n_templist}] " + comm)
+        os.system(comm)
+
+with profiler.stage('copy_pickles'):
+    templist2 = g.glob('*.pkl')
+    n_templist2 = len(templist2)
+    for i, t in zip(range(n_templist2), templist2):
+        comm2 = f"cp -fv {t} {root}/"
+        #print(f"[{i+1}/{n_templist2}] " + comm2)
+        os.system(comm2)
+
+with profiler.stage('copy_configs'):
+    templist3 = g.glob('*.toml')
+    n_templist3 = len(templist3)
+    for i, t in zip(range(n_templist3), templist3):
+        comm3 = f"cp -fv {t} {root}/"
+        #print(f"[{i+1}/{n_templist3}] " + comm3)
+        os.system(comm3)
+
+# the CBV products
+with profiler.stage('copy_cbv_products'):
+    templist5 = g.glob('*_cbvs*.fits')
+    n_templist5 = len(templist5)
+    for i, t in zip(range(n_templist5), templist5):
+        comm5 = f"cp -fv {t} {root}/"
+        #print(f"[{i+1}/{n_templist5}] " + comm5)
+        os.system(comm5)
+
+# the light curve stores that the pointer pickles refer to
+with profiler.stage('copy_store'):
+    templist4 = g.glob('*_store')
+    n_templist4 = len(templist4)
+    for i, t in zip(range(n_templist4), templist4):
+        comm4 = f"cp -rfv {t} {root}/"
+        #print(f"[{i+1}/{n_templist4}] " + comm4)
+        os.system(comm4)
+
+# the instrumentation reports of the earlier steps
+templist6 = g.glob('profile_*.json')
+n_templist6 = len(templist6)
+for i, t in zip(range(n_templist6), templist6):
+    comm6 = f"cp -fv {t} {root}/"
+    os.system(comm6)
+
+profiler.print_summary()
+profile_file = profiler.write(os.path.join(root, profile_filename('store_output')))
+print(f"Instrumentation report saved to {profile_file}")
@@ -0,0 +1,292 @@
+"""
+Helpers for reading and writing the TESS FFI light curve files
+"""
+import os
+import re
+import hashlib
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table, Column
+from lc_store import LightcurveStore, file_stats
+
+# pylint: disable=invalid-name
+
+TIC_FILE_PATTERN = re.compile(r'^TIC-(\d+)\.fits$')
+
+def tic_index(directory='.'):
+    """
+    Scan a directory once for TIC-<id>.fits light curve files
+
+    Parameters
+    ----------
+    directory : str
+        Directory to scan
+
+    Returns
+    -------
+    tic_ids : array-like
+        Sorted TIC ids of the available light curves
+    """
+    tic_ids = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            match = TIC_FILE_PATTERN.match(entry.name)
+            if match:
+                tic_ids.append(int(match.group(1)))
+    return np.unique(np.array(tic_ids, dtype=np.int64))
+
+def aperture_radius(aperture):
+    """
+    Radius in pixels of an aperture column, e.g. AP2.5 -> 2.5
+    """
+    return float(aperture[2:])
+
+def read_tic_file(tic_file, mask, apertures=("AP2.5",)):
+    """
+    Read a TIC light curve file, apply the cadence mask
+    and subtract the sky from each requested aperture
+
+    Parameters
+    ----------
+    tic_file : str
+        Name of the TIC-<id>.fits file to read
+    mask : array-like
+        Boolean cadence mask
+    apertures : list
+        Aperture columns to read, e.g. ['AP2.5', 'AP3.0']
+
+    Returns
+    -------
+    flux_corr : array-like | None
+        Sky subtracted flux for the masked cadences,
+        one row per aperture
+    times : array-like | None
+        BJD for the masked cadences, offset to the first
+        integer day. Both are None if the file is missing
+    """
+    try:
+        with fits.open(tic_file) as ff:
+            h = ff[1].data
+            sky_median = h['SKY_MEDIAN'][mask]
+            flux_corr = np.empty((len(apertures), np.sum(mask)))
+            for i, aperture in enumerate(apertures):
+                sky = sky_median * np.pi * (aperture_radius(aperture)**2)
+                flux_corr[i] = h[aperture][mask] - sky
+            bjd = h['BJD'][mask]
+    except FileNotFoundError:
+        return None, None
+
+    times = bjd - int(bjd[0])
+    return flux_corr, times
+
+def input_digest(tic_file, apertures=("AP2.5",)):
+    """
+    Hash of the columns of a TIC file that are read (BJD, SKY_MEDIAN
+    and the apertures), so writing the COR/CBV columns back to the
+    file does not make it look changed
+
+    Parameters
+    ----------
+    tic_file : str
+        Name of the TIC-<id>.fits file
+    apertures : list
+        Aperture columns that are read
+
+    Returns
+    -------
+    sha1 : str
+        SHA1 hex digest of the columns
+    """
+    sha1 = hashlib.sha1()
+    with fits.open(tic_file) as ff:
+        h = ff[1].data
+        for column in ('BJD', 'SKY_MEDIAN', *apertures):
+            values = np.ascontiguousarray(h[column])
+            sha1.update(f"{column}:{values.dtype.str}".encode())
+            sha1.update(values.tobytes())
+    return sha1.hexdigest()
+
+def read_tic_file_with_stats(tic_file, mask, apertures=("AP2.5",)):
+    """
+    As read_tic_file, but also return the size, mtime and
+    hash of the input columns for the store's input manifest
+    """
+    flux_corr, times = read_tic_file(tic_file, mask, apertures)
+    if flux_corr is None:
+        return None, None, None
+    return flux_corr, times, file_stats(tic_file, digest=partial(input_digest,
+                                                                 apertures=apertures))
+
+def ingest_lightcurves(tic_files, mask, pool_size=1, chunksize=64,
+                       pool_type="process", with_stats=False,
+                       apertures=("AP2.5",)):
+    """
+    Read a list of TIC light curve files, optionally using
+    a pool of workers. Results are yielded in the same order
+    as tic_files, regardless of the number of workers
+
+    Parameters
+    ----------
+    tic_files : list
+        Names of the TIC-<id>.fits files to read
+    mask : array-like
+        Boolean cadence mask
+    pool_size : int
+        Number of workers, 1 reads the files serially
+    chunksize : int
+        Number of files handed to a worker at a time
+    pool_type : str
+        Use a "process" or "thread" pool of workers
+    with_stats : boolean
+        Also yield the file stats, see read_tic_file_with_stats
+    apertures : list
+        Aperture columns to read, all are read in one pass per file
+
+    Yields
+    ------
+    flux_corr, times[, stats] : array-like | None
+        See read_tic_file and read_tic_file_with_stats
+    """
+    if with_stats:
+        fn = partial(read_tic_file_with_stats, mask=mask, apertures=apertures)
+    else:
+        fn = partial(read_tic_file, mask=mask, apertures=apertures)
+
+    if pool_size <= 1:
+        for tic_file in tic_files:
+            yield fn(tic_file)
+        return
+
+    if pool_type == "thread":
+        pool_class = ThreadPool
+    elif pool_type == "process":
+        pool_class = Pool
+    else:
+        raise ValueError(f"Unknown ingest pool type {pool_type}, expected process | thread")
+
+    # imap keeps the results in input order
+    with pool_class(pool_size) as pool:
+        for result in pool.imap(fn, tic_files, chunksize=chunksize):
+            yield result
+
+def write_cotrended_columns(fits_file, mask, columns):
+    """
+    Add or update cotrending output columns in a TIC light curve
+    file. All columns are written in a single rewrite of the file.
+    The new file is written to a temporary name and renamed over
+    the original, so a killed job never leaves a half written file
+
+    Parameters
+    ----------
+    fits_file : str
+        Name of the TIC-<id>.fits file to update
+    mask : array-like
+        Boolean cadence mask, True for the cadences that were cotrended.
+        The values fill those cadences and every other cadence is -99
+    columns : dict
+        Column name (e.g. COR_AP2.5) -> values for the cadences where
+        mask is True, float32 values are written as float32 columns
+    """
+    with fits.open(fits_file) as ff:
+        table = Table(ff[1].data)
+
+    # the columns keep the precision of the values, e.g. float32
+    for name, values in columns.items():
+        output = np.full(len(mask), -99.0, dtype=np.result_type(values, np.float32))
+        output[mask] = values
+
+        # if this column already exists in the file
+        # update it, otherwise add a new Column object
+        if name in table.keys():
+            table[name] = output
+        else:
+            table.add_column(Column(name=name,
+                                    data=output,
+                                    dtype=output.dtype))
+
+    # write out the final light curve
+    tmp_file = f"{fits_file}.tmp"
+    try:
+        table.write(tmp_file, format="fits", overwrite=True)
+        os.replace(tmp_file, fits_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+# the store, mask and apertures are handed to each write back worker once
+_write_back_state = {}
+
+def _init_write_back(store_dir, mask, apertures):
+    """
+    Open the light curve store in a write back worker
+    """
+    _write_back_state['store'] = LightcurveStore(store_dir)
+    _write_back_state['mask'] = mask
+    _write_back_state['apertures'] = apertures
+
+def _write_back_one(row):
+    """
+    Write the COR/CBV columns of one store row back to its TIC file
+
+    Returns
+    -------
+    tic_id : int
+        TIC id of the row
+    error : str | None
+        Description of the failure, None on success
+    """
+    store = _write_back_state['store']
+    tic_id = int(store['tic_ids'][row])
+    fits_file = f"TIC-{tic_id}.fits"
+    columns = {}
+    for aperture in _write_back_state['apertures']:
+        columns[f"COR_{aperture}"] = store[f"cor_{aperture}"][row]
+        columns[f"CBV_{aperture}"] = store[f"cbv_{aperture}"][row]
+    try:
+        write_cotrended_columns(fits_file, _write_back_state['mask'], columns)
+    except Exception as e:
+        return tic_id, f"{type(e).__name__}: {e}"
+    return tic_id, None
+
+def write_back(store_dir, mask, apertures, pool_size=1, chunksize=16):
+    """
+    Write the cotrended outputs kept in the light curve store
+    (cor_<aperture> and cbv_<aperture>) back to every TIC file,
+    using a bounded pool of workers
+
+    Parameters
+    ----------
+    store_dir : str
+        Path to the light curve store
+    mask : array-like
+        Boolean cadence mask
+    apertures : list
+        Apertures to write, e.g. ['AP2.5']
+    pool_size : int
+        Number of workers, 1 writes the files serially
+    chunksize : int
+        Number of files handed to a worker at a time
+
+    Returns
+    -------
+    failures : dict
+        TIC id -> error, for each file that could not be updated
+    """
+    n_rows = len(LightcurveStore(store_dir)['tic_ids'])
+    init_args = (store_dir, mask, apertures)
+
+    if pool_size <= 1:
+        _init_write_back(*init_args)
+        results = map(_write_back_one, range(n_rows))
+        failures = {tic_id: error for tic_id, error in results if error is not None}
+    else:
+        with Pool(pool_size, initializer=_init_write_back, initargs=init_args) as pool:
+            results = pool.imap_unordered(_write_back_one, range(n_rows), chunksize=chunksize)
+            failures = {tic_id: error for tic_id, error in results if error is not None}
+
+    for tic_id, error in failures.items():
+        print(f"Failed to update TIC-{tic_id}.fits: {error}")
+    return failures
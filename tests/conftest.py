@@ -0,0 +1,7 @@
+"""
+The modules under test live in the top level of the repository
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,42 @@
+"""
+Tests for the local scheduler, batch_cotrend.py
+"""
+import sys
+import pytest
+from batch_cotrend import Stage, run_batch
+
+# pylint: disable=invalid-name
+
+def make_jobs(n_jobs=2):
+    """
+    Jobs of one quick compute stage and one quick I/O stage each
+    """
+    jobs, commands = {}, {}
+    for i in range(n_jobs):
+        job = f"J{i}"
+        jobs[job] = [Stage(job, 'cbvs', True, 1, 1.), Stage(job, 'store', False, 1, 1.)]
+        for stage in jobs[job]:
+            commands[(job, stage.name)] = ([sys.executable, '-c', 'pass'], None)
+    return jobs, commands
+
+def test_run_batch_runs_every_stage(tmp_path):
+    jobs, commands = make_jobs()
+    n_failed = run_batch(jobs, commands, 2, 4., 1, str(tmp_path / 'status.json'),
+                         str(tmp_path / 'logs'), poll=0.05)
+    assert n_failed == 0
+    assert all(s.state == 'done' for stages in jobs.values() for s in stages)
+
+@pytest.mark.parametrize("budget", [(0, 4., 1), (2, 0.5, 1), (2, 4., 0)])
+def test_run_batch_rejects_small_budgets(tmp_path, budget):
+    jobs, commands = make_jobs()
+    with pytest.raises(ValueError):
+        run_batch(jobs, commands, *budget, str(tmp_path / 'status.json'),
+                  str(tmp_path / 'logs'), poll=0.05)
+
+def test_run_batch_raises_on_stages_never_started(tmp_path):
+    jobs, commands = make_jobs(n_jobs=1)
+    # a stage in a state the scheduler never starts is left pending
+    jobs['J0'][0].state = 'blocked'
+    with pytest.raises(RuntimeError):
+        run_batch(jobs, commands, 2, 4., 1, str(tmp_path / 'status.json'),
+                  str(tmp_path / 'logs'), poll=0.05)
@@ -0,0 +1,64 @@
+"""
+Tests for the truncated SVD and its comparison with cotrendy's CBVs
+"""
+from types import SimpleNamespace
+import numpy as np
+import scipy.linalg
+from cbv_svd import truncated_svd, swapped_svd, compare_svd
+
+# pylint: disable=invalid-name
+
+def make_flux(n_stars=80, n_cadences=400, n_trends=3, seed=4):
+    """
+    CBV star fluxes made of a few smooth trends plus noise
+    """
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, 1, n_cadences)
+    trends = np.array([np.sin((k + 1) * np.pi * t) for k in range(n_trends)])
+    weights = rng.normal(size=(n_stars, n_trends)) * [5., 3., 1.][:n_trends]
+    return weights @ trends + 0.01 * rng.normal(size=(n_stars, n_cadences))
+
+def cbvs_from_svd(flux, k, mode):
+    """
+    Stand in for a CBVs object holding the leading k components
+    """
+    _, s, VT = truncated_svd(flux, k, mode=mode)
+    return SimpleNamespace(vect_store=VT, s=s, cbvs=dict(enumerate(VT)),
+                           cbvs_snr={i: 0. for i in range(k)})
+
+def test_randomised_matches_exact():
+    flux = make_flux()
+    _, s, VT = truncated_svd(flux, 3, mode="exact")
+    _, s_r, VT_r = truncated_svd(flux, 3, mode="randomised")
+    np.testing.assert_allclose(s_r, s, rtol=1e-8)
+    np.testing.assert_allclose(np.abs(np.sum(VT * VT_r, axis=1)), 1., atol=1e-8)
+
+def test_compare_svd_same_cbvs():
+    flux = make_flux()
+    report = compare_svd(cbvs_from_svd(flux, 3, "exact"), cbvs_from_svd(flux, 3, "randomised"))
+    assert report['n_cbvs'] == report['n_cbvs_cotrendy'] == 3
+    assert max(report['singular_value_rel_diff']) < 1e-8
+    np.testing.assert_allclose(report['abs_cosine'], 1., atol=1e-8)
+    assert max(report['principal_angles_deg']) < 1e-3
+
+def test_compare_svd_flags_reordered_cbvs():
+    flux = make_flux()
+    reference = cbvs_from_svd(flux, 3, "exact")
+    other = cbvs_from_svd(flux, 3, "exact")
+    other.vect_store = other.vect_store[::-1]
+    report = compare_svd(reference, other)
+    # the same subspace, but the CBVs with the same id differ
+    assert max(report['principal_angles_deg']) < 1e-3
+    assert report['abs_cosine'][0] < 0.01
+
+def test_swapped_svd_truncates_and_restores():
+    flux = make_flux()
+    original_np, original_scipy = np.linalg.svd, scipy.linalg.svd
+    with swapped_svd(3, mode="exact") as calls:
+        U, s, VT = np.linalg.svd(flux)
+        s_only = scipy.linalg.svd(flux, compute_uv=False)
+    assert calls == [flux.shape, flux.shape]
+    assert U.shape == (len(flux), 3) and VT.shape == (3, flux.shape[1])
+    np.testing.assert_allclose(s_only, s)
+    np.testing.assert_allclose(s, np.linalg.svd(flux, compute_uv=False)[:3], rtol=1e-10)
+    assert np.linalg.svd is original_np and scipy.linalg.svd is original_scipy
@@ -0,0 +1,50 @@
+"""
+Check the batched engines against cotrendy's own per-star fits,
+only run where cotrendy is installed
+"""
+import numpy as np
+import pytest
+from fitting import (check_ls_engine, check_robust_engine, cotrend_data_ls_batched,
+                     LS_TOLERANCE, ROBUST_TOLERANCE)
+
+cotrendy_cbvs = pytest.importorskip("cotrendy.cbvs")
+
+# pylint: disable=invalid-name
+
+def make_cbvs(n_stars=200, n_cadences=300, n_cbvs=4, seed=3):
+    """
+    A cotrendy CBVs object for stars made from smooth CBVs,
+    noise and a few outliers
+    """
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, 1, n_cadences)
+    vect_store = np.array([np.cos((k + 1) * np.pi * t) for k in range(n_cbvs)])
+    vect_store /= np.linalg.norm(vect_store, axis=1)[:, None]
+    flux = rng.normal(size=(n_stars, n_cbvs)) @ vect_store * 0.05
+    flux += 1e-3 * rng.normal(size=flux.shape)
+    flux[rng.integers(0, n_stars, 50), rng.integers(0, n_cadences, 50)] += 0.05
+
+    cbvs = object.__new__(cotrendy_cbvs.CBVs)
+    cbvs.norm_flux_array = flux
+    cbvs.vect_store = vect_store
+    cbvs.cbvs = {k: vect_store[k] for k in range(n_cbvs)}
+    cbvs.n_cbvs = n_cbvs
+    cbvs.fit_coeffs = {}
+    return cbvs
+
+def test_batched_ls_matches_cotrendy():
+    cbvs = make_cbvs()
+    assert check_ls_engine(cbvs, n_check=50) <= LS_TOLERANCE
+
+def test_batched_ls_outputs_match_cotrendy():
+    cbvs = make_cbvs(n_stars=50)
+    cbvs.cotrend_data_ls()
+    cotrended = np.array(cbvs.cotrended_flux_array)
+    cotrending = np.array(cbvs.cotrending_flux_array)
+    cotrend_data_ls_batched(cbvs, chunk_rows=16)
+    np.testing.assert_allclose(cbvs.cotrending_flux_array, cotrending, rtol=1e-8, atol=1e-12)
+    np.testing.assert_allclose(cbvs.cotrended_flux_array, cotrended, rtol=1e-8, atol=1e-12)
+
+def test_batched_robust_fits_match_cotrendy():
+    cbvs = make_cbvs()
+    assert check_robust_engine(cbvs, n_check=100, block_rows=32) <= ROBUST_TOLERANCE
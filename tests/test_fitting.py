@@ -0,0 +1,138 @@
+"""
+Tests for the batched fitting engines in fitting.py
+"""
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from fitting import (factorise_cbvs, fit_ls_block, cotrend_ls_batched, cbv_order,
+                     robust_fit_block, robust_fit_coeffs_batched,
+                     calculate_robust_fit_coeffs_batched, cotrend_ls_stream)
+
+# pylint: disable=invalid-name
+
+def make_block(n_stars=10, n_cadences=50, n_cbvs=3, seed=1):
+    """
+    Stars made from random CBVs plus a little noise
+    """
+    rng = np.random.default_rng(seed)
+    vect_store = rng.normal(size=(n_cbvs, n_cadences))
+    coeffs = rng.normal(size=(n_stars, n_cbvs))
+    flux = coeffs @ vect_store + 0.01 * rng.normal(size=(n_stars, n_cadences))
+    return flux, vect_store
+
+def lstsq_finite(flux, vect_store):
+    """
+    Reference per-star least squares on the finite cadences
+    """
+    coeffs = np.empty((len(flux), len(vect_store)))
+    for i, row in enumerate(flux):
+        finite = np.isfinite(row)
+        coeffs[i] = np.linalg.lstsq(vect_store[:, finite].T, row[finite], rcond=None)[0]
+    return coeffs
+
+def test_fit_ls_block_matches_lstsq():
+    flux, vect_store = make_block()
+    Q, R = factorise_cbvs(vect_store)
+    coeffs, cotrending = fit_ls_block(flux, Q, R)
+    np.testing.assert_allclose(coeffs, lstsq_finite(flux, vect_store), rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(cotrending, coeffs @ vect_store, rtol=1e-10, atol=1e-12)
+
+def test_fit_ls_block_single_nan():
+    flux, vect_store = make_block()
+    flux[3, 17] = np.nan
+    Q, R = factorise_cbvs(vect_store)
+    coeffs, cotrending = fit_ls_block(flux, Q, R)
+    np.testing.assert_allclose(coeffs, lstsq_finite(flux, vect_store), rtol=1e-10, atol=1e-12)
+    assert np.all(np.isfinite(cotrending))
+
+def test_cotrend_ls_batched_gappy_rows():
+    flux, vect_store = make_block(n_stars=25)
+    flux[0, :5] = np.nan
+    flux[7, 10:30:3] = np.nan
+    flux[19, -1] = np.inf
+    coeffs, cotrended, cotrending = cotrend_ls_batched(flux, vect_store, chunk_rows=8)
+
+    reference = lstsq_finite(flux, vect_store)
+    np.testing.assert_allclose(coeffs, reference, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(cotrending, reference @ vect_store, rtol=1e-10, atol=1e-12)
+    # the gaps stay gaps in the cotrended fluxes, everything else is fitted
+    np.testing.assert_array_equal(np.isfinite(cotrended), np.isfinite(flux))
+
+def test_cotrend_ls_batched_too_few_cadences():
+    flux, vect_store = make_block()
+    flux[2, 2:] = np.nan
+    coeffs, cotrended, cotrending = cotrend_ls_batched(flux, vect_store)
+    assert np.all(np.isnan(coeffs[2])) and np.all(np.isnan(cotrending[2]))
+    assert np.all(np.isnan(cotrended[2]))
+    np.testing.assert_allclose(np.delete(coeffs, 2, axis=0),
+                               lstsq_finite(np.delete(flux, 2, axis=0), vect_store),
+                               rtol=1e-10, atol=1e-12)
+
+def make_cbvs(flux, vect_store, cbv_ids=None):
+    """
+    Minimal stand in for a cotrendy CBVs object, with the
+    attributes the batched engines read
+    """
+    cbv_ids = list(range(len(vect_store))) if cbv_ids is None else cbv_ids
+    return SimpleNamespace(norm_flux_array=flux, vect_store=vect_store,
+                           cbvs={cbv_id: vector for cbv_id, vector in zip(cbv_ids, vect_store)})
+
+def test_cbv_order_follows_vect_store_rows():
+    flux, vect_store = make_block()
+    cbvs = make_cbvs(flux, vect_store, cbv_ids=[2, 0, 1])
+    assert cbv_order(cbvs) == [2, 0, 1]
+
+def test_cbv_order_rejects_mismatch():
+    flux, vect_store = make_block()
+    cbvs = make_cbvs(flux, vect_store)
+    cbvs.cbvs[1] = -vect_store[1]
+    with pytest.raises(ValueError):
+        cbv_order(cbvs)
+
+def test_robust_fit_block_ignores_outliers():
+    flux, vect_store = make_block(n_stars=20, n_cadences=200)
+    clean = lstsq_finite(flux, vect_store)
+    rng = np.random.default_rng(2)
+    spoilt = flux.copy()
+    rows = rng.integers(0, len(flux), size=40)
+    cols = rng.integers(0, flux.shape[1], size=40)
+    spoilt[rows, cols] += 50.
+    coeffs = robust_fit_block(spoilt, vect_store)
+    assert np.max(np.abs(coeffs - clean)) < 0.01
+    assert np.max(np.abs(lstsq_finite(spoilt, vect_store) - clean)) > 0.1
+
+def test_calculate_robust_fit_coeffs_batched_keys():
+    flux, vect_store = make_block(n_stars=30)
+    cbvs = make_cbvs(flux, vect_store, cbv_ids=[5, 3, 4])
+    calculate_robust_fit_coeffs_batched(cbvs, block_rows=7)
+    coeffs = robust_fit_coeffs_batched(flux, vect_store, block_rows=7)
+    for k, cbv_id in enumerate([5, 3, 4]):
+        np.testing.assert_allclose(cbvs.fit_coeffs[cbv_id], coeffs[:, k], rtol=1e-10, atol=1e-12)
+
+def test_stream_matches_batched():
+    flux, vect_store = make_block(n_stars=25)
+    raw = 1000. * (1. + 0.01 * flux)
+    raw[3, 7] = np.nan
+    cor, cbv = np.empty_like(raw), np.empty_like(raw)
+    coeffs, bad = cotrend_ls_stream(raw, vect_store, cor, cbv, chunk_rows=10)
+    assert not bad.any()
+
+    # the same fit on the fluxes normalised up front
+    med = np.nanmedian(raw, axis=1, keepdims=True)
+    ref_coeffs, cotrended, cotrending = cotrend_ls_batched((raw - med) / med, vect_store)
+    np.testing.assert_allclose(coeffs, ref_coeffs, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(cbv, cotrending, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(cor, cotrended * med + med, rtol=1e-10)
+
+def test_stream_flags_unnormalisable_stars():
+    flux, vect_store = make_block(n_stars=6)
+    raw = 1000. * (1. + 0.01 * flux)
+    raw[1] = np.nan
+    raw[2] = -raw[2]
+    raw[4] = 0.
+    cor, cbv = np.empty_like(raw), np.empty_like(raw)
+    coeffs, bad = cotrend_ls_stream(raw, vect_store, cor, cbv, chunk_rows=4)
+    np.testing.assert_array_equal(bad, [False, True, True, False, True, False])
+    for out in (coeffs, cor, cbv):
+        assert np.isnan(out[bad]).all()
+        assert np.isfinite(out[~bad]).all()
@@ -0,0 +1,140 @@
+"""
+Tests for sharing cotrendy's MAP inputs with its workers, map_cotrendy.py
+"""
+import json
+import pickle
+from functools import partial
+from multiprocessing import Pool
+import numpy as np
+from map_cotrendy import shared_attributes, SharedNDArray, cotrend_data_map_cotrendy
+
+# pylint: disable=invalid-name
+
+class Holder():
+    """
+    Stand in for the CBVs object and its light curves
+    """
+
+def make_holder(n_stars=200, n_cadences=500, seed=1):
+    """
+    An object with an array, a dict of arrays and a list of light curves
+    """
+    rng = np.random.default_rng(seed)
+    obj = Holder()
+    obj.norm_flux_array = rng.random((n_stars, n_cadences))
+    obj.fit_coeffs = {0: rng.random(n_stars), 1: rng.random(n_stars)}
+    obj.lightcurves = []
+    for _ in range(n_stars):
+        lc = Holder()
+        lc.flux = rng.random(n_cadences)
+        obj.lightcurves.append(lc)
+    obj.small = np.arange(3)
+    return obj
+
+def star_sum(i, obj):
+    """
+    A per-star task reading every kind of shared attribute
+    """
+    assert isinstance(obj.norm_flux_array, SharedNDArray)
+    assert not obj.norm_flux_array.flags.writeable
+    return float(obj.norm_flux_array[i].sum() + obj.fit_coeffs[1][i] +
+                 obj.lightcurves[i].flux.sum())
+
+def test_shared_attributes_pickle_by_reference():
+    obj = make_holder()
+    expected = [float(obj.norm_flux_array[i].sum() + obj.fit_coeffs[1][i] +
+                      obj.lightcurves[i].flux.sum()) for i in range(200)]
+    full_size = len(pickle.dumps(obj))
+    with shared_attributes([obj], min_bytes=1000) as n_bytes:
+        assert n_bytes > 0
+        assert len(pickle.dumps(obj)) < full_size / 10
+        # arrays made from the shared ones pickle as ordinary arrays
+        assert not isinstance(pickle.loads(pickle.dumps(obj.norm_flux_array * 2)),
+                              SharedNDArray)
+        with Pool(2) as pool:
+            results = pool.map(partial(star_sum, obj=obj), range(200))
+    np.testing.assert_allclose(results, expected)
+
+def test_shared_attributes_restore():
+    obj = make_holder()
+    original = obj.norm_flux_array
+    original_flux = obj.lightcurves[0].flux
+    with shared_attributes([obj], min_bytes=1000):
+        obj.norm_flux_array[0, 0] = 5.
+        obj.lightcurves[0].flux[0] = 7.
+    assert obj.norm_flux_array is original
+    assert obj.lightcurves[0].flux is original_flux
+    assert original[0, 0] == 5.
+    assert original_flux[0] == 7.
+    assert not isinstance(obj.fit_coeffs[0], SharedNDArray)
+    assert not isinstance(obj.small, SharedNDArray)
+
+def fit_star(i, cbvs):
+    """
+    Stand in for cotrendy's MAP fit of one star
+    """
+    return cbvs.norm_flux_array[i] - cbvs.fit_coeffs[0][i] * cbvs.vect_store[0]
+
+class FakeCBVs():
+    """
+    Stand in for cotrendy's CBVs, mapping its stars over this module's Pool
+    """
+    def __init__(self, n_stars=40, n_cadences=100, seed=2):
+        rng = np.random.default_rng(seed)
+        self.norm_flux_array = rng.random((n_stars, n_cadences))
+        self.vect_store = rng.random((1, n_cadences))
+        self.cbvs = {0: self.vect_store[0]}
+        self.fit_coeffs = {0: rng.random(n_stars)}
+        self.variability = rng.uniform(0.5, 2., n_stars)
+        self.cotrended_flux_array = None
+
+    def cotrend_data_map_mp(self, catalog):
+        """
+        Fit every star in a pool
+        """
+        assert catalog is not None
+        with Pool(2) as pool:
+            self.cotrended_flux_array = np.array(pool.map(partial(fit_star, cbvs=self),
+                                                          range(len(self.norm_flux_array))))
+
+def map_config(tmp_path):
+    """
+    Config with the MAP status, latency and journal files in tmp_path
+    """
+    return {'data': {'map_status_file': str(tmp_path / "status.json"),
+                     'map_latency_file': str(tmp_path / "latency.txt"),
+                     'map_journal_dir': str(tmp_path / "journal")},
+            'cotrend': {'prior_normalised_variability_limit': 0.85, 'pool_size': 2}}
+
+def test_cotrendy_map_telemetry(tmp_path):
+    cbvs = FakeCBVs()
+    expected = np.array([fit_star(i, cbvs) for i in range(40)])
+    cotrend_data_map_cotrendy(cbvs, Holder(), map_config(tmp_path), tic_ids=np.arange(40) + 100)
+    np.testing.assert_array_equal(cbvs.cotrended_flux_array, expected)
+    with open(tmp_path / "status.json", 'r') as sf:
+        status = json.load(sf)
+    assert status['finished'] and status['n_done'] == 40 and status['n_resumed'] == 0
+    latency = np.loadtxt(tmp_path / "latency.txt")
+    assert len(latency) == 40 and np.all(latency[:, 2] >= 0)
+    np.testing.assert_array_equal(latency[:, 1], np.arange(40) + 100)
+
+def test_cotrendy_map_journal_resume(tmp_path):
+    cbvs = FakeCBVs()
+    config = map_config(tmp_path)
+    cotrend_data_map_cotrendy(cbvs, Holder(), config)
+    expected = cbvs.cotrended_flux_array
+
+    # a run killed part way through a record
+    tasks_file = tmp_path / "journal" / "tasks.bin"
+    tasks_file.write_bytes(tasks_file.read_bytes()[:-10])
+    cbvs.cotrended_flux_array = None
+    cotrend_data_map_cotrendy(cbvs, Holder(), config)
+    np.testing.assert_array_equal(cbvs.cotrended_flux_array, expected)
+    with open(tmp_path / "status.json", 'r') as sf:
+        assert json.load(sf)['n_resumed'] == 39
+
+    # different inputs start afresh
+    cbvs.fit_coeffs[0] = cbvs.fit_coeffs[0] + 1
+    cotrend_data_map_cotrendy(cbvs, Holder(), config)
+    with open(tmp_path / "status.json", 'r') as sf:
+        assert json.load(sf)['n_resumed'] == 0
@@ -0,0 +1,64 @@
+"""
+Tests for the adaptive grid search of the kde MAP engine in map_fit.py
+"""
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from map_fit import (theta_grids, cotrendy_theta, neighbour_index, prior_weight,
+                     check_adaptive, cotrend_map_kde, ADAPTIVE_TOLERANCE)
+
+# pylint: disable=invalid-name
+
+def make_stars(n_stars=300, n_cadences=200, n_cbvs=3, seed=5):
+    """
+    Stars made from smooth CBVs, with coefficients that vary smoothly
+    across the sky so the neighbours make a useful prior
+    """
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, 1, n_cadences)
+    vect_store = np.array([np.cos((k + 1) * np.pi * t) for k in range(n_cbvs)])
+    vect_store /= np.linalg.norm(vect_store, axis=1)[:, None]
+    coords = rng.uniform(size=(n_stars, 3))
+    coeffs = np.column_stack([np.sin(3 * coords[:, 0] + k) for k in range(n_cbvs)])
+    flux = coeffs @ vect_store + 0.02 * rng.normal(size=(n_stars, n_cadences))
+    fit_coeffs = coeffs + 0.05 * rng.normal(size=coeffs.shape)
+    variability = rng.uniform(0.5, 3., size=n_stars)
+    return flux, vect_store, fit_coeffs, variability, coords
+
+def test_check_adaptive_within_tolerance():
+    flux, vect_store, fit_coeffs, variability, coords = make_stars()
+    theta = theta_grids(fit_coeffs, n_theta=300)
+    neighbours, distances = neighbour_index(coords, 20)
+    report = check_adaptive(flux, vect_store, fit_coeffs, prior_weight(variability, 0.85),
+                            neighbours, distances, theta, np.arange(0, 300, 7))
+    assert len(report['step_diff']) == len(range(0, 300, 7))
+    assert report['max_step_diff'] <= ADAPTIVE_TOLERANCE
+
+def test_adaptive_matches_fixed_on_given_grid():
+    flux, vect_store, fit_coeffs, variability, coords = make_stars()
+    theta = theta_grids(fit_coeffs, n_theta=200, pad=1.)
+    fixed = cotrend_map_kde(flux, vect_store, fit_coeffs, variability, coords, 0.85,
+                            n_neighbours=20, theta=theta, theta_mode="fixed")
+    adaptive = cotrend_map_kde(flux, vect_store, fit_coeffs, variability, coords, 0.85,
+                               n_neighbours=20, theta=theta, theta_mode="adaptive",
+                               check_rows=np.arange(20))
+    np.testing.assert_array_equal(adaptive[3], theta)
+    step = theta[:, 1] - theta[:, 0]
+    assert np.max(np.abs(adaptive[0] - fixed[0]) / step) <= ADAPTIVE_TOLERANCE
+
+def test_adaptive_check_failure_raises(monkeypatch):
+    flux, vect_store, fit_coeffs, variability, coords = make_stars(n_stars=50)
+    monkeypatch.setattr("map_fit.ADAPTIVE_TOLERANCE", -1)
+    with pytest.raises(RuntimeError):
+        cotrend_map_kde(flux, vect_store, fit_coeffs, variability, coords, 0.85,
+                        n_neighbours=10, n_theta=100, theta_mode="adaptive",
+                        check_rows=np.arange(5))
+
+def test_cotrendy_theta():
+    grids = {0: np.linspace(-1, 1, 50), 1: np.linspace(-2, 2, 50)}
+    np.testing.assert_array_equal(cotrendy_theta(SimpleNamespace(theta=grids), [1, 0]),
+                                  np.vstack([grids[1], grids[0]]))
+    assert cotrendy_theta(SimpleNamespace(), [0, 1]) is None
+    assert cotrendy_theta(SimpleNamespace(theta={0: grids[0]}), [0, 1]) is None
+    uneven = {0: np.geomspace(1, 2, 50), 1: grids[1]}
+    assert cotrendy_theta(SimpleNamespace(theta=uneven), [0, 1]) is None
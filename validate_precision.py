@@ -0,0 +1,242 @@
+"""
+Compare the float32 precision mode against the float64 path
+
+A random sample of light curves, topped up with a sample of the CBV
+stars, is read from the TIC files in float64. The sample is put in two
+temporary light curve stores, one float64 and one float32, and each is
+run through cotrend_tess_lcs.cotrend_aperture in its own temporary
+working directory, exactly as a cotrending run with that precision
+would be. Nothing in the real store, its checkpoints or the CBV cache is
+touched. The CBVs, the robust fit coefficients and the cotrended
+outputs of the two runs are compared, and the largest deviations are
+printed and saved to the light curve store
+"""
+import os
+import copy
+import tempfile
+import argparse as ap
+import numpy as np
+from astropy.io import fits
+import cotrendy.utils as cuts
+from lc_store import LightcurveStore, store_dirname, config_apertures, aperture_config
+from cbv_product import CBVProduct
+from tess_io import read_tic_file
+from checkpoint import CheckpointStore, unpack_fit_coeffs
+from fitting import cbv_order
+from cotrend_tess_lcs import cotrend_aperture, STAGES
+
+# pylint: disable=invalid-name
+
+def arg_parse():
+    """
+    Parse the command line arguments
+    """
+    p = ap.ArgumentParser()
+    p.add_argument('config',
+                   help='path to config file')
+    p.add_argument('--aperture',
+                   help='aperture to check, defaults to the first in the config')
+    p.add_argument('--n_stars',
+                   help='number of light curves to compare, and of CBV stars among them',
+                   type=int,
+                   default=500)
+    p.add_argument('--seed',
+                   help='seed for picking the light curves',
+                   type=int,
+                   default=0)
+    return p.parse_args()
+
+def sample_store(directory, store, aperture, rows, flux, precision):
+    """
+    Make a light curve store holding only some rows of another, with
+    the fluxes given, as the prepare step would have made it
+
+    Parameters
+    ----------
+    directory : str
+        Path of the new store
+    store : LightcurveStore
+        Store the rows are taken from
+    aperture : str
+        Aperture column of the fluxes, e.g. AP2.5
+    rows : array-like
+        Rows of the store to keep, sorted
+    flux : array-like
+        Raw float64 fluxes of those rows, (n_rows, n_cadences)
+    precision : np.dtype
+        dtype of the fluxes and errors in the new store
+
+    Returns
+    -------
+    sample : LightcurveStore
+        The new store, writeable
+    """
+    sample = LightcurveStore.create(directory)
+    sample.write_array(f"flux_{aperture}", np.asarray(flux, dtype=precision))
+    sample.write_array(f"error_{aperture}", np.sqrt(flux).astype(precision))
+    sample.write_array('times', np.asarray(store['times']))
+    sample.write_array('objects_mask', np.asarray(store['objects_mask'])[rows])
+    sample.write_array('catalog', np.asarray(store['catalog'])[:, rows])
+    sample.write_array('tic_ids', np.asarray(store['tic_ids'])[rows])
+    sample.manifest['mask_sha1'] = store.manifest.get('mask_sha1')
+    sample.manifest['apertures'] = [aperture]
+    sample.manifest['precision'] = np.dtype(precision).name
+
+    # renumber the input manifest so the checkpoints are keyed as usual
+    new_row = {int(row): i for i, row in enumerate(rows)}
+    sample.write_inputs({tic_file: dict(info, row=new_row[info['row']])
+                         for tic_file, info in store.read_inputs().items()
+                         if info['row'] in new_row})
+    sample.flush()
+    return LightcurveStore(directory, mode='r+')
+
+def sample_config(config, aperture, root, precision):
+    """
+    Copy of the config for cotrending a sample store in a temporary
+    working directory, with the CBV cache, journals and status files
+    turned off so nothing outside it is read or written
+
+    Parameters
+    ----------
+    config : dict
+        Cotrendy configuration of the real run
+    aperture : str
+        Aperture column, e.g. AP2.5
+    root : str
+        Temporary working directory
+    precision : np.dtype
+        Precision of the sample store
+
+    Returns
+    -------
+    config : dict
+        Cotrendy configuration for the sample
+    """
+    config = copy.deepcopy(config)
+    config['global']['root'] = root
+    data = config['data']
+    data.update(apertures=[aperture], precision=np.dtype(precision).name,
+                store_dir="store", checkpoint_dir="checkpoints",
+                cbv_file="cbvs.pkl", cbv_product_file="cbvs.fits",
+                cbv_cache=False, pickle_cbvs_object=False)
+    for key in ('map_status_file', 'map_latency_file', 'map_journal_dir'):
+        data.pop(key, None)
+    # the test stars are rows of the full catalog, not of the sample
+    config['cotrend']['test_stars'] = []
+    return config
+
+def run_precision(config, store, aperture, rows, flux, precision, directory):
+    """
+    Cotrend a sample of stars through cotrend_aperture in one precision
+
+    Returns
+    -------
+    results : dict
+        The CBV product, the robust fit coefficients (n_stars, n_cbvs)
+        and the cotrended fluxes and CBV models of the sample
+    """
+    root = os.path.join(directory, np.dtype(precision).name)
+    os.makedirs(root)
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        ap_config = aperture_config(sample_config(config, aperture, root, precision), aperture)
+        sample = sample_store(store_dirname(ap_config), store, aperture, rows, flux, precision)
+        sample.write_pointers(ap_config)
+        cotrend_aperture(ap_config, sample, aperture)
+
+        checkpoints = CheckpointStore(ap_config['data']['checkpoint_dir'], STAGES,
+                                      inputs_key=sample.inputs_key())
+        fit_coeffs = unpack_fit_coeffs(checkpoints.load('robust_fits'))
+        cbv_product = CBVProduct.read(ap_config['data']['cbv_product_file'])
+        return {'cbv_product': cbv_product,
+                'fit_coeffs': np.column_stack([fit_coeffs[cbv_id]
+                                               for cbv_id in cbv_order(cbv_product)]),
+                'cor': np.asarray(sample[f"cor_{aperture}"], dtype=np.float64),
+                'cbv': np.asarray(sample[f"cbv_{aperture}"], dtype=np.float64)}
+    finally:
+        os.chdir(cwd)
+
+def compare_runs(run64, run32, flux):
+    """
+    Largest deviations of the float32 run from the float64 one
+
+    The SVD leaves the sign of each CBV free, so the CBVs and robust
+    fit coefficients are compared after matching the signs, and the
+    cotrending through the CBV models, which do not depend on them
+
+    Parameters
+    ----------
+    run64, run32 : dict
+        Results of run_precision in float64 and float32
+    flux : array-like
+        Raw float64 fluxes of the sample
+
+    Returns
+    -------
+    report : dict
+        Largest deviations of the float32 run
+    """
+    vect64 = run64['cbv_product'].vect_store
+    vect32 = run32['cbv_product'].vect_store
+    n_cbvs = min(len(vect64), len(vect32))
+    cosine = np.sum(vect64[:n_cbvs] * vect32[:n_cbvs], axis=1) / \
+        (np.linalg.norm(vect64[:n_cbvs], axis=1) * np.linalg.norm(vect32[:n_cbvs], axis=1))
+    s64, s32 = run64['cbv_product'].s[:n_cbvs], run32['cbv_product'].s[:n_cbvs]
+
+    robust64 = run64['fit_coeffs'][:, :n_cbvs]
+    robust32 = run32['fit_coeffs'][:, :n_cbvs] * np.sign(cosine)
+    spread = np.maximum(np.nanstd(robust64, axis=0), np.finfo(float).tiny)
+
+    # compare to each star's point to point scatter, the
+    # deviations only matter relative to the noise
+    cor64, cor32 = run64['cor'], run32['cor']
+    noise = np.nanmedian(np.abs(np.diff(cor64, axis=1)), axis=1) / 0.6745 / np.sqrt(2.)
+    noise[~(noise > 0)] = np.finfo(float).tiny
+    cor_diff = np.abs(cor32 - cor64)
+    return {'n_stars': len(flux),
+            'n_cbvs_float64': len(vect64),
+            'n_cbvs_float32': len(vect32),
+            'flux_max_rel_diff': float(np.nanmax(np.abs(flux.astype(np.float32) - flux)
+                                                 / np.abs(flux))),
+            'cbv_singular_value_max_rel_diff': float(np.max(np.abs(s32 - s64) / s64)),
+            'cbv_min_abs_cosine': float(np.min(np.abs(cosine))),
+            'robust_max_diff_over_spread': float(np.nanmax(np.abs(robust32 - robust64)
+                                                           / spread)),
+            'cor_max_abs_diff': float(np.nanmax(cor_diff)),
+            'cor_max_rel_diff': float(np.nanmax(cor_diff / np.abs(cor64))),
+            'cor_max_diff_over_noise': float(np.nanmax(cor_diff / noise[:, None])),
+            'cbv_max_abs_diff': float(np.nanmax(np.abs(run32['cbv'] - run64['cbv'])))}
+
+if __name__ == "__main__":
+    args = arg_parse()
+    config = cuts.load_config(args.config)
+    os.chdir(config['global']['root'])
+    aperture = args.aperture or config_apertures(config)[0]
+
+    with fits.open(config['data']['cadence_mask_file']) as mf:
+        mask = mf[1].data['MASK']
+
+    # the real store is only read, the report aside
+    store = LightcurveStore(store_dirname(config))
+
+    # a sample of all the light curves, topped up with CBV stars so the
+    # sample has its own CBVs, read straight from the TIC files in float64
+    tic_ids = np.asarray(store['tic_ids'])
+    rng = np.random.default_rng(args.seed)
+    rows = rng.choice(len(tic_ids), size=min(args.n_stars, len(tic_ids)), replace=False)
+    cbv_rows = np.where(store['objects_mask'])[0]
+    cbv_rows = rng.choice(cbv_rows, size=min(args.n_stars, len(cbv_rows)), replace=False)
+    rows = np.union1d(rows, cbv_rows)
+    flux = np.array([read_tic_file(f"TIC-{tic_ids[row]}.fits", mask,
+                                   apertures=[aperture])[0][0] for row in rows])
+
+    with tempfile.TemporaryDirectory(prefix="validate_precision_", dir=".") as tmpdir:
+        runs = {precision: run_precision(config, store, aperture, rows, flux, precision,
+                                         os.path.abspath(tmpdir))
+                for precision in (np.float64, np.float32)}
+    report = dict(compare_runs(runs[np.float64], runs[np.float32], flux),
+                  cbv_mode=config['cotrend']['cbv_mode'], aperture=aperture)
+    for key, value in report.items():
+        print(f"{key}: {value}")
+    store.write_report(report, filename=f"precision_report_{aperture}.json")
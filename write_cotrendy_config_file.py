@@ -32,6 +32,14 @@ def arg_parse():
                    type=str,
                    help='CBV fitting mode, MAP | LS',
                    choices=['MAP', 'LS'])
+    p.add_argument('--write_pool_size',
+                   type=int,
+                   help='number of workers writing the cotrended light curves back',
+                   default=8)
+    p.add_argument('--robust_pool_size',
+                   type=int,
+                   help='number of processes for the batched robust fits',
+                   default=1)
     return p.parse_args()
 
 args = arg_parse()
@@ -78,10 +86,55 @@ error_file = "tess_{args.sector_id}_{args.camera_id}-{args.chip_id}_errors.pkl"
 cadence_mask_file = "/tess/photometry/tessFFIextract/masks/{args.sector_id}_{args.camera_id}-{args.chip_id}_mask.fits"
 # name of the cbv pickle file
 cbv_file = "tess_{args.sector_id}_{args.camera_id}-{args.chip_id}_cbvs.pkl"
+# slim CBV product (vectors, SNRs, CBV star mask, singular values), if this
+# exists the CBVs are loaded from it rather than calculated again
+cbv_product_file = "tess_{args.sector_id}_{args.camera_id}-{args.chip_id}_cbvs.fits"
+# directory of per-stage checkpoints, reruns resume at the first incomplete stage
+checkpoint_dir = "tess_{args.sector_id}_{args.camera_id}-{args.chip_id}_checkpoints"
+# pickle the whole CBVs object to cbv_file at the end, for the diagnostics
+pickle_cbvs_object = true
 # file with ids of objects considered for CVBs
 objects_mask_file = "tess_{args.sector_id}_{args.camera_id}-{args.chip_id}_objects_mask.pkl"
+# directory of memory mappable arrays written by the prepare step, the
+# time, flux, error, objects mask and catalog pickles only point into it
+store_dir = "tess_{args.sector_id}_{args.camera_id}-{args.chip_id}_store"
+# aperture columns to cotrend, all are read and written in one pass per file
+# with more than one, the flux, error and cbv file names get an _APx.x suffix
+apertures = ["AP2.5"]
 # reject outliers in the data, as per PLATO outlier rejection?
 reject_outliers = false
+# number of workers used to read the light curves, 1 reads them serially
+ingest_pool_size = {args.pool_size}
+# number of light curves handed to each ingest worker at a time
+ingest_chunksize = 64
+# read the light curves using a "process" or "thread" pool
+ingest_pool_type = "process"
+# "tic" writes the cotrended columns back into every TIC file, "ccd" keeps
+# them all in a single per-CCD HDF5 product instead (needs h5py)
+output_mode = "tic"
+# per-CCD product file and its compression (e.g. "gzip", "lzf"), ccd mode only
+ccd_product_file = "tess_{args.sector_id}_{args.camera_id}-{args.chip_id}_cotrended.h5"
+ccd_product_compression = "gzip"
+# number of workers writing the cotrended columns back to the light curves
+write_pool_size = {args.write_pool_size}
+# progress of the MAP fits, rewritten every map_status_interval seconds
+map_status_file = "tess_{args.sector_id}_{args.camera_id}-{args.chip_id}_map_status.json"
+# fit latency of every star in the MAP fits
+map_latency_file = "tess_{args.sector_id}_{args.camera_id}-{args.chip_id}_map_latency.txt"
+# journal of the stars finished by the MAP fits, so a killed run
+# only refits the missing stars. Removed once the fits are in the store
+map_journal_dir = "tess_{args.sector_id}_{args.camera_id}-{args.chip_id}_map_journal"
+# cache the CBVs keyed on a hash of everything they depend on, so changing
+# only the fitting options (e.g. cbv_mode) reuses them. The cache must be
+# outside root, which is the job's TMPDIR, to outlive the job
+cbv_cache = true
+cbv_cache_dir = "/tess/photometry/tessFFIextract/cbv_cache"
+# evict the least recently used CBVs beyond these limits
+cbv_cache_max_gb = 5
+cbv_cache_max_entries = 50
+# "float64" or "float32", the dtype the fluxes, errors and cotrended outputs
+# are stored, shared and written back as. The fits always run in float64
+precision = "float64"
 
 [catalog]
 # Master input catalog
@@ -103,6 +156,70 @@ max_n_cbvs = 12
 cbv_snr_limit = 5
 # set if we want LS or MAP fitting - NOTE: MAP still needs some work
 cbv_mode = "{args.cbv_mode}"
+# LS fitting engine, "batched" factorises the CBVs once and fits blocks of
+# stars with matrix products, "cotrendy" fits each star in turn
+ls_engine = "batched"
+# number of stars per block for the batched LS engine, bounds its memory use
+ls_chunk_rows = 4096
+# number of stars the batched LS engine, or the stream, is checked against
+# cotrendy's cotrend_data_ls on before fitting, 0 to skip the check
+ls_check_stars = 100
+# stream the full catalog through the LS fit in chunks, reading and writing
+# the light curve store, so memory is set by the chunk size (LS mode only,
+# without reject_outliers). It is checked against cotrendy on ls_check_stars
+streaming = false
+# number of stars per chunk when streaming
+stream_chunk_rows = 2048
+# SVD for the CBVs, "cotrendy" (full SVD), "exact" or "randomised"
+# (leading max_n_cbvs components only)
+svd_mode = "cotrendy"
+# extra random directions and power iterations for svd_mode = "randomised"
+svd_oversample = 10
+svd_power_iters = 2
+# compare the CBVs and SNRs against cotrendy's own, written to the store
+svd_report = false
+# robust fit engine, "cotrendy" or "batched" (IRLS on blocks of stars,
+# checked against cotrendy on robust_check_stars stars first, 0 to skip)
+robust_engine = "cotrendy"
+robust_check_stars = 100
+# number of stars per block for the batched robust fits
+robust_block_rows = 256
+# IRLS options of the batched robust fits: maximum iterations, Huber
+# threshold in units of the residual scatter and convergence tolerance
+robust_n_iter = 20
+robust_huber_t = 1.345
+robust_tol = 1e-6
+# number of processes for the batched robust fits, 1 for serial
+robust_pool_size = {args.robust_pool_size}
+# MAP engine, "cotrendy" (its own MAP, with the large arrays shared with
+# its workers) or "kde" (a separate, simpler estimator, see map_fit.py)
+map_engine = "cotrendy"
+# stars the kde engine is checked against cotrendy (and adaptive mode
+# against the whole grid) on first, the test_stars if there are any, 0 to skip
+map_check_stars = 10
+# number of neighbours making up each star's prior, kde MAP engine only
+prior_n_neighbours = 40
+# only use prior neighbours within this distance in the dim_weights scaled
+# (ra, dec, mag) space, kde MAP engine only, unset for no limit
+# prior_radius = 1.0
+# number of points in the coefficient grids, kde MAP engine only
+map_n_theta = 500
+# "fixed" evaluates the MAP PDFs on the whole grid, "adaptive" refines the
+# grid near the peaks only, checked against the whole grid on the
+# map_check_stars stars first, kde MAP engine only
+map_theta_mode = "fixed"
+# number of stars sent to a MAP worker at a time, kde MAP engine only
+map_chunk_stars = 64
+# seconds between progress updates of the MAP fits
+map_status_interval = 10
+# flag stars whose fit takes more than this many times the median
+map_slow_factor = 10
+# time every star in adaptive mode by fitting them one at a time, to track
+# down slow stars. This is about 3x slower than fitting each block together,
+# the default, which leaves the adaptive stars untimed
+map_star_latency = false
+# seconds between forcing the MAP journal to disk, it is flushed after every block or star
+map_journal_fsync_interval = 30
 # set the normalised variability limit
 normalised_variability_limit = 1.3
 # set the normalised variability limit below which priors are not used